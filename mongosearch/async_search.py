@@ -0,0 +1,128 @@
+"""
+Non-blocking access to searches, for servers built around an event loop.
+
+pymongo blocks, so AsyncSearchCursor runs each search on a bounded pool of
+worker threads shared by the process. Its methods return immediately with
+an AsyncResult (see multiprocessing.pool) and, like Motor's, take an
+optional `callback(result, error)` that is called from the worker thread when
+the work is done; event loop servers can use it to schedule the rest of the
+request back onto the loop. Concurrent searches overlap their postings reads,
+scoring and hydration on the pool, and no more than `threads` of them run at
+once however many are started.
+"""
+import threading
+from multiprocessing.pool import ThreadPool
+
+import mongo_search
+
+DEFAULT_THREADS = 10
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool(threads=DEFAULT_THREADS):
+    """
+    Return the worker pool shared by all asynchronous searches, creating
+    it with `threads` threads if there isn't one yet.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(threads)
+        return _pool
+
+def _submit(func, callback=None):
+    """
+    Run `func` on the worker pool, passing its result or the exception it
+    raised to `callback` as (result, error), and return an AsyncResult whose
+    get() returns the result or raises the exception.
+    """
+    def run():
+        try:
+            result = func()
+        except Exception, e:
+            if callback is not None:
+                callback(None, e)
+            raise
+        if callback is not None:
+            callback(result, None)
+        return result
+    return get_pool().apply_async(run)
+
+class AsyncSearchableCollection(object):
+    """
+    Wrap a pymongo Collection (or SearchableCollection) so that searches
+    return AsyncSearchCursors.
+    """
+    def __init__(self, collection):
+        if not isinstance(collection, mongo_search.SearchableCollection):
+            collection = mongo_search.SearchableCollection(collection)
+        self.searchable_collection = collection
+
+    def __getattr__(self, att):
+        return getattr(self.searchable_collection, att)
+
+    def search(self, search_query, **kwargs):
+        """
+        Return an AsyncSearchCursor for the search. The arguments are as for
+        SearchableCollection.search(). Nothing is done until one of the
+        cursor's methods is called.
+        """
+        return AsyncSearchCursor(self.searchable_collection, search_query, kwargs)
+
+    def search_many(self, queries, callback=None, **kwargs):
+        return _submit(lambda: self.searchable_collection.search_many(queries,
+          **kwargs), callback)
+
+class AsyncSearchCursor(object):
+    """
+    A search that is run on the worker pool. Should not be instantiated
+    directly, but returned by calling AsyncSearchableCollection.search().
+    """
+    def __init__(self, searchable_collection, search_query, search_kwargs):
+        self._searchable_collection = searchable_collection
+        self._search_query = search_query
+        self._search_kwargs = search_kwargs
+        self._cursor = None
+        self._cursor_lock = threading.Lock()
+
+    def _get_cursor(self):
+        # the cursor is created on a worker, as compiling the query can
+        # touch the database
+        with self._cursor_lock:
+            if self._cursor is None:
+                self._cursor = self._searchable_collection.search(
+                  self._search_query, **self._search_kwargs)
+            return self._cursor
+
+    def to_list(self, length=None, callback=None):
+        """
+        Fetch up to `length` results (or all of them), as a list.
+        """
+        def fetch():
+            results = []
+            for doc in self._get_cursor():
+                if length is not None and len(results) >= length:
+                    break
+                results.append(doc)
+            return results
+        return _submit(fetch, callback)
+
+    def each(self, callback):
+        """
+        Call `callback(doc, None)` for each result in turn, then
+        `callback(None, None)` at the end (or `callback(None, error)` if the
+        search fails).
+        """
+        def iterate():
+            for doc in self._get_cursor():
+                callback(doc, None)
+        def finished(result, error):
+            callback(None, error)
+        return _submit(iterate, finished)
+
+    def count(self, approximate=False, callback=None):
+        return _submit(lambda: self._get_cursor().count(approximate), callback)
+
+    def explain(self, callback=None):
+        return _submit(lambda: self._get_cursor().explain(), callback)
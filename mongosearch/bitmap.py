@@ -0,0 +1,104 @@
+"""
+Compressed sets of document numbers.
+
+The postings of an index identify documents by dense integer docnos (see the
+`postings` module), so the documents matching a filter can be kept as a
+bitmap over them rather than a set of `_id`s. DocnoBitmap follows the roaring
+bitmap layout: docnos are split on their high 16 bits into containers, and
+each container holds its low 16 bits either as a sorted array (when sparse)
+or as a 65536-bit bitmap (when dense), whichever is smaller.
+"""
+from array import array
+from bisect import bisect_left
+
+ARRAY_CONTAINER_MAX = 4096 # beyond this, a bitmap container is smaller
+BITMAP_CONTAINER_BYTES = 8192
+
+class DocnoBitmap(object):
+    """
+    An immutable set of non-negative integer docnos.
+    """
+    def __init__(self, docnos=()):
+        self._containers = {}
+        lows_by_high = {}
+        for docno in docnos:
+            lows_by_high.setdefault(docno >> 16, set()).add(docno & 0xFFFF)
+        for high, lows in lows_by_high.iteritems():
+            self._containers[high] = _container(lows)
+        self._length = sum(_container_length(container)
+          for container in self._containers.itervalues())
+
+    def __contains__(self, docno):
+        container = self._containers.get(docno >> 16)
+        if container is None:
+            return False
+        return _container_contains(container, docno & 0xFFFF)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for high in sorted(self._containers):
+            base = high << 16
+            for low in _container_iter(self._containers[high]):
+                yield base | low
+
+    def __and__(self, other):
+        result = DocnoBitmap()
+        for high, container in self._containers.iteritems():
+            other_container = other._containers.get(high)
+            if other_container is None:
+                continue
+            lows = _container_intersection(container, other_container)
+            if lows:
+                result._containers[high] = _container(lows)
+                result._length += len(lows)
+        return result
+
+    def intersection(self, docnos):
+        """
+        Return the list of `docnos` (any iterable) that are in this bitmap.
+        """
+        return [docno for docno in docnos if docno in self]
+
+    def __repr__(self):
+        return '<DocnoBitmap of %d docnos in %d containers>' % (
+          self._length, len(self._containers))
+
+def _container(lows):
+    if len(lows) <= ARRAY_CONTAINER_MAX:
+        return array('H', sorted(lows))
+    bits = bytearray(BITMAP_CONTAINER_BYTES)
+    for low in lows:
+        bits[low >> 3] |= 1 << (low & 7)
+    return bits
+
+def _container_length(container):
+    if isinstance(container, array):
+        return len(container)
+    return sum(bin(byte).count('1') for byte in container if byte)
+
+def _container_contains(container, low):
+    if isinstance(container, array):
+        position = bisect_left(container, low)
+        return position < len(container) and container[position] == low
+    return bool(container[low >> 3] & (1 << (low & 7)))
+
+def _container_iter(container):
+    if isinstance(container, array):
+        return iter(container)
+    return (offset << 3 | bit for offset, byte in enumerate(container) if byte
+      for bit in xrange(8) if byte & (1 << bit))
+
+def _container_intersection(container, other):
+    """
+    Return the set of low bits in both `container` and `other`.
+    """
+    if isinstance(container, array) and isinstance(other, array):
+        return set(container).intersection(other)
+    if isinstance(other, array):
+        container, other = other, container
+    if isinstance(container, array):
+        return set(low for low in container if _container_contains(other, low))
+    both = bytearray(a & b for a, b in zip(container, other))
+    return set(_container_iter(both))
@@ -0,0 +1,91 @@
+"""
+Bloom filters over the stems in each search index.
+
+ensure_text_index builds one filter per index from the stems in its index
+collection and stores it in the `search_.bloom` collection, keyed by the name
+of the index collection. Searches load it once per index generation and use
+it to recognise, without querying the index, stems that are definitely not in
+it - so a query for a word nobody has ever used returns nothing straight
+away.
+"""
+import hashlib
+import math
+import struct
+
+from pymongo.binary import Binary
+
+BLOOM_COLLECTION = 'search_.bloom'
+DEFAULT_ERROR_RATE = 0.01
+
+class BloomFilter(object):
+    """
+    A fixed-size Bloom filter of unicode strings. Membership tests can give
+    false positives (at about `error_rate` when holding `capacity` items) but
+    never false negatives.
+    """
+    def __init__(self, capacity, error_rate=DEFAULT_ERROR_RATE, num_bits=None,
+      num_hashes=None, bits=None):
+        capacity = max(capacity, 1)
+        if num_bits is None:
+            num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        if num_hashes is None:
+            num_hashes = max(int(round(float(num_bits) / capacity * math.log(2))), 1)
+        self.num_bits = max(num_bits, 8)
+        self.num_hashes = num_hashes
+        if bits is None:
+            bits = bytearray((self.num_bits + 7) // 8)
+        self.bits = bits
+
+    def _positions(self, item):
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        digest = hashlib.md5(item).digest()
+        hash_a, hash_b = struct.unpack('<QQ', digest)
+        return [(hash_a + i * hash_b) % self.num_bits for i in xrange(self.num_hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        for position in self._positions(item):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def to_document(self):
+        return {'num_bits': self.num_bits, 'num_hashes': self.num_hashes,
+          'bits': Binary(str(self.bits))}
+
+    @classmethod
+    def from_document(cls, doc):
+        return cls(1, num_bits=doc['num_bits'], num_hashes=doc['num_hashes'],
+          bits=bytearray(doc['bits']))
+
+def build_term_filter(index_collection, error_rate=DEFAULT_ERROR_RATE):
+    """
+    Return a BloomFilter of all the stems in `index_collection`.
+    """
+    stems = set()
+    for entry in index_collection.find({}, ['value._extracted_terms']):
+        stems.update(entry.get('value', {}).get('_extracted_terms', []))
+    term_filter = BloomFilter(len(stems), error_rate)
+    for stem in stems:
+        term_filter.add(stem)
+    return term_filter
+
+def save_term_filter(index_collection, term_filter):
+    doc = term_filter.to_document()
+    doc['_id'] = index_collection.name
+    index_collection.database[BLOOM_COLLECTION].save(doc)
+
+def load_term_filter(index_collection):
+    """
+    Return the stored BloomFilter for `index_collection`, or None if it
+    doesn't have one.
+    """
+    doc = index_collection.database[BLOOM_COLLECTION].find_one(
+      {'_id': index_collection.name})
+    if doc is None:
+        return None
+    return BloomFilter.from_document(doc)
@@ -0,0 +1,130 @@
+"""
+In-process caches for search results, counts and other per-query data.
+
+Keys include the generation of the index being searched, which
+ensure_text_index bumps every time it rebuilds the indexes, so entries never
+need explicit invalidation - stale ones simply stop being asked for and fall
+out of the LRU. Anything that also depends on the source collection (eg. a
+`spec` restriction) is additionally bounded by the cache's `max_age`.
+
+Searches themselves aren't cached, but identical searches running at the same
+time are coalesced by `search_flights`, so only one of them does the work.
+"""
+import sys
+import threading
+import time
+
+DEFAULT_CACHE_SIZE = 1000
+DEFAULT_MAX_AGE = 300 # seconds
+
+_missing = object()
+
+class LRUCache(object):
+    """
+    A small thread-safe least-recently-used cache with optional expiry.
+    """
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, max_age=None):
+        from collections import OrderedDict
+        self.max_size = max_size
+        self.max_age = max_age
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value, stored_at = self._data.pop(key, (_missing, None))
+            if value is _missing:
+                return default
+            if self.max_age is not None and time.time() - stored_at > self.max_age:
+                return default
+            self._data[key] = (value, stored_at) # mark as most recently used
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time())
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the
+    function, and anyone else who asks for the same key while it is running
+    waits for it and shares its result (or exception). `executed` and
+    `coalesced` count the calls of each kind.
+    """
+    def __init__(self):
+        self.executed = 0
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """
+        Return (result, shared), where `result` is that of `func()` or of a
+        concurrent call for the same key, and `shared` says which.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result, True
+        try:
+            call.result = func()
+        except:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def stats(self):
+        with self._lock:
+            return {'executed': self.executed, 'coalesced': self.coalesced,
+              'in_flight': len(self._calls)}
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+# shared by all cursors in this process
+query_cache = LRUCache(max_age=DEFAULT_MAX_AGE)
+# per-index structures loaded from the database, which only change with the
+# index generation
+index_data_cache = LRUCache(max_size=100)
+search_flights = SingleFlight()
+
+def normalise(obj):
+    """
+    Turn a (possibly nested) query document or list into something hashable
+    that compares equal for equivalent queries, for use in cache keys.
+    """
+    if isinstance(obj, dict):
+        return tuple(sorted((key, normalise(val)) for key, val in obj.iteritems()))
+    if isinstance(obj, (list, tuple)):
+        return tuple(normalise(val) for val in obj)
+    return obj
@@ -0,0 +1,166 @@
+"""
+Term dictionaries, for prefix completion.
+
+ensure_text_index builds, for each index, a dictionary collection
+`search_.dictionary.<collection>.<index>` with one {_id: stem, df: ...,
+forms: [...]} record per stem, where `forms` are the words in the documents
+that the stem came from, most common first. The stems and forms are indexed
+for prefix range scans, so TermDictionary.complete() can find the most
+common words starting with a prefix without scanning the index - and keeps
+the completions of recently used prefixes in memory, answering longer
+prefixes from a shorter one's completions whenever those were complete.
+"""
+import re
+
+import pymongo
+
+import cache
+import postings
+import util
+
+DICTIONARY_NAMESPACE = 'search_.dictionary'
+MAX_FORMS = 5 # surface forms kept per stem
+PREFIX_FETCH_SIZE = 100 # completions fetched (and cached) per prefix
+PREFIX_CACHE_SIZE = 1000 # prefixes whose completions are kept in memory
+
+_prefix_cache = cache.LRUCache(max_size=PREFIX_CACHE_SIZE)
+
+def dictionary_coll_name(collection, index_name):
+    return DICTIONARY_NAMESPACE + '.' + collection.name + '.' + index_name
+
+def build_term_dictionary(collection, index_name, fields, index_collection):
+    """
+    (Re)build the term dictionary of the index `index_name` of `collection`
+    from the documents in its index collection, swapping it in when done.
+    """
+    builder = DictionaryBuilder(collection, index_name, fields)
+    for docno, doc in postings.iter_indexed_docs(collection, index_collection, fields):
+        builder.add(docno, doc)
+    return builder.finish()
+
+class DictionaryBuilder(object):
+    """
+    Builds the term dictionary of an index from its documents, given to
+    add() one at a time; finish() writes it and swaps it in.
+    """
+    def __init__(self, collection, index_name, fields):
+        self.collection = collection
+        self.fields = fields
+        self._name = dictionary_coll_name(collection, index_name)
+        self._new_dictionary = collection.database[self._name + '.building']
+        self._new_dictionary.drop()
+        self._doc_freqs = {}
+        self._form_counts = {}
+
+    def add(self, docno, doc):
+        from mongo_search import stem, tokenize
+        stems = set()
+        for fieldname in self.fields:
+            for value in util.get_field(doc, fieldname) or []:
+                if not isinstance(value, basestring):
+                    continue
+                tokens = tokenize(value.lower())
+                for token, token_stem in zip(tokens, stem(tokens)):
+                    stems.add(token_stem)
+                    forms = self._form_counts.setdefault(token_stem, {})
+                    forms[token] = forms.get(token, 0) + 1
+        for token_stem in stems:
+            self._doc_freqs[token_stem] = self._doc_freqs.get(token_stem, 0) + 1
+
+    def finish(self):
+        """
+        Write the dictionary, swap it in and return the number of stems in it.
+        """
+        new_dictionary = self._new_dictionary
+        batch = []
+        for token_stem, doc_freq in self._doc_freqs.iteritems():
+            forms = sorted(self._form_counts[token_stem].iteritems(),
+              key=lambda item: -item[1])
+            batch.append({'_id': token_stem, 'df': doc_freq,
+              'forms': [form for form, count in forms[:MAX_FORMS]]})
+            if len(batch) >= postings.BUILD_BATCH_SIZE:
+                new_dictionary.insert(batch)
+                batch = []
+        if batch:
+            new_dictionary.insert(batch)
+        new_dictionary.ensure_index([('forms', pymongo.ASCENDING)])
+        new_dictionary.ensure_index([('df', pymongo.DESCENDING)])
+        db = self.collection.database
+        db.drop_collection(self._name)
+        if new_dictionary.name in db.collection_names():
+            new_dictionary.rename(self._name)
+        return len(self._doc_freqs)
+
+class TermDictionary(object):
+    """
+    Search-time access to the term dictionary of one index, at generation
+    `generation`.
+    """
+    def __init__(self, collection, index_name, generation):
+        self.terms = collection.database[dictionary_coll_name(collection, index_name)]
+        self._cache_key = (collection.database.name, collection.name, index_name,
+          generation)
+
+    def complete(self, prefix, k=10):
+        """
+        Return up to `k` completions of `prefix`, most common first, as
+        dicts with the completed `term` (its most common form starting with
+        the prefix), its `stem`, `df` and all its `forms`.
+        """
+        prefix = prefix.lower()
+        if not prefix:
+            return []
+        if k > PREFIX_FETCH_SIZE:
+            return self._fetch(prefix, k)[:k]
+        completions = self._cached_completions(prefix)
+        if completions is None:
+            found = self._fetch(prefix, PREFIX_FETCH_SIZE + 1)
+            completions = found[:PREFIX_FETCH_SIZE]
+            _prefix_cache.set(self._cache_key + (prefix,),
+              (completions, len(found) <= PREFIX_FETCH_SIZE))
+        return completions[:k]
+
+    def _cached_completions(self, prefix):
+        """
+        Return the cached completions of `prefix`, or work them out from the
+        cached completions of a shorter prefix if we have all of those.
+        """
+        for length in xrange(len(prefix), 0, -1):
+            entry = _prefix_cache.get(self._cache_key + (prefix[:length],))
+            if entry is None:
+                continue
+            completions, exhaustive = entry
+            if length == len(prefix):
+                return completions
+            if not exhaustive:
+                return None
+            completions = [_completion(completion, prefix) for completion in completions
+              if _completes(completion, prefix)]
+            _prefix_cache.set(self._cache_key + (prefix,), (completions, True))
+            return completions
+        return None
+
+    def _fetch(self, prefix, limit):
+        """
+        Return the `limit` most common completions of `prefix`, from the
+        stems and from the forms starting with it - looked up separately, so
+        each lookup can use its own index, and merged.
+        """
+        found = {}
+        for query_obj in ({'_id': {'$gte': prefix, '$lt': prefix + u'\uffff'}},
+          {'forms': re.compile('^' + re.escape(prefix))}):
+            for rec in self.terms.find(query_obj).sort('df', pymongo.DESCENDING).limit(limit):
+                found[rec['_id']] = rec
+        recs = sorted(found.itervalues(), key=lambda rec: (-rec['df'], rec['_id']))
+        return [_completion(rec, prefix) for rec in recs[:limit]]
+
+def _completes(completion, prefix):
+    return completion['stem'].startswith(prefix) or \
+      [form for form in completion['forms'] if form.startswith(prefix)]
+
+def _completion(rec, prefix):
+    stem = rec.get('stem', rec.get('_id'))
+    forms = rec['forms']
+    matching_forms = [form for form in forms if form.startswith(prefix)]
+    return {'term': (matching_forms or forms or [stem])[0], 'stem': stem,
+      'df': rec['df'], 'forms': forms}
@@ -0,0 +1,106 @@
+"""
+Searching several collections at once.
+
+MultiCollectionSearch searches the same-named index of several
+SearchableCollections and ranks the results together. Each collection's
+postings are scored on a thread of the worker pool that asynchronous searches
+use (see async_search.py), but with idfs computed over all the collections
+(from each index's size and document frequencies): the query is weighted by
+them, and each posting's weight is rescaled from its collection's idf to the
+shared one (see PostingsIndex.query_weights), so that a term that is rare
+overall counts the same everywhere. Document norms stay
+per collection, so the scores are comparable only approximately. The
+per-collection top-k lists are then merged with a heap, and only the overall
+top k documents are fetched.
+"""
+import heapq
+import math
+
+import async_search
+import mongo_search
+
+class MultiCollectionSearch(object):
+    """
+    Search the index `index_name` (the default index, unless given) of each
+    of `collections`. Every index must have been configured with
+    `postings=True`. As its work is done on the shared worker pool, search()
+    mustn't be called from a function that is itself running on that pool.
+    """
+    def __init__(self, collections, index_name=None):
+        self.collections = list(collections)
+        self.index_name = index_name or mongo_search.DEFAULT_INDEX_NAME
+        self._pool = async_search.get_pool()
+
+    def search(self, search_query, limit=10, skip=0, spec=None):
+        """
+        Return a list of the documents matching `search_query` (ranked by
+        score, and each with its `score` and the name of its `_collection`),
+        after skipping `skip` and up to `limit` of them. `spec` is applied
+        to each collection as with SearchableCollection.search().
+        """
+        cursors = [collection.search({self.index_name: search_query}, spec=spec)
+          for collection in self.collections]
+        for cursor in cursors:
+            if cursor._get_postings_index() is None:
+                raise mongo_search.InvalidSearchOperation("Searching several"
+                  " collections needs postings, but the index of '%s' was not"
+                  " configured with postings=True" % cursor.search_collection.name)
+        k = None
+        if limit:
+            k = (skip or 0) + limit
+        idfs = self._shared_idfs(cursors)
+        def rank(cursor):
+            if cursor._definitely_empty():
+                return []
+            cursor._idfs = idfs
+            cursor.limit(k or 0)
+            return cursor._postings_ranking(cursor._get_postings_index())
+        rankings = self._pool.map(rank, cursors)
+        # each list must be in the order of the whole key, ties included
+        merged = heapq.merge(*[sorted((-score, position, id) for id, score in ranked)
+          for position, ranked in enumerate(rankings)])
+        best = [(position, id, -negated_score) for negated_score, position, id
+          in merged][skip or 0:k]
+        return self._hydrate(best)
+
+    def _shared_idfs(self, cursors):
+        """
+        Return a dict of stem: idf over all the collections, for the stems
+        of the query.
+        """
+        def stats(cursor):
+            terms = cursor._plan.terms
+            return (cursor._index_size(),
+              cursor._get_postings_index().term_stats(terms))
+        doc_count = 0
+        doc_freqs = {}
+        for index_size, term_stats in self._pool.map(stats, cursors):
+            doc_count += index_size
+            for term, term_stat in term_stats.iteritems():
+                doc_freqs[term] = doc_freqs.get(term, 0) + term_stat['df']
+        return dict((term, math.log(float(doc_count) / doc_freq))
+          for term, doc_freq in doc_freqs.iteritems())
+
+    def _hydrate(self, best):
+        """
+        Fetch the documents for the (position, _id, score) triples in
+        `best`, one query per collection, and return them in order.
+        """
+        ids_by_position = {}
+        for position, id, score in best:
+            ids_by_position.setdefault(position, []).append(id)
+        def fetch(item):
+            position, ids = item
+            collection = self.collections[position]
+            return position, dict((doc['_id'], doc) for doc in
+              collection.find({'_id': {'$in': ids}}))
+        docs = dict(self._pool.map(fetch, ids_by_position.items()))
+        results = []
+        for position, id, score in best:
+            doc = docs[position].get(id)
+            if doc is None:
+                continue # deleted since it was indexed
+            doc['score'] = score
+            doc['_collection'] = self.collections[position].name
+            results.append(doc)
+        return results
@@ -0,0 +1,136 @@
+"""
+Fuzzy matching of misspelled query words.
+
+A DeletionIndex (the SymSpell approach) maps every string that can be made
+by deleting up to `max_distance` characters from the start of a stem to the
+stems it came from. A misspelled stem within that edit distance of a known
+one shares at least one deletion with it, so looking up the deletions of
+the misspelling finds all its candidate corrections without scanning the
+term dictionary; each candidate is then checked with a real edit distance.
+
+The deletion index of an index is built from its term dictionary (see
+dictionary.py) the first time it's needed in the process, and when the
+index has been rebuilt it is updated from the new dictionary - only the
+stems that were added or removed have their deletions worked out again.
+"""
+import threading
+
+import dictionary
+
+MAX_DISTANCE = 2
+PREFIX_LENGTH = 7 # deletions are only generated from this many leading characters
+
+_latest = {} # (database, collection, index name): the most recent DeletionIndex
+_latest_lock = threading.Lock()
+
+class DeletionIndex(object):
+    """
+    A SymSpell deletion index of a set of stems, with their document
+    frequencies.
+    """
+    def __init__(self, max_distance=MAX_DISTANCE, prefix_length=PREFIX_LENGTH):
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.doc_freqs = {}
+        self._deletions = {}
+        self._lock = threading.Lock()
+
+    def update(self, doc_freqs):
+        """
+        Make the index hold exactly the stems in the dict of stem: document
+        frequency `doc_freqs`, adding and removing stems as needed.
+        """
+        with self._lock:
+            for stem in set(self.doc_freqs) - set(doc_freqs):
+                for deletion in self._deletes(stem):
+                    stems = self._deletions.get(deletion)
+                    if stems is not None:
+                        stems.discard(stem)
+                        if not stems:
+                            del self._deletions[deletion]
+            for stem in set(doc_freqs) - set(self.doc_freqs):
+                for deletion in self._deletes(stem):
+                    self._deletions.setdefault(deletion, set()).add(stem)
+            self.doc_freqs = dict(doc_freqs)
+
+    def lookup(self, word, max_distance=None):
+        """
+        Return the stems closest to `word` within `max_distance` edits (the
+        index's maximum, by default), as a list of (stem, distance), most
+        common first.
+        """
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+        with self._lock:
+            candidates = set()
+            for deletion in self._deletes(word, max_distance):
+                candidates.update(self._deletions.get(deletion, ()))
+            found = []
+            for stem in candidates:
+                distance = edit_distance(word, stem, max_distance)
+                if distance is not None:
+                    found.append((stem, distance))
+            found.sort(key=lambda item: (item[1], -self.doc_freqs[item[0]], item[0]))
+        return found
+
+    def _deletes(self, word, max_distance=None):
+        """
+        Return the set of strings made by deleting up to `max_distance`
+        characters from the prefix of `word`, including the prefix itself.
+        """
+        if max_distance is None:
+            max_distance = self.max_distance
+        prefix = word[:self.prefix_length]
+        deletes = set([prefix])
+        edges = [prefix]
+        for distance in xrange(max_distance):
+            next_edges = []
+            for edge in edges:
+                if len(edge) <= 1:
+                    continue
+                for i in xrange(len(edge)):
+                    deletion = edge[:i] + edge[i + 1:]
+                    if deletion not in deletes:
+                        deletes.add(deletion)
+                        next_edges.append(deletion)
+            edges = next_edges
+        return deletes
+
+def edit_distance(a, b, max_distance):
+    """
+    Return the edit distance (insertions, deletions, substitutions and
+    transpositions of adjacent characters) between `a` and `b`, or None if
+    it is more than `max_distance`.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return None
+    previous = None
+    current = range(len(b) + 1)
+    for i in xrange(1, len(a) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(b)
+        for j in xrange(1, len(b) + 1):
+            cost = int(a[i - 1] != b[j - 1])
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        if min(current) > max_distance:
+            return None
+    if current[-1] > max_distance:
+        return None
+    return current[-1]
+
+def load_deletion_index(collection, index_name):
+    """
+    Return the DeletionIndex of the term dictionary of the index
+    `index_name` of `collection`, bringing the one last loaded for that
+    index up to date rather than building it from scratch.
+    """
+    key = (collection.database.name, collection.name, index_name)
+    terms = collection.database[dictionary.dictionary_coll_name(collection, index_name)]
+    doc_freqs = dict((rec['_id'], rec['df']) for rec in terms.find({}, ['df']))
+    with _latest_lock:
+        deletion_index = _latest.get(key)
+        if deletion_index is None:
+            deletion_index = _latest[key] = DeletionIndex()
+    deletion_index.update(doc_freqs)
+    return deletion_index
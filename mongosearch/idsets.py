@@ -0,0 +1,85 @@
+"""
+Compact storage for large lists of document `_id`s.
+
+A spec that matches hundreds of thousands of documents turns into that many
+`_id`s, which as a python list of boxed values (let alone a list of result
+dicts) costs far more memory than the ids themselves. CompactIds keeps ints
+and floats in an array and ObjectIds as packed 12-byte strings, falling back
+to a list for anything else, and hands them out in chunks small enough to
+put in an `$in` without approaching the BSON document size limit.
+"""
+from array import array
+
+from pymongo.objectid import ObjectId
+
+ID_CHUNK_SIZE = 50000 # ids per $in clause
+
+class CompactIds(object):
+    """
+    An append-only sequence of `_id`s, stored as compactly as their types
+    allow.
+    """
+    def __init__(self, ids=()):
+        self._kind = None
+        self._data = None
+        self._length = 0
+        for id in ids:
+            self.append(id)
+
+    def append(self, id):
+        kind = _kind_of(id)
+        if self._kind is None:
+            self._kind = kind
+            self._data = _new_storage(kind)
+        elif kind != self._kind and self._kind != 'other':
+            # mixed types; give up and use a list
+            self._data = list(self)
+            self._kind = 'other'
+        if self._kind == 'objectid':
+            self._data.extend(id.binary)
+        else:
+            self._data.append(id)
+        self._length += 1
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        if self._kind == 'objectid':
+            data = str(self._data)
+            return (ObjectId(data[i:i + 12]) for i in xrange(0, len(data), 12))
+        return iter(self._data or [])
+
+    def chunks(self, size=ID_CHUNK_SIZE):
+        return chunks(self, size)
+
+def _kind_of(id):
+    if type(id) is int:
+        return 'int'
+    if type(id) is float:
+        return 'float'
+    if isinstance(id, ObjectId):
+        return 'objectid'
+    return 'other'
+
+def _new_storage(kind):
+    if kind == 'int':
+        return array('l')
+    if kind == 'float':
+        return array('d')
+    if kind == 'objectid':
+        return bytearray()
+    return []
+
+def chunks(ids, size=ID_CHUNK_SIZE):
+    """
+    Yield lists of at most `size` of `ids` at a time.
+    """
+    chunk = []
+    for id in ids:
+        chunk.append(id)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -18,18 +18,51 @@ search.encodeQueryString
 TODO: provide access to a non-ranked search that searches for matching stems
 in the full-text index
 """
+import calendar
+import datetime
+import heapq
+import itertools
+import math
+import random
 import re
+import threading
 
 import pymongo
+from operator import itemgetter
+
 from pymongo.code import Code
+from pymongo.objectid import ObjectId
 
 import util
 import porter
+import bitmap
+import bloom
+import cache
+import dictionary
+import fuzzy
+import idsets
+import ngrams
+import postings
+import query
 
 TOKENIZE_BASIC_RE = re.compile(r"\b(\w[\w'-]*\w|\w)\b") #this should match the RE in use on the server
 INDEX_NAMESPACE = 'search_.indexes'
 CONFIG_COLLECTION = 'search_.config'
 DEFAULT_INDEX_NAME = 'default_'
+RESULT_PAGE_SIZE = 20 # number of hydrated results fetched at a time for random access
+APPROXIMATE_COUNT_SAMPLE_SIZE = 500 # index entries examined by count(approximate=True)
+APPROXIMATE_COUNT_SAMPLE_BLOCKS = 5 # contiguous runs the sample is taken in
+SPEC_COUNT_LIMIT = 10000 # stop counting a spec's matches when estimating its selectivity
+POST_FILTER_BATCH_SIZE = 100 # minimum ranked results checked against a spec at a time
+FILTER_FIELDS_KEY = '_filter' # where index entries keep their stored filter fields
+STORED_FIELDS_KEY = '_stored' # ... and their stored display fields
+PREFIX_EXPANSION_LIMIT = 20 # completions a `word*` query is expanded into
+FUZZY_EXPANSION_LIMIT = 5 # corrections a misspelled stem is expanded into
+PREFETCH_LIMIT = 8 # background page fetches outstanding at once, per process
+FILTER_FIRST = 'filter_first'
+SCORE_FIRST = 'score_first'
+
+_prefetch_slots = threading.BoundedSemaphore(PREFETCH_LIMIT)
 
 def ensure_text_index(collection):
     """
@@ -40,17 +73,153 @@ def ensure_text_index(collection):
         mapReduceTermScore , which creates a table of scores for each term.
           which is covered by mapReduceIndexTheLot
     """
-    return util.exec_js_from_string(
+    result = util.exec_js_from_string(
       "mft.get('search').mapReduceIndexTheLot('%s');" % collection.name,
       collection.database)
+    _build_index_data(collection)
+    return result
 
-def configure_text_index_fields(collection, fields, index_name=None):
+def _build_index_data(collection):
+    """
+    Build what's kept alongside each index on `collection`: a Bloom filter
+    of its stems, so searches can skip stems that aren't in the index, and
+    whichever of the stored fields, postings (see postings.py), term
+    dictionary (see dictionary.py) and trigrams (see ngrams.py) it's
+    configured with - all from one pass over its documents. Then increment
+    each index's generation counter, so that anything cached against the
+    old index contents is no longer used.
+    """
+    db = collection.database
+    coll_name_spec = {'collection_name': collection.name}
+    collection_conf = db[CONFIG_COLLECTION].find_one(coll_name_spec)
+    if not collection_conf or not collection_conf.get('indexes'):
+        return
+    existing = db.collection_names()
+    built = {}
+    for index_name, index_conf in collection_conf['indexes'].iteritems():
+        idx_coll = db[index_coll_name(collection, index_name)]
+        if idx_coll.name in existing:
+            bloom.save_term_filter(idx_coll, bloom.build_term_filter(idx_coll))
+        builders = _index_data_builders(collection, index_name, index_conf, idx_coll)
+        if not builders:
+            continue
+        fields = set()
+        for builder, conf_keys in builders:
+            fields.update(builder.fields)
+        for docno, doc in postings.iter_indexed_docs(collection, idx_coll, fields):
+            for builder, conf_keys in builders:
+                builder.add(docno, doc)
+        for builder, conf_keys in builders:
+            builder.finish()
+            built.update(('indexes.%s.%s' % (index_name, conf_key), True)
+              for conf_key in conf_keys)
+    update = {'$inc': dict(('indexes.%s.generation' % index_name, 1)
+      for index_name in collection_conf['indexes'])}
+    if built:
+        update['$set'] = built
+    db[CONFIG_COLLECTION].update(coll_name_spec, update)
+
+def _index_data_builders(collection, index_name, index_conf, index_collection):
+    """
+    Return a (builder, config keys to set when it's done) pair for each
+    thing the index `index_name` is configured to have built from its
+    documents.
+    """
+    fields = index_conf['fields']
+    builders = []
+    fields_by_key = {}
+    for key, conf_key in [(FILTER_FIELDS_KEY, 'filter_fields'),
+      (STORED_FIELDS_KEY, 'stored_fields')]:
+        if index_conf.get(conf_key):
+            fields_by_key[key] = index_conf[conf_key]
+    if fields_by_key:
+        builders.append((_IndexFieldsCopier(index_collection, fields_by_key,
+          index_conf.get('filter_fields', [])), [conf_key + '_built' for conf_key
+          in ['filter_fields', 'stored_fields'] if index_conf.get(conf_key)]))
+    if index_conf.get('postings'):
+        with_positions = index_conf.get('positions', False)
+        builders.append((postings.PostingsBuilder(collection, index_name, fields,
+          with_positions),
+          ['postings_built'] + (['positions_built'] if with_positions else [])))
+    if index_conf.get('dictionary'):
+        builders.append((dictionary.DictionaryBuilder(collection, index_name,
+          fields), ['dictionary_built']))
+    if index_conf.get('trigrams'):
+        builders.append((ngrams.TrigramBuilder(collection, index_name, fields),
+          ['trigrams_built']))
+    return builders
+
+class _IndexFieldsCopier(object):
+    """
+    For each key: fields pair in `fields_by_key`, sets the key on the entry
+    in `index_collection` of each document given to add() to a subdocument
+    holding those fields of the document; finish() indexes the
+    `filter_fields` there.
+    """
+    def __init__(self, index_collection, fields_by_key, filter_fields):
+        self.index_collection = index_collection
+        self.fields_by_key = fields_by_key
+        self.filter_fields = filter_fields
+        self.fields = set()
+        for fields in fields_by_key.itervalues():
+            self.fields.update(fields)
+    
+    def add(self, docno, doc):
+        update = {}
+        for key, fields in self.fields_by_key.iteritems():
+            update[key] = _project(doc, fields)
+        self.index_collection.update({'_id': doc['_id']}, {'$set': update})
+    
+    def finish(self):
+        for field in self.filter_fields:
+            self.index_collection.ensure_index(
+              [(FILTER_FIELDS_KEY + '.' + field, pymongo.ASCENDING)])
+
+def _project(doc, fields):
+    """
+    Return the parts of the (already projected) `doc` under the top-level
+    fields of the `fields` paths.
+    """
+    top_level = set(field.split('.')[0] for field in fields)
+    return dict((name, value) for name, value in doc.iteritems()
+      if name in top_level and name != '_id')
+
+def configure_text_index_fields(collection, fields, index_name=None, postings=False,
+  filter_fields=None, stored_fields=None, trigrams=False, positions=False,
+  dictionary=False):
     """
     Configure the text search index named `index_name` on the supplied `collection`.
     
     `fields_json` should be dict
     with fieldnames as keys and integers as values -- eg:
         "{'content': 1, 'title': 5}"
+    
+    If `postings` is True, ensure_text_index also builds python-side postings
+    for the index, which lets searches be scored without map_reduce and
+    stop early when they have a limit. See the `postings` module.
+    `positions=True` implies `postings`, and makes the postings record where
+    each stem occurs, so that phrase ("john dory") and NEAR/k searches are
+    exact rather than matching documents with the words anywhere. See the
+    `positions` module.
+    
+    `filter_fields` is an optional list of field names whose values
+    ensure_text_index copies into the index entries (and indexes there). A
+    search `spec` that only refers to those fields (and `_id`) is then
+    applied directly to the index collection instead of being resolved
+    against this one first - against the values as they were when the index
+    was last built.
+    
+    `stored_fields` is an optional list of field names that are likewise
+    copied into the index entries, so that searches with `hydrate=False` can
+    return them without reading this collection.
+    
+    If `trigrams` is True, ensure_text_index also builds character trigram
+    postings for the index's fields, for substring_search. See the `ngrams`
+    module.
+    
+    If `dictionary` is True, ensure_text_index also builds a dictionary of
+    the index's terms, which complete(), prefix searches ("whipp*") and fuzzy
+    searches use. See the `dictionary` module.
         
     re-implementation of the JS function 'search.configureSearchIndexFields'
     """
@@ -66,6 +235,10 @@ def configure_text_index_fields(collection, fields, index_name=None):
         if not isinstance(fieldvalue, int):
             raise InvalidSearchFieldConfiguration("Field value (the keys of the `fields` dict)"
                 "must be integers. You supplied %r of type %s" % (fieldvalue, type(fieldvalue)))
+    for fieldname in list(filter_fields or []) + list(stored_fields or []):
+        if not isinstance(fieldname, basestring) or fieldname.startswith('$'):
+            raise InvalidSearchFieldConfiguration("Filter and stored fields must be"
+                " lists of field names. You supplied %r" % (fieldname,))
     db = collection.database
     coll_name_spec = {'collection_name': collection.name}
     collection_conf = db[CONFIG_COLLECTION].find_one(coll_name_spec);
@@ -73,8 +246,24 @@ def configure_text_index_fields(collection, fields, index_name=None):
         collection_conf = {'collection_name': collection.name}
     if 'indexes' not in collection_conf: 
         collection_conf['indexes'] = { }
-    collection_conf['indexes'][index_name] = { }
-    collection_conf['indexes'][index_name]['fields'] = fields
+    index_conf = {'fields': fields}
+    if postings or positions:
+        index_conf['postings'] = True
+    if positions:
+        index_conf['positions'] = True
+    if filter_fields:
+        index_conf['filter_fields'] = list(filter_fields)
+    if stored_fields:
+        index_conf['stored_fields'] = list(stored_fields)
+    if trigrams:
+        index_conf['trigrams'] = True
+    if dictionary:
+        index_conf['dictionary'] = True
+    old_index_conf = collection_conf['indexes'].get(index_name)
+    if old_index_conf and 'generation' in old_index_conf:
+        # keep counting, so cached results for the old index can't be revived
+        index_conf['generation'] = old_index_conf['generation']
+    collection_conf['indexes'][index_name] = index_conf
     db[CONFIG_COLLECTION].update(coll_name_spec, collection_conf, upsert=True);
     
     
@@ -95,13 +284,83 @@ def raw_search(collection, search_query):
     db = collection.database
     res = db[index_coll_name(collection, index_name)].map_reduce(
       map_js, reduce_js, scope=scope, query=query_obj)
-    res.ensure_index([('value.score', pymongo.ASCENDING)]) # can't demand backgrounding in python seemingly?
+    res.ensure_index([('value', pymongo.ASCENDING)]) # can't demand backgrounding in python seemingly?
     # should we be returning a verbose result, or just the collection here?
     return res
 
 def _query_obj_for_terms(search_query_terms):
     return {'value._extracted_terms': {'$all': search_query_terms}}
     
+def _restrict_query(query_obj, id_list):
+    """
+    Restrict the index query `query_obj` to the entries with the given `_id`s.
+    """
+    return _and_queries(query_obj, {'_id': {'$in': list(id_list)}})
+
+def _and_queries(query_obj, other):
+    """
+    Return a query matching what both `query_obj` and `other` match.
+    """
+    if set(query_obj) & set(other):
+        return {'$and': [query_obj, other]}
+    query_obj = dict(query_obj)
+    query_obj.update(other)
+    return query_obj
+
+def _pushdown_spec(spec, filter_fields):
+    """
+    Translate `spec` into a query on index entries that store `filter_fields`
+    under FILTER_FIELDS_KEY, or return None if it refers to anything else.
+    """
+    translated = {}
+    for key, value in spec.iteritems():
+        if key in ('$and', '$or', '$nor'):
+            clauses = [_pushdown_spec(clause, filter_fields) for clause in value]
+            if None in clauses:
+                return None
+            translated[key] = clauses
+        elif key == '_id':
+            translated[key] = value
+        elif not key.startswith('$') and [field for field in filter_fields
+          if key == field or key.startswith(field + '.')]:
+            translated[FILTER_FIELDS_KEY + '.' + key] = value
+        else:
+            return None
+    return translated
+
+def _chunked_map_reduce(source_coll, map_js, reduce_js, query_obj, id_list, **kwargs):
+    """
+    map_reduce over the entries of `source_coll` matching `query_obj` whose
+    `_id`s are in `id_list`.
+    
+    A big enough id list won't fit in one query document, so it is split into
+    chunks of idsets.ID_CHUNK_SIZE, each chunk is run separately and the
+    results of the later chunks are copied into the result collection of the
+    first. Every document is in exactly one chunk, so there is nothing to
+    reduce across them.
+    """
+    result_coll = None
+    for chunk in idsets.chunks(id_list):
+        chunk_result = source_coll.map_reduce(map_js, reduce_js,
+          query=_restrict_query(query_obj, chunk), **kwargs)
+        if result_coll is None:
+            result_coll = chunk_result
+            continue
+        batch = []
+        for rec in chunk_result.find():
+            batch.append(rec)
+            if len(batch) >= idsets.ID_CHUNK_SIZE:
+                result_coll.insert(batch)
+                batch = []
+        if batch:
+            result_coll.insert(batch)
+        chunk_result.drop()
+    if result_coll is None:
+        # nothing to restrict to; still produce an (empty) result collection
+        result_coll = source_coll.map_reduce(map_js, reduce_js,
+          query=_restrict_query(query_obj, []), **kwargs)
+    return result_coll
+    
 def search_by_query(collection, search_query_string, query_obj):
     """
     Search, returning full result sets and limiting by the supplied id_list
@@ -109,7 +368,7 @@ def search_by_query(collection, search_query_string, query_obj):
     """
     # because we only have access to the index collection later, we have to convert 
     # the query_obj to an id list
-    id_list = [rec['_id'] for rec in collection.find(query_obj, ['_id'])]
+    id_list = idsets.CompactIds(rec['_id'] for rec in collection.find(query_obj, ['_id']))
     return search_by_ids(collection, search_query_string, id_list)
 
 def search_by_ids(collection, search_query_string, id_list=None):
@@ -124,11 +383,11 @@ def search_by_ids(collection, search_query_string, id_list=None):
     db = collection.database
     sorting = {'value.score': pymongo.DESCENDING}
     if id_list is None:
-        id_query_obj = {}
+        res_coll = db[search_coll_name].map_reduce(map_js, reduce_js, 
+            query={}, scope=scope, sort=sorting)
     else:
-        id_query_obj = {'_id': {'$in': id_list}}
-    res_coll = db[search_coll_name].map_reduce(map_js, reduce_js, 
-        query=id_query_obj, scope=scope, sort=sorting)
+        res_coll = _chunked_map_reduce(db[search_coll_name], map_js, reduce_js,
+            {}, id_list, scope=scope, sort=sorting)
     #should we be ensuring an index here? or just leave it?
     # res_coll.ensure_index([('value.score', pymongo.ASCENDING)])
     return res_coll.find()
@@ -171,13 +430,15 @@ class SearchableCollection(object):
     def get_configuration(self):
         return self.search_collection.database[CONFIG_COLLECTION].find_one({'collection_name': self.search_collection.name})
     
-    def search(self, search_query, spec=None, id_list=None, limit=None, skip=None):
+    def search(self, search_query, spec=None, id_list=None, limit=None, skip=None,
+      hydrate=True, boosts=None, prefetch=False, fuzzy=False):
         """Search for the specified `search_query` in this collection.
         
         `search_query` can be a string, which will search in the default index
         named '_default', or a dictionary, where the key indicates which named
-        index to search in. Currently searching through multiple indexes is not
-        supported.
+        index to search in. A dictionary with several keys searches all those
+        indexes at once (see MultiIndexSearchCursor), with `boosts` an optional
+        dict of index name: weight.
         
         `spec` prefilters the search results with the given query object,
         operating the same way as the same argument to .find() on a regular
@@ -185,10 +446,135 @@ class SearchableCollection(object):
         `id_list` is a list of values for `_id` which you want to restrict the
         search to. If you know the id_list already, it is more efficient to
         supply that than `spec`, as the latter is converted to an id_list
-        behind the scenes to make it compatible with MapReduce.
+        behind the scenes to make it compatible with MapReduce - unless the
+        index stores all the fields the spec refers to (see
+        configure_text_index_fields' `filter_fields`).
         `limit` and `skip` have the same meaning as the arguments to .find()
+        With `hydrate=False`, results are built from the index alone: just
+        `_id`, `score` and the index's stored fields (see
+        configure_text_index_fields), without reading the documents.
+        With `prefetch=True`, whenever a page of results is read the next one
+        is fetched in the background (see SearchCursor._prefetch_page).
+        With `fuzzy=True` (or a maximum edit distance, 1 or 2), stems that
+        aren't in the index are replaced by the closest ones that are, as
+        found in its term dictionary (see fuzzy.py).
+        """
+        if isinstance(search_query, dict) and len(search_query) > 1:
+            if not hydrate:
+                raise InvalidSearchOperation("Searches of several indexes"
+                  " are always hydrated")
+            return MultiIndexSearchCursor(self, search_query, spec=spec,
+              id_list=id_list, limit=limit, skip=skip, boosts=boosts,
+              prefetch=prefetch, fuzzy=fuzzy)
+        return SearchCursor(self, search_query, spec=spec, id_list=id_list, limit=limit,
+          skip=skip, hydrate=hydrate, prefetch=prefetch, fuzzy=fuzzy)
+    
+    def complete(self, prefix, k=10, index_name=None):
         """
-        return SearchCursor(self, search_query, spec=spec, id_list=id_list, limit=limit, skip=skip)
+        Return up to `k` completions of the word `prefix` from the term
+        dictionary of the index named `index_name` (or the default index),
+        those in the most documents first. The index must have been
+        configured with `dictionary=True`. See dictionary.TermDictionary.
+        """
+        if index_name is None:
+            index_name = DEFAULT_INDEX_NAME
+        index_conf = ((self.get_configuration() or {}).get('indexes') or {}).get(index_name)
+        if index_conf is None:
+            raise SearchIndexNotConfiguredException("Index '%s' has not been"
+              " configured" % index_name)
+        if not index_conf.get('dictionary_built'):
+            raise SearchIndexNotInitializedException("The term dictionary of"
+              " index '%s' has not been built; run ensure_text_index" % index_name)
+        return dictionary.TermDictionary(self.search_collection, index_name,
+          index_conf.get('generation', 0)).complete(prefix, k)
+    
+    def substring_search(self, substring, index_name=None, spec=None, fields=None):
+        """
+        Return an iterator over the documents with `substring` (ignoring
+        case) in any of the fields of the index named `index_name` (or the
+        default index), which must have been configured with
+        `trigrams=True`. `spec` and `fields` are as for .find().
+        
+        Only the documents containing all the substring's trigrams are
+        checked for the substring itself, which must be at least three
+        characters long.
+        """
+        if index_name is None:
+            index_name = DEFAULT_INDEX_NAME
+        index_conf = ((self.get_configuration() or {}).get('indexes') or {}).get(index_name)
+        if index_conf is None:
+            raise SearchIndexNotConfiguredException("Index '%s' has not been"
+              " configured" % index_name)
+        if not index_conf.get('trigrams_built'):
+            raise SearchIndexNotInitializedException("Index '%s' has no trigram"
+              " postings; configure it with trigrams=True and run"
+              " ensure_text_index" % index_name)
+        try:
+            candidates = ngrams.TrigramIndex(self.search_collection,
+              index_name).candidates(substring)
+        except ValueError, e:
+            raise InvalidSearchOperation(str(e))
+        pattern = re.compile(re.escape(substring), re.IGNORECASE | re.UNICODE)
+        verify = {'$or': [{fieldname: pattern} for fieldname in index_conf['fields']]}
+        return itertools.chain(*[self.search_collection.find(
+          _and_queries(spec or {}, _restrict_query(verify, chunk)), fields)
+          for chunk in idsets.chunks(candidates)])
+    
+    def search_session(self, index_name=None, limit=10):
+        """
+        Return a typeahead.SearchSession, for searching as the user types.
+        """
+        import typeahead
+        return typeahead.SearchSession(self, index_name, limit)
+    
+    def search_many(self, queries, limit=10, index_name=None):
+        """
+        Run the searches in `queries` - query strings for the index named
+        `index_name`, or the default index - together, returning a list with
+        the results of each: a list of up to `limit` documents with scores.
+        
+        The searches share as much work as they can. With postings, the term
+        statistics for all their terms are fetched at once and each term's
+        postings are only read once (see postings.SharedPostingsIndex), and
+        the results of all of them are fetched from the collection together.
+        """
+        if index_name is None:
+            index_name = DEFAULT_INDEX_NAME
+        # resolve the index once, and have the term statistics in the cache
+        # before any of the queries is compiled
+        index_config = ((self.get_configuration() or {}).get('indexes') or {}).get(
+          index_name)
+        idx_coll = _get_index_collection(self, index_name, index_config)
+        shared_index = None
+        if (index_config or {}).get('postings_built'):
+            shared_index = postings.SharedPostingsIndex(self.search_collection,
+              index_name, idx_coll, bool(index_config.get('positions_built')))
+            # the terms of the parsed queries, without operators or field
+            # names; the plans can't be compiled without their dfs
+            terms = set()
+            for search_query in queries:
+                terms.update(term.stem for term, negated in query.iter_terms(
+                  query.parse(search_query, stem_and_tokenize)) if term.field is None)
+            _prime_document_frequencies(self, index_name, index_config, terms,
+              shared_index.term_stats(terms))
+        cursors = [SearchCursor(self, {index_name: search_query}, limit=limit,
+          index_collection=idx_coll, index_config=index_config)
+          for search_query in queries]
+        rankings = []
+        for cursor in cursors:
+            if cursor._definitely_empty():
+                rankings.append([])
+            elif shared_index is not None:
+                rankings.append(cursor._postings_ranking(shared_index))
+            else:
+                cursor._raw_search()
+                rankings.append(cursor._ranked_raw_results(FILTER_FIRST))
+        docs = {}
+        for chunk in idsets.chunks(set(id for ranked in rankings for id, score in ranked)):
+            docs.update((doc['_id'], doc) for doc in
+              self.search_collection.find({'_id': {'$in': chunk}}))
+        return [[dict(docs[id], score=score) for id, score in ranked if id in docs]
+          for ranked in rankings]
 
 
 class SearchCursor(object):
@@ -196,10 +582,10 @@ class SearchCursor(object):
     A cursor to iterate through search results. Should not be instantiated
     directly, but returned by calling SearchableCollection.search().
     """
-    def __init__(self, search_collection, search_query, id_list=None, spec=None, limit=0, skip=0):
-        if id_list and spec:
-            raise InvalidSearchOperation("Can't set id_list and spec at the same time")
-        self.search_collection = search_collection
+    def __init__(self, search_collection, search_query, id_list=None, spec=None, limit=0, skip=0,
+      hydrate=True, prefetch=False, fuzzy=False, index_collection=None, index_config=None):
+        self._init_cursor_state(search_collection, id_list, spec, limit, skip,
+          hydrate, prefetch, fuzzy)
         if isinstance(search_query, dict): #eww, not very pythonic, any ideas here?
             if len(search_query) > 1 or len(search_query) == 0:
                 raise InvalidSearchOperation("Number of indexes requested must "
@@ -210,13 +596,44 @@ class SearchCursor(object):
         else:
             self.search_query_string = search_query
             self.search_index_name = DEFAULT_INDEX_NAME 
-        self.search_query_terms = process_query_string(self.search_query_string)
+        # already resolved by a caller searching the same index repeatedly
+        self._index_collection = index_collection
+        self._index_config = index_config
+        self._get_search_idx_collection() #throw an error now for invalid index
+        self._plan = self._get_query_plan()
+        self.search_query_terms = self._plan.terms
+
+    def _init_cursor_state(self, search_collection, id_list, spec, limit, skip,
+      hydrate, prefetch, fuzzy):
+        """
+        Set up the state that doesn't depend on the index being searched,
+        shared with MultiIndexSearchCursor.
+        """
+        if id_list and spec:
+            raise InvalidSearchOperation("Can't set id_list and spec at the same time")
+        self.search_collection = search_collection
         self._id_list = id_list
         self._spec = spec
         self._actual_result_cursor = None
+        self._raw_result_coll = None
+        self._resolved_id_list = None
+        self._resolved_scoped_ids = None
+        self._restriction_strategy = None
+        self._explanation = {}
+        self._index_collection = None
+        self._index_config = None
+        self._page_cache = {}
+        self._prefetch = prefetch
+        self._prefetches = {}
+        self._page_lock = threading.Lock()
+        self._result_total = None
+        self._empty = False
         self._limit = limit
         self._skip = skip
-        self._get_search_idx_collection() #throw an error now for invalid index
+        self._hydrate = hydrate
+        self._sort = None
+        self._idfs = None # overrides the index's idfs; see federated.py
+        self._fuzzy = _max_edit_distance(fuzzy)
 
     def _cached_result_cursor(self):
         if self._actual_result_cursor is None:
@@ -224,11 +641,129 @@ class SearchCursor(object):
         return self._actual_result_cursor
     
     def __iter__(self):
+        if self._empty:
+            return
+        if self._prefetch:
+            # go page by page, so each page is prefetched while the one
+            # before it is being used
+            page_number = 0
+            while page_number * RESULT_PAGE_SIZE < self._result_count():
+                for doc in self._get_result_page(page_number):
+                    yield doc
+                page_number += 1
+            return
         for wrapped_rec in self._cached_result_cursor():
             yield wrapped_rec['value']
         
     def __getitem__(self, item):
-        return self._cached_result_cursor()[item]['value']
+        """
+        Get a single result, or restrict the search to a slice of the results.
+        
+        Slicing works like slicing a regular cursor: it must happen before the
+        search is executed, is translated into skip and limit, and returns this
+        cursor. Integer access executes the search and is served from a cache
+        of result pages, so repeated or nearby access doesn't requery the
+        server.
+        """
+        if isinstance(item, slice):
+            return self._apply_slice(item)
+        if not isinstance(item, (int, long)):
+            raise TypeError("SearchCursor indices must be integers or slices,"
+              " not %s" % type(item).__name__)
+        if item < 0:
+            raise IndexError("SearchCursor does not support negative indices")
+        page = self._get_result_page(item // RESULT_PAGE_SIZE)
+        try:
+            return page[item % RESULT_PAGE_SIZE]
+        except IndexError:
+            raise IndexError("no such item for SearchCursor")
+    
+    def _apply_slice(self, item):
+        if self._actual_result_cursor is not None:
+            raise InvalidSearchOperation("Cannot set search options after"
+             " executing SearchQuery")
+        if item.step is not None:
+            raise IndexError("SearchCursor does not support slice steps")
+        start = item.start or 0
+        if start < 0 or (item.stop is not None and item.stop < 0):
+            raise IndexError("SearchCursor does not support negative slice"
+              " indices")
+        # the slice is relative to any skip and limit already set
+        if self._limit:
+            stop = self._limit
+            if item.stop is not None:
+                stop = min(stop, item.stop)
+        else:
+            stop = item.stop
+        self._skip = (self._skip or 0) + start
+        if stop is not None:
+            if stop <= start:
+                self._empty = True
+            self._limit = max(stop - start, 0)
+        return self
+    
+    def _get_result_page(self, page_number):
+        """
+        Return the hydrated results on page `page_number` of this cursor's
+        results, fetching them if we haven't already.
+        """
+        if self._empty:
+            return []
+        with self._page_lock:
+            prefetching = self._prefetches.get(page_number)
+        if prefetching is not None:
+            prefetching.wait()
+        try:
+            page = self._page_cache[page_number]
+        except KeyError:
+            page = self._page_cache[page_number] = self._fetch_page(page_number)
+        if self._prefetch:
+            self._prefetch_page(page_number + 1)
+        return page
+    
+    def _fetch_page(self, page_number):
+        page_cursor = self._cached_result_cursor().clone()
+        page_cursor.skip(page_number * RESULT_PAGE_SIZE)
+        page_cursor.limit(RESULT_PAGE_SIZE)
+        return [wrapped_rec['value'] for wrapped_rec in page_cursor]
+    
+    def _prefetch_page(self, page_number):
+        """
+        Start fetching page `page_number` into the page cache on a background
+        thread, unless it's past the end of the results, already fetched or
+        being fetched, or PREFETCH_LIMIT prefetches are already running in
+        this process (in which case it'll be fetched when it's asked for).
+        """
+        if page_number * RESULT_PAGE_SIZE >= self._result_count():
+            return
+        with self._page_lock:
+            if page_number in self._page_cache or page_number in self._prefetches:
+                return
+            if not _prefetch_slots.acquire(False):
+                return
+            done = self._prefetches[page_number] = threading.Event()
+        def prefetch():
+            try:
+                self._page_cache[page_number] = self._fetch_page(page_number)
+            except Exception:
+                pass # it'll be fetched again, with the error, when it's asked for
+            finally:
+                with self._page_lock:
+                    del self._prefetches[page_number]
+                _prefetch_slots.release()
+                done.set()
+        thread = threading.Thread(target=prefetch)
+        thread.daemon = True
+        thread.start()
+    
+    def _result_count(self):
+        """
+        The number of ranked results this cursor will return, respecting
+        skip and limit.
+        """
+        if self._result_total is None:
+            self._result_total = self._cached_result_cursor().count(True)
+        return self._result_total
     
     def rewind(self):
         if self._actual_result_cursor is not None:
@@ -261,28 +796,541 @@ class SearchCursor(object):
         self._skip = skip
         return self
     
-    def count(self):
-        # if we haven't done the query yet, don't do a full search - just minimum to get the count right
-        if self._actual_result_cursor is None \
-          or self._limit is not None or self.skip is not None:
-            #shoudl refactor this by moving search() inside this cursor, so we can cache this stuff
-            return self._get_search_idx_collection().find(_query_obj_for_terms(self.search_query_terms)).count()
+    def sort(self, key_or_list, direction=None):
+        """
+        Sort the results by stored fields, or by score and stored fields.
+        
+        Works like .sort() on a regular cursor, where the keys are `score`
+        or fields stored in the index (`filter_fields` or `stored_fields`,
+        see configure_text_index_fields). Alternatively, `key_or_list` can be
+        a dict of field: weight, to sort by a blend of `score` and numeric or
+        date fields, highest weighted sum first - eg. {'score': 1, 'date':
+        1.0 / 86400} gives each day of recency as much weight as a score of
+        1. Dates count as seconds since the epoch.
+        
+        The sort keys are read from the index while ranking, keeping only the
+        best skip + limit results, so only the results actually requested are
+        read from the collection.
+        """
+        if self._actual_result_cursor is not None:
+            raise InvalidSearchOperation("Cannot set search options after"
+             " executing SearchQuery")
+        if isinstance(key_or_list, dict):
+            fields = key_or_list.keys()
+            self._sort = ('blend', sorted(key_or_list.items()))
+        else:
+            if isinstance(key_or_list, basestring):
+                key_or_list = [(key_or_list, direction or pymongo.ASCENDING)]
+            fields = [field for field, field_direction in key_or_list]
+            self._sort = ('keys', list(key_or_list))
+        for field in fields:
+            if field != 'score':
+                self._stored_field_path(field) # raise an error now for unstored fields
+        return self
+    
+    def _stored_field_path(self, field):
+        """
+        Return the path to the value of `field` in the index entries.
+        """
+        index_config = self._get_search_idx_config() or {}
+        for key, conf_key in [(STORED_FIELDS_KEY, 'stored_fields'),
+          (FILTER_FIELDS_KEY, 'filter_fields')]:
+            if not index_config.get(conf_key + '_built'):
+                continue
+            for stored_field in index_config[conf_key]:
+                if field == stored_field or field.startswith(stored_field + '.'):
+                    return key + '.' + field
+        raise InvalidSearchOperation("Can't sort by field '%s' as it isn't"
+          " stored in the search index" % field)
+    
+    def count(self, approximate=False):
+        """
+        Return the total number of search results, ignoring skip and limit (as
+        with .count() on a regular cursor).
+        
+        This only touches the index collection: the `spec` restriction is
+        resolved to `_id`s without hydrating any documents, and if the search
+        has already been executed its candidate set is counted directly.
+        Counts are cached per index generation.
+        
+        With `approximate=True`, an ApproximateCount is returned instead,
+        estimated from term document frequencies and a sample of the rarest
+        term's index entries, without ever scanning the full candidate set.
+        """
+        key = self._query_cache_key('count')
+        result = cache.query_cache.get(key)
+        if result is None:
+            if approximate and (self._raw_result_coll is None
+              or self._restriction_strategy == SCORE_FIRST):
+                return self._approximate_count()
+            result = self._count()
+            cache.query_cache.set(key, result)
+        if approximate:
+            return ApproximateCount(result)
+        return result
+    
+    def _count(self):
+        if self._definitely_empty():
+            return 0
+        if self._raw_result_coll is not None and \
+          self._restriction_strategy != SCORE_FIRST:
+            # the candidate set has already been materialised by the search
+            return self._raw_result_coll.count()
+        postings_index = self._proximity_postings_index()
+        if postings_index is not None:
+            return len(self._positional_matches(postings_index))
+        id_list = self._restriction_ids()
+        single_term = False
+        if self._plan.is_conjunctive:
+            terms = self._plan.required_terms
+            doc_freqs = [cache.query_cache.get(self._index_cache_key('df', term))
+              for term in terms]
+            if 0 in doc_freqs:
+                # a term that matches nothing empties the whole intersection
+                return 0
+            # a one-term count is that term's df - unless a spec or id_list
+            # (even one pushed down into the index query) restricts it
+            single_term = self._spec is None and self._id_list is None \
+              and len(terms) == 1
+            if single_term and doc_freqs[0] is not None:
+                return doc_freqs[0]
+        idx_coll = self._get_search_idx_collection()
+        if id_list is not None and len(id_list) > idsets.ID_CHUNK_SIZE:
+            query_obj = self._index_query()
+            result = sum(idx_coll.find(_restrict_query(query_obj, chunk)).count()
+              for chunk in idsets.chunks(id_list))
         else:
-            return self._actual_result_cursor.count()
+            result = idx_coll.find(self._index_query(id_list)).count()
+        if single_term:
+            cache.query_cache.set(self._index_cache_key('df', terms[0]), result)
+        return result
+    
+    def facets(self, fields):
+        """
+        Return a dict of field: {value: count} giving, for each of `fields`,
+        the number of search results (ignoring skip and limit) with each of
+        its values. A result with a list of values counts towards each of
+        them.
+        
+        The values are counted in one pass over the matching index entries:
+        read straight from the index when all of `fields` are stored filter
+        fields (see configure_text_index_fields), otherwise from the matching
+        documents, fetched in batches with only `fields`. The total number
+        of results is counted along the way for count(), and facets are
+        cached the same way as counts.
+        """
+        fields = list(fields)
+        key = self._query_cache_key('facets', tuple(sorted(fields)))
+        facets = cache.query_cache.get(key)
+        if facets is not None:
+            return facets
+        facets = dict((field, {}) for field in fields)
+        if self._definitely_empty():
+            return facets
+        total = 0
+        if self._stores_filter_fields(fields):
+            for entry in self._matching_index_entries([FILTER_FIELDS_KEY]):
+                _add_facet_values(facets, entry.get(FILTER_FIELDS_KEY, {}))
+                total += 1
+        else:
+            for chunk in idsets.chunks(entry['_id'] for entry in
+              self._matching_index_entries(['_id'])):
+                total += len(chunk)
+                for doc in self.search_collection.find({'_id': {'$in': chunk}}, fields):
+                    _add_facet_values(facets, doc)
+        cache.query_cache.set(key, facets)
+        cache.query_cache.set(self._query_cache_key('count'), total)
+        return facets
+    
+    def _stores_filter_fields(self, fields):
+        """
+        True if the index entries store all of `fields` as filter fields.
+        """
+        index_config = self._get_search_idx_config() or {}
+        if not index_config.get('filter_fields_built'):
+            return False
+        stored = index_config['filter_fields']
+        return all([filter_field for filter_field in stored if field == filter_field
+          or field.startswith(filter_field + '.')] for field in fields)
+    
+    def _matching_index_entries(self, fields):
+        """
+        Iterate over the index entries matching the search (ignoring skip
+        and limit), fetching only `fields`.
+        """
+        idx_coll = self._get_search_idx_collection()
+        postings_index = self._proximity_postings_index()
+        if postings_index is not None:
+            return itertools.chain.from_iterable(
+              idx_coll.find({'_id': {'$in': chunk}}, fields)
+              for chunk in idsets.chunks(self._positional_matches(postings_index)))
+        id_list = self._restriction_ids()
+        if id_list is None:
+            return idx_coll.find(self._index_query(), fields)
+        query_obj = self._index_query()
+        return itertools.chain.from_iterable(
+          idx_coll.find(_restrict_query(query_obj, chunk), fields)
+          for chunk in idsets.chunks(id_list))
+    
+    def _proximity_postings_index(self):
+        """
+        The index's PostingsIndex if the query has phrases or NEAR/k clauses
+        and the postings have positions to check them with, otherwise None.
+        The index entries can't tell whether the words line up, so anything
+        counting results has to go through the postings then.
+        """
+        if not self._plan.has_proximity:
+            return None
+        postings_index = self._get_postings_index()
+        if postings_index is None or not postings_index.with_positions:
+            return None
+        return postings_index
+    
+    def _positional_matches(self, postings_index):
+        """
+        Return the `_id`s of all the results, evaluated with `postings_index`.
+        """
+        scoped_docnos = dict((term, postings_index.docnos_for_ids(ids))
+          for term, ids in self._scoped_ids().iteritems())
+        ranked = postings_index.evaluate(self._plan, None,
+          self._allowed_docnos(postings_index), scoped_docnos)
+        return postings_index.ids_for_docnos(docno for docno, score in ranked).values()
+    
+    def _approximate_count(self):
+        key = self._query_cache_key('approximate_count')
+        result = cache.query_cache.get(key)
+        if result is None:
+            result = self._estimate_count()
+            cache.query_cache.set(key, result)
+        return result
+    
+    def _estimate_count(self):
+        """
+        Estimate the number of results by sampling the index entries of the
+        rarest required search term (or, if no term is required, of the union
+        of the query's terms) and checking what fraction of them match the
+        query and pass the id_list/spec restriction.
+        """
+        plan = self._plan
+        if self._definitely_empty():
+            return ApproximateCount(0)
+        if self._proximity_postings_index() is not None:
+            # sampled entries can't be checked for phrases; count exactly
+            return ApproximateCount(self._count())
+        restricted = self._id_list is not None or self._spec is not None
+        if plan.required_terms:
+            driver = plan.required_terms[0]
+            population = self._document_frequency(driver)
+            driver_query = {'value._extracted_terms': driver}
+        elif plan.scoped_terms:
+            # a match might only have a scoped term, in another index
+            return ApproximateCount(self._count())
+        else:
+            # every match has at least one of the (positive) terms
+            driver_query = {'value._extracted_terms': {'$in': plan.terms}}
+            population = self._get_search_idx_collection().find(driver_query).count()
+        if population == 0 or (plan.is_conjunctive
+          and len(plan.required_terms) == 1 and not restricted):
+            return ApproximateCount(population)
+        sample = self._sample_index_entries(driver_query, population)
+        scoped_ids = self._scoped_ids()
+        hits = [entry['_id'] for entry in sample if plan.matches(
+          entry['value']['_extracted_terms'], entry['_id'], scoped_ids)]
+        if restricted:
+            hits = self._restrict_ids(hits)
+        sample_size = len(sample)
+        if sample_size >= population:
+            # we have actually looked at every candidate
+            return ApproximateCount(len(hits))
+        # Agresti-Coull interval, with a finite population correction
+        adjusted_p = (len(hits) + 2.0) / (sample_size + 4.0)
+        std_error = math.sqrt(adjusted_p * (1 - adjusted_p) / (sample_size + 4.0)) \
+          * math.sqrt(float(population - sample_size) / (population - 1))
+        estimate = population * float(len(hits)) / sample_size
+        return ApproximateCount(estimate, 1.96 * std_error * population)
+    
+    def _sample_index_entries(self, query_obj, population):
+        """
+        Fetch up to APPROXIMATE_COUNT_SAMPLE_SIZE of the `population` index
+        entries matching `query_obj`, taken in a few contiguous runs (in
+        `_id` order) from random `_id`s.
+        """
+        idx_coll = self._get_search_idx_collection()
+        fields = ['value._extracted_terms']
+        if population <= APPROXIMATE_COUNT_SAMPLE_SIZE:
+            return list(idx_coll.find(query_obj, fields))
+        block_size = APPROXIMATE_COUNT_SAMPLE_SIZE // APPROXIMATE_COUNT_SAMPLE_BLOCKS
+        ends = [_first(list(idx_coll.find(query_obj, ['_id']).sort(
+          '_id', direction).limit(1))) for direction in
+          (pymongo.ASCENDING, pymongo.DESCENDING)]
+        if None in ends:
+            return []
+        pivots = [_random_id_between(ends[0]['_id'], ends[1]['_id'])
+          for i in xrange(APPROXIMATE_COUNT_SAMPLE_BLOCKS)]
+        if None in pivots:
+            # ids we can't pick at random between; take one run from the start
+            pivots, block_size = [ends[0]['_id']], APPROXIMATE_COUNT_SAMPLE_SIZE
+        sample = {}
+        for pivot in pivots:
+            run_query = _and_queries(query_obj, {'_id': {'$gte': pivot}})
+            for entry in idx_coll.find(run_query, fields).sort('_id').limit(block_size):
+                sample[entry['_id']] = entry
+        return sample.values()
+    
+    def _restrict_ids(self, ids):
+        """
+        Return those of `ids` that pass this cursor's id_list or spec
+        restriction, without resolving the restriction in full.
+        """
+        if self._id_list is not None:
+            allowed = set(self._id_list)
+            return [id for id in ids if id in allowed]
+        index_filter = self._index_filter()
+        if index_filter is not None:
+            coll, spec = self._get_search_idx_collection(), index_filter
+        else:
+            coll, spec = self.search_collection, self._spec
+        query_obj = _and_queries(spec, {'_id': {'$in': ids}})
+        return [rec['_id'] for rec in coll.find(query_obj, ['_id'])]
+    
+    def _definitely_empty(self):
+        """
+        True if we know without searching that nothing can match: the query
+        had nothing searchable in it, or it requires a stem that the index's
+        Bloom filter says isn't in the index.
+        """
+        if self._plan.is_empty:
+            return True
+        term_filter = self._get_term_filter()
+        if term_filter is None:
+            return False
+        for term in self._plan.required_terms:
+            if term not in term_filter:
+                return True
+        return False
+    
+    def _get_term_filter(self):
+        """
+        The Bloom filter of the stems in the index being searched, or None if
+        the index doesn't have one yet.
+        """
+        key = self._index_cache_key('bloom')
+        term_filter = cache.index_data_cache.get(key)
+        if term_filter is None:
+            term_filter = bloom.load_term_filter(self._get_search_idx_collection())
+            if term_filter is None:
+                term_filter = False # so we don't look it up again
+            cache.index_data_cache.set(key, term_filter)
+        return term_filter or None
+    
+    def _document_frequency(self, term):
+        """
+        The number of index entries containing `term`, cached per index
+        generation.
+        """
+        key = self._index_cache_key('df', term)
+        doc_freq = cache.query_cache.get(key)
+        if doc_freq is None:
+            term_filter = self._get_term_filter()
+            if term_filter is not None and term not in term_filter:
+                return 0
+            doc_freq = self._get_search_idx_collection().find(
+              {'value._extracted_terms': term}).count()
+            cache.query_cache.set(key, doc_freq)
+        return doc_freq
+    
+    def _index_query(self, id_list=None):
+        """
+        The query selecting matching entries from the index collection.
+        """
+        scoped_ids = self._scoped_ids()
+        for term, ids in scoped_ids.iteritems():
+            if len(ids) > idsets.ID_CHUNK_SIZE:
+                # the ids would go in the query, and not fit
+                raise InvalidSearchOperation("'%s:%s' matches too many documents"
+                  " to search for without other words" % (term.field, term.stem))
+        query_obj = self._plan.mongo_query(scoped_ids)
+        index_filter = self._index_filter()
+        if index_filter is not None:
+            query_obj = _and_queries(query_obj, index_filter)
+        if id_list is not None:
+            query_obj = _restrict_query(query_obj, id_list)
+        return query_obj
+    
+    def _index_filter(self):
+        """
+        The spec translated into a query on the index entries, if the index
+        stores every field it refers to; otherwise None.
+        """
+        if self._spec is None:
+            return None
+        index_config = self._get_search_idx_config() or {}
+        if not index_config.get('filter_fields_built'):
+            return None
+        return _pushdown_spec(self._spec, index_config['filter_fields'])
+    
+    def _restriction_ids(self):
+        """
+        The `_id`s the index query has to be restricted to: the id_list, or
+        the resolved spec unless it can be pushed down into the index query.
+        """
+        if self._id_list is None and self._index_filter() is not None:
+            return None
+        return self.id_list()
+    
+    def _get_query_plan(self):
+        """
+        Compile the query string into a QueryPlan, cached per query string
+        and index generation.
+        """
+        key = self._index_cache_key('plan', self.search_query_string, self._fuzzy)
+        plan = cache.query_cache.get(key)
+        if plan is None:
+            correct = None
+            if self._fuzzy:
+                correct = self._correct_stem
+            plan = query.compile_query(self.search_query_string,
+              stem_and_tokenize, self._document_frequency, self._expand_prefix, correct)
+            cache.query_cache.set(key, plan)
+        return plan
+    
+    def _scoped_ids(self):
+        """
+        Return a dict mapping each of the plan's field-scoped terms to the set
+        of `_id`s of the documents containing it in that field - of those
+        containing all the plan's required terms, if it has any, as no other
+        document can match.
+        """
+        if self._resolved_scoped_ids is None:
+            self._resolved_scoped_ids = dict((term, self._field_term_ids(term))
+              for term in self._plan.scoped_terms)
+        return self._resolved_scoped_ids
+    
+    def _field_term_ids(self, term):
+        """
+        Return the set of `_id`s for `term` (see _scoped_ids). With required
+        terms, whichever of the two sides has fewer documents is read and
+        looked up in the other a chunk at a time. Only sets small enough to
+        go in one $in are cached.
+        """
+        required = self._plan.required_terms
+        key = self._index_cache_key('field_term', term.field, term.stem,
+          tuple(sorted(required)))
+        ids = cache.query_cache.get(key)
+        if ids is not None:
+            return ids
+        db = self.search_collection.database
+        field_coll = db[index_coll_name(self.search_collection,
+          self._index_for_field(term.field))]
+        field_query = {'value._extracted_terms': term.stem}
+        if not required:
+            ids = frozenset(rec['_id'] for rec in field_coll.find(field_query, ['_id']))
+        else:
+            sides = [(self._get_search_idx_collection(),
+              {'value._extracted_terms': {'$all': required}}), (field_coll, field_query)]
+            if field_coll.find(field_query).count() < self._document_frequency(required[0]):
+                sides.reverse()
+            (driver, driver_query), (other, other_query) = sides
+            ids = set()
+            for chunk in idsets.chunks(rec['_id'] for rec in driver.find(driver_query, ['_id'])):
+                ids.update(rec['_id'] for rec in
+                  other.find(_restrict_query(other_query, chunk), ['_id']))
+            ids = frozenset(ids)
+        if len(ids) <= idsets.ID_CHUNK_SIZE:
+            cache.query_cache.set(key, ids)
+        return ids
+    
+    def _index_for_field(self, field):
+        """
+        Return the name of the index to use for terms scoped to `field`:
+        either the index of that name, or one indexing only that field.
+        """
+        indexes = (self.search_collection.get_configuration() or {}).get('indexes', {})
+        if field in indexes:
+            return field
+        for index_name, index_conf in indexes.iteritems():
+            if index_conf.get('fields', {}).keys() == [field]:
+                return index_name
+        raise InvalidSearchOperation("No search index covers only the field "
+          "'%s'" % field)
+    
+    def _index_cache_key(self, kind, *extra):
+        """
+        A cache key for data about the index being searched, valid only for
+        the current generation of the index.
+        """
+        return _index_data_key(self.search_collection, self.search_index_name,
+          self._get_search_idx_config(), kind, *extra)
+    
+    def _query_cache_key(self, kind, *extra):
+        """
+        A cache key for data about this particular query (ignoring skip and
+        limit).
+        """
+        if self._id_list is not None:
+            restriction = ('id_list', tuple(self._id_list))
+        elif self._spec is not None:
+            restriction = ('spec', cache.normalise(self._spec))
+        else:
+            restriction = None
+        return self._index_cache_key(kind, repr(self._plan.root), restriction, *extra)
     
     def _perform_search(self):
-        self._raw_search()
+        """
+        Execute the search, unless an identical search is already running in
+        another thread, in which case wait for it and share its results.
+        """
+        key = self._query_cache_key('results', self._skip or 0, self._limit or 0,
+          cache.normalise(self._sort), self._hydrate, cache.normalise(self._idfs))
+        def execute():
+            self._execute_search()
+            return self
+        leader, shared = cache.search_flights.do(key, execute)
+        if shared:
+            self._actual_result_cursor = leader._actual_result_cursor.clone()
+            self._raw_result_coll = leader._raw_result_coll
+            self._restriction_strategy = leader._restriction_strategy
+            self._explanation = dict(leader._explanation, coalesced=True)
+    
+    def _execute_search(self):
+        if self._definitely_empty():
+            # nothing to do on the server
+            self._actual_result_cursor = self._ranked_result_cursor([])
+            return
+        if self._sort is not None:
+            self._perform_sorted_search()
+            return
+        postings_index = self._get_postings_index()
+        if postings_index is not None:
+            self._explanation['engine'] = 'postings'
+            self._perform_postings_search(postings_index)
+            return
+        self._explanation['engine'] = 'map_reduce'
+        strategy = self._choose_restriction_strategy()
+        self._raw_search(restrict=strategy != SCORE_FIRST)
+        if not self._hydrate:
+            self._actual_result_cursor = self._ranked_result_cursor(
+              self._ranked_raw_results(strategy))
+            return
         search_coll_name = self._raw_result_coll.name
         map_js = Code("function() { mft.get('search')._searchMap.call(this) }")
         reduce_js = Code("function(k, v) { return mft.get('search')._searchReduce(k, v) }")
         scope =  {'coll_name': self.search_collection.name}
         db = self.search_collection.database
         # sorting = [('value.score', pymongo.DESCENDING)]    #Seems to not make any difference?
-        if self._limit or self._skip: 
+        if strategy == SCORE_FIRST:
+            # raw results are {_id: ..., value: score}
+            raw_result_cursor = self._raw_result_coll.find().sort(
+              [('value', pymongo.DESCENDING)])
+            ranked = self._post_filter((rec['_id'], rec['value'])
+              for rec in raw_result_cursor)
+            id_query_obj = {'_id': {'$in': [id for id, score in ranked]}}
+        elif self._limit or self._skip: 
             # avoid instantiating extra objects by sorting on the raw resutls first
             # so if only need 20 actual objects, we can get them only
+            # raw results are {_id: ..., value: score}
             raw_result_cursor = self._raw_result_coll.find(fields=['_id']).sort(
-              [('value.score', pymongo.DESCENDING)])
+              [('value', pymongo.DESCENDING)])
             if self._limit:
                 raw_result_cursor.limit(self._limit)
             if self._skip:
@@ -297,53 +1345,723 @@ class SearchCursor(object):
         #should we be ensuring an index here? or just leave it?
         # res_coll.ensure_index([('value.score', pymongo.ASCENDING)])
     
-    def _raw_search(self):
+    def _perform_sorted_search(self):
+        """
+        Rank every result by score with whichever engine the index supports,
+        then select the skip/limit window in the order set by sort().
+        """
+        postings_index = self._get_postings_index()
+        if postings_index is not None:
+            self._explanation['engine'] = 'postings'
+            scoped_docnos = dict((term, postings_index.docnos_for_ids(ids))
+              for term, ids in self._scoped_ids().iteritems())
+            ranked = postings_index.evaluate(self._plan, None,
+              self._allowed_docnos(postings_index), scoped_docnos)
+            ids = postings_index.ids_for_docnos(docno for docno, score in ranked)
+            ranked = ((ids[docno], score) for docno, score in ranked if docno in ids)
+        else:
+            self._explanation['engine'] = 'map_reduce'
+            self._raw_search()
+            ranked = ((rec['_id'], rec['value']) for rec in self._raw_result_coll.find())
+        self._actual_result_cursor = self._ranked_result_cursor(self._sorted_window(ranked))
+    
+    def _sorted_window(self, ranked):
+        """
+        Return the skip/limit window of the (_id, score) pairs in `ranked` in
+        the order set by sort(), reading the sort keys from the index entries
+        in batches and keeping only the best skip + limit as we go.
+        """
+        kind, sort = self._sort
+        if kind == 'blend':
+            fields = [field for field, weight in sort]
+        else:
+            fields = [field for field, direction in sort]
+        paths = dict((field, self._stored_field_path(field)) for field in fields
+          if field != 'score')
+        idx_coll = self._get_search_idx_collection()
+        def keyed():
+            for chunk in idsets.chunks(ranked):
+                scores = dict(chunk)
+                for entry in idx_coll.find({'_id': {'$in': scores.keys()}}, paths.values()):
+                    score = scores[entry['_id']]
+                    values = dict((field, _first(util.get_field(entry, path)))
+                      for field, path in paths.iteritems())
+                    values['score'] = score
+                    yield _sort_key(kind, sort, values), entry['_id'], score
+        skip = self._skip or 0
+        if self._limit:
+            best = heapq.nsmallest(skip + self._limit, keyed(), key=itemgetter(0))
+        else:
+            best = sorted(keyed(), key=itemgetter(0))
+        return [(id, score) for key, id, score in best[skip:]]
+    
+    def _ranked_raw_results(self, strategy):
+        """
+        Return the skip/limit window of the raw search results as (_id,
+        score) pairs, best first.
+        """
+        # raw results are {_id: ..., value: score}
+        raw_result_cursor = self._raw_result_coll.find().sort(
+          [('value', pymongo.DESCENDING)])
+        ranked = ((rec['_id'], rec['value']) for rec in raw_result_cursor)
+        if strategy == SCORE_FIRST:
+            return self._post_filter(ranked)
+        if self._skip:
+            raw_result_cursor.skip(self._skip)
+        if self._limit:
+            raw_result_cursor.limit(self._limit)
+        return list(ranked)
+    
+    def _ranked_result_cursor(self, ranked):
+        if self._hydrate:
+            return RankedResultCursor(self.search_collection, ranked)
+        return StoredFieldsResultCursor(self._get_search_idx_collection(), ranked)
+    
+    def _perform_postings_search(self, postings_index):
+        """
+        Rank the results using the index's postings rather than map_reduce,
+        keeping only the top skip + limit, and hydrate them lazily.
+        """
+        self._actual_result_cursor = self._ranked_result_cursor(
+          self._postings_ranking(postings_index))
+    
+    def _postings_ranking(self, postings_index):
+        """
+        Return the skip/limit window of the results, as (_id, score) pairs,
+        ranked using the index's postings.
+        """
+        skip = self._skip or 0
+        k = None
+        if self._limit:
+            k = skip + self._limit
+        scoped_docnos = dict((term, postings_index.docnos_for_ids(ids))
+          for term, ids in self._scoped_ids().iteritems())
+        if self._choose_restriction_strategy() == SCORE_FIRST:
+            ranked = self._post_filter_postings(postings_index, k, scoped_docnos)
+        else:
+            allowed = self._allowed_docnos(postings_index)
+            ranked = postings_index.evaluate(self._plan, k, allowed, scoped_docnos,
+              self._idfs)[skip:]
+            ids = postings_index.ids_for_docnos(docno for docno, score in ranked)
+            ranked = [(ids[docno], score) for docno, score in ranked if docno in ids]
+        return ranked
+    
+    def _allowed_docnos(self, postings_index):
+        """
+        The docnos the search is restricted to, or None if it isn't.
+        
+        A spec's docnos are kept in the query cache as a DocnoBitmap, keyed by
+        the normalised spec and the index generation, so a recurring filter
+        is only resolved against the collection once and is then intersected
+        with the candidates in memory.
+        """
+        if self._id_list is not None:
+            return postings_index.docnos_for_ids(self._id_list)
+        if self._spec is None:
+            return None
+        docnos = self._cached_filter_bitmap()
+        if docnos is None:
+            self._explanation['filter_cache'] = 'miss'
+            index_filter = self._index_filter()
+            if index_filter is not None:
+                docnos = postings_index.docnos_for_query(index_filter)
+            else:
+                docnos = postings_index.docnos_for_ids(self.id_list())
+            docnos = bitmap.DocnoBitmap(docnos)
+            cache.query_cache.set(self._filter_bitmap_key(), docnos)
+        else:
+            self._explanation['filter_cache'] = 'hit'
+        return docnos
+    
+    def _cached_filter_bitmap(self):
+        if self._spec is None:
+            return None
+        return cache.query_cache.get(self._filter_bitmap_key())
+    
+    def _filter_bitmap_key(self):
+        return self._index_cache_key('filter_bitmap', cache.normalise(self._spec))
+    
+    def _post_filter_postings(self, postings_index, k, scoped_docnos):
+        """
+        Score first, then filter by the spec: rank the unrestricted top k',
+        post-filter them, and retry with a larger k' until enough results pass
+        or there are no more to rank.
+        """
+        wanted = k
+        if k is not None:
+            k = max(k * 2, POST_FILTER_BATCH_SIZE)
+        while True:
+            ranked = postings_index.evaluate(self._plan, k, None, scoped_docnos,
+              self._idfs)
+            ids = postings_index.ids_for_docnos(docno for docno, score in ranked)
+            passed = self._post_filter((ids[docno], score) for docno, score
+              in ranked if docno in ids)
+            if k is None or len(ranked) < k or len(passed) >= wanted - (self._skip or 0):
+                return passed
+            k *= 4
+    
+    def _post_filter(self, ranked):
+        """
+        Return the skip/limit window of the (_id, score) pairs in `ranked`
+        that match the spec, checking them in batches and stopping as soon as
+        the window is full.
+        """
+        skip = self._skip or 0
+        batch_size = POST_FILTER_BATCH_SIZE
+        if self._limit:
+            batch_size = max(batch_size, 2 * (skip + self._limit))
+        passed = []
+        batch = []
+        for id, score in ranked:
+            batch.append((id, score))
+            if len(batch) < batch_size:
+                continue
+            passed.extend(self._filter_batch(batch))
+            batch = []
+            if self._limit and len(passed) >= skip + self._limit:
+                break
+        passed.extend(self._filter_batch(batch))
+        if self._limit:
+            return passed[skip:skip + self._limit]
+        return passed[skip:]
+    
+    def _filter_batch(self, batch):
+        if not batch:
+            return []
+        allowed = set(self._restrict_ids([id for id, score in batch]))
+        return [(id, score) for id, score in batch if id in allowed]
+    
+    def _choose_restriction_strategy(self):
+        """
+        Decide how to apply a `spec`: resolve it to an id list and only score
+        matching documents (filter first), or score without it and check the
+        best results against it in batches until skip + limit of them pass
+        (score first).
+        
+        Filter first costs about as much as the spec has matches, plus
+        scoring the candidates that pass; score first costs scoring every
+        candidate, plus checking about (skip + limit) / selectivity of them.
+        When the spec's filter bitmap is already cached (see
+        _allowed_docnos), resolving it costs nothing and its exact size is
+        known, and a spec pushed down into the index query (see
+        _index_filter) is always applied filter first. The decision and its
+        inputs are recorded for explain().
+        """
+        if self._restriction_strategy is not None or self._spec is None:
+            return self._restriction_strategy
+        if self._sort is not None:
+            # score first relies on the results coming out best first
+            self._restriction_strategy = FILTER_FIRST
+            self._explanation['restriction'] = {
+              'strategy': self._restriction_strategy,
+              'pushdown': self._index_filter() is not None,
+              'sorted': True,
+            }
+            return self._restriction_strategy
+        if self._index_filter() is not None:
+            # the spec is part of the index query, so it costs nothing extra
+            self._restriction_strategy = FILTER_FIRST
+            self._explanation['restriction'] = {
+              'strategy': self._restriction_strategy,
+              'pushdown': True,
+            }
+            return self._restriction_strategy
+        index_size = self._index_size()
+        cached_bitmap = None
+        if self._get_postings_index() is not None:
+            cached_bitmap = self._cached_filter_bitmap()
+        if cached_bitmap is not None:
+            spec_count = len(cached_bitmap)
+        else:
+            spec_count = self._spec_count()
+        selectivity = float(spec_count) / max(index_size, 1)
+        if self._plan.required_terms:
+            text_candidates = self._document_frequency(self._plan.required_terms[0])
+        else:
+            text_candidates = index_size
+        window = text_candidates
+        if self._limit:
+            window = (self._skip or 0) + self._limit
+        filter_first_cost = text_candidates * selectivity
+        if cached_bitmap is None:
+            # resolving the spec means reading all its matches
+            filter_first_cost += spec_count
+        score_first_cost = text_candidates + min(text_candidates,
+          window / max(selectivity, 1.0 / max(index_size, 1)))
+        if score_first_cost < filter_first_cost:
+            self._restriction_strategy = SCORE_FIRST
+        else:
+            self._restriction_strategy = FILTER_FIRST
+        self._explanation['restriction'] = {
+          'strategy': self._restriction_strategy,
+          'pushdown': False,
+          'spec_count': spec_count,
+          'spec_count_is_lower_bound': cached_bitmap is None and
+            spec_count >= SPEC_COUNT_LIMIT,
+          'filter_cached': cached_bitmap is not None,
+          'index_size': index_size,
+          'text_candidates': text_candidates,
+          'filter_first_cost': filter_first_cost,
+          'score_first_cost': score_first_cost,
+        }
+        return self._restriction_strategy
+    
+    def _spec_count(self):
+        """
+        The number of documents matching the spec, counting no further than
+        SPEC_COUNT_LIMIT. Cached per index generation.
+        """
+        key = self._index_cache_key('spec_count', cache.normalise(self._spec))
+        spec_count = cache.query_cache.get(key)
+        if spec_count is None:
+            spec_count = self.search_collection.find(self._spec).limit(
+              SPEC_COUNT_LIMIT).count(True)
+            cache.query_cache.set(key, spec_count)
+        return spec_count
+    
+    def _index_size(self):
+        key = self._index_cache_key('index_size')
+        index_size = cache.query_cache.get(key)
+        if index_size is None:
+            index_size = self._get_search_idx_collection().count()
+            cache.query_cache.set(key, index_size)
+        return index_size
+    
+    def explain(self):
+        """
+        Return a dict describing how this search is (or would be) executed:
+        the compiled query plan, the engine used and, for searches with a
+        `spec`, which restriction strategy was chosen and why.
+        """
+        explanation = {
+          'index': self.search_index_name,
+          'plan': repr(self._plan.root),
+          'required_terms': self._plan.required_terms,
+          'executed': self._actual_result_cursor is not None,
+        }
+        if self._definitely_empty():
+            explanation['engine'] = 'none'
+        elif self._get_postings_index() is not None:
+            explanation['engine'] = 'postings'
+        else:
+            explanation['engine'] = 'map_reduce'
+        if self._spec is not None and not self._definitely_empty():
+            self._choose_restriction_strategy()
+        if self._sort is not None:
+            explanation['sort'] = self._sort
+        explanation.update(self._explanation)
+        return explanation
+    
+    def _raw_search(self, restrict=True):
         map_js = Code("function() { mft.get('search')._rawSearchMap.call(this) }")
         reduce_js = Code("function(k, v) { return mft.get('search')._rawSearchReduce(k, v) }")
         scope =  {'search_terms': self.search_query_terms, 'coll_name': self.search_collection.name, 
           'index_name': self.search_index_name}
-        #   lazily assuming "$all" (i.e. AND search) 
-        query_obj = {'value._extracted_terms': {'$all': self.search_query_terms}}
-        id_list = self.id_list()
-        if id_list is not None:
-            query_obj['_id'] = {'$in': id_list}
-        self._raw_result_coll = self._get_search_idx_collection().map_reduce(
-          map_js, reduce_js, scope=scope, query=query_obj)
-        self._raw_result_coll.ensure_index([('value.score', pymongo.ASCENDING)]) 
+        id_list = self._restriction_ids() if restrict else None
+        idx_coll = self._get_search_idx_collection()
+        if id_list is not None and len(id_list) > idsets.ID_CHUNK_SIZE:
+            self._raw_result_coll = _chunked_map_reduce(idx_coll, map_js,
+              reduce_js, self._index_query(), id_list, scope=scope)
+        else:
+            self._raw_result_coll = idx_coll.map_reduce(map_js, reduce_js,
+              scope=scope, query=self._index_query(id_list))
+        self._raw_result_coll.ensure_index([('value', pymongo.ASCENDING)]) 
         # can't demand backgrounding in python seemingly?
     
     def id_list(self):
+        """
+        The `_id`s the search is restricted to, or None if it isn't. A `spec`
+        is resolved once, into an idsets.CompactIds.
+        """
         if self._id_list is not None:
             return self._id_list
         elif self._spec is not None:
-            return [rec['_id'] for rec in self.search_collection.find(self._spec, ['_id'])]
+            if self._resolved_id_list is None:
+                self._resolved_id_list = idsets.CompactIds(rec['_id'] for rec in
+                  self.search_collection.find(self._spec, ['_id']))
+            return self._resolved_id_list
         else:
             return None
     
     def _get_search_idx_collection(self):
-        db = self.search_collection.database
-        name_for_index_coll = index_coll_name(self.search_collection, self.search_index_name)
-        if name_for_index_coll not in db.collection_names():
-            if self._get_search_idx_config() is None:
-                raise SearchIndexNotConfiguredException("Search index '%s' does not exist"
-                    " as index name '%s' has not been configured" % (
-                    name_for_index_coll, self.search_index_name))
-            # TODO: this should distinguish between the unindexed case and the missing config item case
-            # would be a simple matter of checking the DB config
-            raise SearchIndexNotInitializedException("Search index '%s' does not exist "
-                " because the database hasn't been indexed for requested index name '%s'" % (
-                name_for_index_coll, self.search_index_name))
-        return db[name_for_index_coll]
+        if self._index_collection is None:
+            self._index_collection = _get_index_collection(self.search_collection,
+              self.search_index_name, self._get_search_idx_config())
+        return self._index_collection
         
     def _get_search_idx_config(self):
-        all_index_config = self.search_collection.get_configuration()
-        if not all_index_config:
+        if self._index_config is None:
+            all_index_config = self.search_collection.get_configuration()
+            if not all_index_config:
+                return None
+            try:
+                self._index_config = all_index_config['indexes'][self.search_index_name]
+            except KeyError:
+                return None
+        return self._index_config
+    
+    def _get_postings_index(self):
+        """
+        Return a PostingsIndex for the index being searched, or None if it
+        doesn't have postings.
+        """
+        index_config = self._get_search_idx_config() or {}
+        if not index_config.get('postings_built'):
             return None
-        try:
-            return all_index_config['indexes'][self.search_index_name]
-        except KeyError:
+        return postings.PostingsIndex(self.search_collection,
+          self.search_index_name, self._get_search_idx_collection(),
+          bool(index_config.get('positions_built')))
+    
+    def _expand_prefix(self, prefix):
+        """
+        Return the stems of the commonest completions of `prefix` in the
+        index's term dictionary, or None if it doesn't have one.
+        """
+        index_config = self._get_search_idx_config() or {}
+        if not index_config.get('dictionary_built'):
             return None
+        term_dictionary = dictionary.TermDictionary(self.search_collection,
+          self.search_index_name, self._get_index_generation())
+        return [completion['stem'] for completion in
+          term_dictionary.complete(prefix, PREFIX_EXPANSION_LIMIT)]
+    
+    def _correct_stem(self, stem):
+        """
+        If `stem` isn't in the index, return the known stems closest to it
+        (within the fuzzy edit distance), most common first; otherwise None.
+        """
+        if self._document_frequency(stem):
+            return None
+        deletion_index = self._get_deletion_index()
+        if deletion_index is None:
+            return None
+        found = deletion_index.lookup(stem, self._fuzzy)
+        return [correction for correction, distance in found
+          if distance == found[0][1]][:FUZZY_EXPANSION_LIMIT]
+    
+    def _get_deletion_index(self):
+        """
+        The fuzzy.DeletionIndex of the index's term dictionary, or None if it
+        doesn't have one.
+        """
+        index_config = self._get_search_idx_config() or {}
+        if not index_config.get('dictionary_built'):
+            return None
+        key = self._index_cache_key('deletions')
+        deletion_index = cache.index_data_cache.get(key)
+        if deletion_index is None:
+            deletion_index = fuzzy.load_deletion_index(self.search_collection,
+              self.search_index_name)
+            cache.index_data_cache.set(key, deletion_index)
+        return deletion_index
+    
+    def _get_index_generation(self):
+        index_config = self._get_search_idx_config() or {}
+        return index_config.get('generation', 0)
         
+def _get_index_collection(search_collection, index_name, index_config):
+    """
+    Return the index collection of the index `index_name` of
+    `search_collection`, whose configuration is `index_config`, raising an
+    exception if it hasn't been built.
+    """
+    db = search_collection.database
+    name_for_index_coll = index_coll_name(search_collection, index_name)
+    if name_for_index_coll not in db.collection_names():
+        if index_config is None:
+            raise SearchIndexNotConfiguredException("Search index '%s' does not exist"
+                " as index name '%s' has not been configured" % (
+                name_for_index_coll, index_name))
+        # TODO: this should distinguish between the unindexed case and the missing config item case
+        # would be a simple matter of checking the DB config
+        raise SearchIndexNotInitializedException("Search index '%s' does not exist "
+            " because the database hasn't been indexed for requested index name '%s'" % (
+            name_for_index_coll, index_name))
+    return db[name_for_index_coll]
+
+def _index_data_key(search_collection, index_name, index_config, kind, *extra):
+    """
+    A cache key for data about the index `index_name` of `search_collection`,
+    valid only for the generation of the index in `index_config`.
+    """
+    return (kind, search_collection.database.name, search_collection.name,
+      index_name, (index_config or {}).get('generation', 0)) + extra
+
+def _prime_document_frequencies(search_collection, index_name, index_config,
+  terms, term_stats):
+    """
+    Cache the document frequencies of `terms` in the index `index_name` of
+    `search_collection` from its postings `term_stats`, in which terms not in
+    the index are missing.
+    """
+    for term in terms:
+        doc_freq = 0
+        if term in term_stats:
+            doc_freq = term_stats[term]['df']
+        cache.query_cache.set(_index_data_key(search_collection, index_name,
+          index_config, 'df', term), doc_freq)
+
+def _max_edit_distance(fuzzy_option):
+    if fuzzy_option is True:
+        return fuzzy.MAX_DISTANCE
+    return fuzzy_option or 0
+
+def _random_id_between(low, high):
+    """
+    Return a random `_id` between `low` and `high`, or None if they aren't
+    both numbers or both ObjectIds.
+    """
+    if isinstance(low, ObjectId) and isinstance(high, ObjectId):
+        low, high = [calendar.timegm(id.generation_time.utctimetuple())
+          for id in (low, high)]
+        return ObjectId.from_datetime(datetime.datetime.utcfromtimestamp(
+          random.randint(low, high)))
+    if isinstance(low, (int, long)) and isinstance(high, (int, long)):
+        return random.randint(low, high)
+    if isinstance(low, (int, long, float)) and isinstance(high, (int, long, float)):
+        return random.uniform(low, high)
+    return None
+
+def _first(values):
+    if values:
+        return values[0]
+    return None
+
+def _sort_key(kind, sort, values):
+    """
+    Return a key ordering the results with the field `values` as specified
+    by the (kind, sort) pair that SearchCursor.sort() sets up.
+    """
+    if kind == 'blend':
+        return -sum(weight * _numeric(values[field]) for field, weight in sort)
+    return tuple(values[field] if direction == pymongo.ASCENDING
+      else _Descending(values[field]) for field, direction in sort)
+
+def _numeric(value):
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple())
+    if isinstance(value, (int, long, float)):
+        return value
+    return 0
+
+class _Descending(object):
+    """
+    Wraps a sort key to reverse its order.
+    """
+    def __init__(self, value):
+        self.value = value
+    
+    def __lt__(self, other):
+        return other.value < self.value
+    
+    def __eq__(self, other):
+        return self.value == other.value
+
+def _add_facet_values(facets, doc):
+    for field, counts in facets.iteritems():
+        for value in util.get_field(doc, field) or []:
+            value = cache.normalise(value)
+            counts[value] = counts.get(value, 0) + 1
+
+class MultiIndexSearchCursor(SearchCursor):
+    """
+    A cursor over the results of searching several indexes at once, as
+    returned by SearchableCollection.search() for a query dict with more
+    than one key.
+    
+    A document matches if it matches the query for any of the indexes, and
+    its score is the sum of its scores in each, times that index's boost.
+    Every index is scored from its postings, so they must all have been
+    configured with `postings=True`; there is no map_reduce per index.
+    
+    With a limit, only the top skip + limit of each index are ranked and
+    summed, so a document just outside every index's top results can be
+    missed even though its summed score would have placed it. count() ranks
+    every index in full, the first time it's asked for.
+    """
+    def __init__(self, search_collection, search_query, id_list=None, spec=None,
+      limit=0, skip=0, boosts=None, prefetch=False, fuzzy=False):
+        boosts = boosts or {}
+        for index_name in boosts:
+            if index_name not in search_query:
+                raise InvalidSearchOperation("Boost given for index '%s', which"
+                  " isn't being searched" % index_name)
+        self._init_cursor_state(search_collection, id_list, spec, limit, skip,
+          True, prefetch, fuzzy)
+        self._index_cursors = [SearchCursor(search_collection,
+          {index_name: query_string}, id_list=id_list, spec=spec, fuzzy=fuzzy)
+          for index_name, query_string in sorted(search_query.iteritems())]
+        for cursor in self._index_cursors:
+            if cursor._get_postings_index() is None:
+                raise InvalidSearchOperation("Searching several indexes at once"
+                  " needs postings, but index '%s' was not configured with"
+                  " postings=True" % cursor.search_index_name)
+        self._boosts = dict((index_name, float(boosts.get(index_name, 1)))
+          for index_name in search_query)
+        self._total = None
+    
+    def _perform_search(self):
+        skip = self._skip or 0
+        k = None
+        if self._limit:
+            k = skip + self._limit
+        totals = self._summed_scores(k)
+        if k is None:
+            self._total = len(totals)
+            ranked = sorted(totals.iteritems(), key=itemgetter(1), reverse=True)
+        else:
+            ranked = heapq.nlargest(k, totals.iteritems(), key=itemgetter(1))
+        self._actual_result_cursor = RankedResultCursor(self.search_collection,
+          ranked[skip:])
+    
+    def _summed_scores(self, k):
+        """
+        Return a dict of `_id`: boosted score summed over the indexes, from
+        the top `k` results of each (or all of them, with `k` of None).
+        """
+        totals = {}
+        for cursor in self._index_cursors:
+            boost = self._boosts[cursor.search_index_name]
+            if cursor._definitely_empty():
+                continue
+            cursor._skip, cursor._limit = 0, k
+            for id, score in cursor._postings_ranking(cursor._get_postings_index()):
+                totals[id] = totals.get(id, 0.0) + boost * score
+        return totals
+    
+    def count(self, approximate=False):
+        """
+        Return the total number of search results, ignoring skip and limit.
+        """
+        if self._total is None:
+            self._total = len(self._summed_scores(None))
+        if approximate:
+            return ApproximateCount(self._total)
+        return self._total
+    
+    def explain(self):
+        return {
+          'indexes': [cursor.explain() for cursor in self._index_cursors],
+          'boosts': self._boosts,
+          'engine': 'postings',
+          'executed': self._actual_result_cursor is not None,
+        }
+    
+    def facets(self, fields):
+        raise InvalidSearchOperation("Facets aren't supported when searching"
+          " several indexes")
+    
+    def sort(self, key_or_list, direction=None):
+        raise InvalidSearchOperation("Sorting isn't supported when searching"
+          " several indexes")
+
+class RankedResultCursor(object):
+    """
+    Cursor-like access to a list of (_id, score) pairs that has already been
+    ranked, hydrating the documents from `collection` a page at a time.
+    
+    Records look like those of the map_reduce result collections - {'_id':
+    ..., 'value': document} with the score added to the document - so
+    SearchCursor can treat the two interchangeably.
+    """
+    def __init__(self, collection, ranked):
+        self._collection = collection
+        self._ranked = ranked
+        self._skip = 0
+        self._limit = 0
+        self._position = 0
+        self._buffer = []
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        if not self._buffer:
+            end = len(self._ranked)
+            if self._limit:
+                end = min(end, self._skip + self._limit)
+            start = self._skip + self._position
+            if start >= end:
+                raise StopIteration
+            page = self._ranked[start:min(start + RESULT_PAGE_SIZE, end)]
+            self._position += len(page)
+            self._buffer = self._hydrate(page)
+            self._buffer.reverse()
+            if not self._buffer:
+                return self.next() # everything on this page has been deleted
+        return self._buffer.pop()
+    
+    def _hydrate(self, ranked):
+        docs = dict((doc['_id'], doc) for doc in self._collection.find(
+          {'_id': {'$in': [id for id, score in ranked]}}))
+        records = []
+        for id, score in ranked:
+            if id in docs:
+                docs[id]['score'] = score
+                records.append({'_id': id, 'value': docs[id]})
+        return records
+    
+    def skip(self, skip):
+        self._skip = skip
+        return self
+    
+    def limit(self, limit):
+        self._limit = limit
+        return self
+    
+    def clone(self):
+        return self.__class__(self._collection, self._ranked)
+    
+    def rewind(self):
+        self._position = 0
+        self._buffer = []
+        return self
+    
+    def count(self, with_limit_and_skip=False):
+        if not with_limit_and_skip:
+            return len(self._ranked)
+        count = max(len(self._ranked) - self._skip, 0)
+        if self._limit:
+            count = min(count, self._limit)
+        return count
+
+class StoredFieldsResultCursor(RankedResultCursor):
+    """
+    A RankedResultCursor that builds its records from the stored fields in
+    the index collection `collection`, rather than the documents themselves.
+    """
+    def _hydrate(self, ranked):
+        entries = dict((entry['_id'], entry) for entry in self._collection.find(
+          {'_id': {'$in': [id for id, score in ranked]}}, [STORED_FIELDS_KEY]))
+        records = []
+        for id, score in ranked:
+            if id in entries:
+                doc = dict(entries[id].get(STORED_FIELDS_KEY, {}))
+                doc['_id'] = id
+                doc['score'] = score
+                records.append({'_id': id, 'value': doc})
+        return records
+
+class ApproximateCount(int):
+    """
+    An estimated number of search results, as returned by
+    SearchCursor.count(approximate=True).
+    
+    Behaves as an int. `error` is the half-width of a roughly 95% confidence
+    interval around the estimate, and `exact` is True when no estimation was
+    needed.
+    """
+    def __new__(cls, value, error=0):
+        instance = super(ApproximateCount, cls).__new__(cls, int(round(value)))
+        instance.error = int(math.ceil(error))
+        instance.exact = not error
+        return instance
+    
+    def __repr__(self):
+        if self.exact:
+            return 'ApproximateCount(%d)' % self
+        return 'ApproximateCount(%d +/- %d)' % (self, self.error)
+
 class InvalidSearchOperation(pymongo.errors.InvalidOperation, Exception):  
     # (it seems InvalidOperation doesn't subclass Exception)
     pass
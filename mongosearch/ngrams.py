@@ -0,0 +1,121 @@
+"""
+Character trigram postings, for substring searches.
+
+Stems are no help in finding "X-200" in "MX-2001b" or "ongre" in "mongrels",
+and a regex over the source collection has to look at every document. An
+index configured with `trigrams=True` additionally gets, from
+build_trigram_postings(), a collection `search_.trigrams.<collection>.<index>`
+of {g: trigram, ids: [...]} records listing the `_id`s of the documents whose
+indexed fields contain each (lower-cased) three character sequence.
+
+Any document containing a substring contains all of its trigrams, so
+TrigramIndex.candidates() intersects their `_id` lists, rarest first, and
+only those candidates need checking for the substring itself (see
+SearchableCollection.substring_search).
+"""
+import pymongo
+
+import postings
+import util
+
+TRIGRAMS_NAMESPACE = 'search_.trigrams'
+TRIGRAM_FLUSH_SIZE = 100000 # postings held in memory before they are written out
+
+def trigrams_coll_name(collection, index_name):
+    return TRIGRAMS_NAMESPACE + '.' + collection.name + '.' + index_name
+
+def trigrams(text):
+    """
+    Return the set of (lower-cased) trigrams in `text`.
+    """
+    text = text.lower()
+    return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+def build_trigram_postings(collection, index_name, fields, index_collection):
+    """
+    (Re)build the trigrams collection for the index `index_name` of
+    `collection`, from the documents in its index collection, swapping it in
+    when done.
+    """
+    builder = TrigramBuilder(collection, index_name, fields)
+    for docno, doc in postings.iter_indexed_docs(collection, index_collection, fields):
+        builder.add(docno, doc)
+    builder.finish()
+
+class TrigramBuilder(object):
+    """
+    Builds the trigrams collection of an index from its documents, given to
+    add() one at a time; finish() swaps it in.
+    """
+    def __init__(self, collection, index_name, fields):
+        self.collection = collection
+        self.fields = fields
+        self._name = trigrams_coll_name(collection, index_name)
+        self._new_trigrams = collection.database[self._name + '.building']
+        self._new_trigrams.drop()
+        self._pending = {}
+        self._pending_count = 0
+
+    def add(self, docno, doc):
+        doc_trigrams = set()
+        for fieldname in self.fields:
+            for value in util.get_field(doc, fieldname) or []:
+                if isinstance(value, basestring):
+                    doc_trigrams.update(trigrams(value))
+        for trigram in doc_trigrams:
+            self._pending.setdefault(trigram, []).append(doc['_id'])
+        self._pending_count += len(doc_trigrams)
+        if self._pending_count >= TRIGRAM_FLUSH_SIZE:
+            _write_trigrams(self._new_trigrams, self._pending)
+            self._pending = {}
+            self._pending_count = 0
+
+    def finish(self):
+        _write_trigrams(self._new_trigrams, self._pending)
+        self._pending = {}
+        self._new_trigrams.ensure_index([('g', pymongo.ASCENDING)])
+        db = self.collection.database
+        db.drop_collection(self._name)
+        if self._new_trigrams.name in db.collection_names():
+            self._new_trigrams.rename(self._name)
+
+def _write_trigrams(trigrams_collection, pending):
+    batch = []
+    for trigram, ids in pending.iteritems():
+        batch.append({'g': trigram, 'ids': ids})
+        if len(batch) >= postings.BUILD_BATCH_SIZE:
+            trigrams_collection.insert(batch)
+            batch = []
+    if batch:
+        trigrams_collection.insert(batch)
+
+class TrigramIndex(object):
+    """
+    Search-time access to the trigrams collection of one index.
+    """
+    def __init__(self, collection, index_name):
+        self.trigrams = collection.database[trigrams_coll_name(collection, index_name)]
+
+    def candidates(self, substring):
+        """
+        Return the set of `_id`s of the documents containing all the trigrams
+        of `substring`, which must be at least three characters long.
+        """
+        substring_trigrams = trigrams(substring)
+        if not substring_trigrams:
+            raise ValueError("Substrings need at least three characters")
+        # the trigrams with fewest records are (roughly) the rarest
+        ordered = sorted(substring_trigrams,
+          key=lambda trigram: self.trigrams.find({'g': trigram}).count())
+        candidates = None
+        for trigram in ordered:
+            ids = set()
+            for rec in self.trigrams.find({'g': trigram}, ['ids']):
+                if candidates is None:
+                    ids.update(rec['ids'])
+                else:
+                    ids.update(id for id in rec['ids'] if id in candidates)
+            candidates = ids
+            if not candidates:
+                break
+        return candidates
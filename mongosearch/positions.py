@@ -0,0 +1,99 @@
+"""
+Token positions, for phrase and NEAR/k searches.
+
+An index configured with `positions=True` records, in each of its postings
+(see postings.py), where in the document the stem occurs, as `p`: the
+ascending positions, delta-encoded as unsigned varints in a BSON binary.
+Positions count tokens across the document's indexed fields, with a gap of
+POSITION_GAP between each field value so that phrases don't run from one
+into the next.
+
+Phrases and NEAR/k clauses are evaluated by first intersecting the postings
+of their stems, as an AND would be, and then merging the position lists of
+just those candidates.
+"""
+from pymongo.binary import Binary
+
+import util
+
+POSITION_GAP = 100 # between field values; NEAR distances are capped below this
+
+def extract_term_positions(doc, fields):
+    """
+    Return a dict of stem: ascending list of positions for `doc`, where
+    `fields` is an index's dict of fieldname: weighting.
+    """
+    from mongo_search import stem_and_tokenize
+    positions = {}
+    offset = 0
+    for fieldname in sorted(fields):
+        for value in util.get_field(doc, fieldname) or []:
+            if not isinstance(value, basestring):
+                continue
+            stems = stem_and_tokenize(value)
+            for i, stem in enumerate(stems):
+                positions.setdefault(stem, []).append(offset + i)
+            offset += len(stems) + POSITION_GAP
+    return positions
+
+def encode_positions(positions):
+    """
+    Delta-encode the ascending `positions` as varints, in a Binary.
+    """
+    data = bytearray()
+    previous = 0
+    for position in positions:
+        delta = position - previous
+        previous = position
+        while delta >= 0x80:
+            data.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        data.append(delta)
+    return Binary(str(data))
+
+def decode_positions(data):
+    """
+    Return the list of positions encoded by encode_positions.
+    """
+    positions = []
+    position = delta = shift = 0
+    for byte in bytearray(data):
+        delta |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        position += delta
+        positions.append(position)
+        delta = shift = 0
+    return positions
+
+def phrase_matches(position_lists):
+    """
+    True if there's a position in the first of `position_lists` such that
+    each following list contains the position after the previous one.
+    """
+    following = [set(positions) for positions in position_lists[1:]]
+    for start in position_lists[0]:
+        if all(start + i + 1 in positions for i, positions in enumerate(following)):
+            return True
+    return False
+
+def near_matches(position_lists, distance):
+    """
+    True if there is a position from each of `position_lists` (all sorted)
+    such that they are all within `distance` of each other.
+    """
+    if not all(position_lists):
+        return False
+    distance = min(distance, POSITION_GAP - 1)
+    indexes = [0] * len(position_lists)
+    while True:
+        current = [positions[i] for positions, i in zip(position_lists, indexes)]
+        lowest = min(current)
+        if max(current) - lowest <= distance:
+            return True
+        # the lowest position can't be in any window that fits; move past it
+        which = current.index(lowest)
+        indexes[which] += 1
+        if indexes[which] >= len(position_lists[which]):
+            return False
@@ -0,0 +1,586 @@
+"""
+Python-side postings for the full text indexes.
+
+The server-side indexer only records which stems each document contains
+(`value._extracted_terms`), which is enough to find candidates but means that
+every candidate has to be scored by map_reduce before any can be discarded.
+An index configured with `postings=True` additionally gets, from
+build_postings():
+
+ * a terms collection, `search_.terms.<collection>.<index>`, with each stem's
+   document frequency, idf and the largest weight it has in any document;
+ * a postings collection, `search_.postings.<collection>.<index>`, with one
+   {t: stem, d: docno, w: weight} record per stem per document, where `docno`
+   is a dense integer;
+ * a docnos collection, `search_.docnos.<collection>.<index>`, with an
+   {_id: document `_id`, n: docno} record per document.
+
+Weights follow the scheme in search.js: a stem's frequency in each field times
+the field's weighting, times ln(N/df), normalised by the length of the
+document's weight vector. A document's score is the cosine between that and
+the query's vector of idfs, ie. the sum over the query terms of the document
+weight times the normalised query weight.
+
+With `positions=True`, each posting also records where the stem occurs in
+the document, for phrase and NEAR/k searches (see positions.py).
+
+Because the largest possible contribution of each term is known,
+PostingsIndex.top_k can skip candidates that cannot make the top k, and stop
+altogether once no unseen candidate can (MaxScore).
+"""
+import heapq
+import itertools
+import math
+from operator import itemgetter
+
+import pymongo
+
+import idsets
+import positions
+import query
+import util
+
+POSTINGS_NAMESPACE = 'search_.postings'
+TERMS_NAMESPACE = 'search_.terms'
+DOCNOS_NAMESPACE = 'search_.docnos'
+BUILD_BATCH_SIZE = 500 # source documents fetched / postings inserted at a time
+PRUNING_BLOCK_SIZE = 100 # candidates scored between top-k threshold checks
+SHARED_POSTINGS_LIMIT = 10000 # longest postings list SharedPostingsIndex keeps in memory
+
+def postings_coll_name(collection, index_name):
+    return POSTINGS_NAMESPACE + '.' + collection.name + '.' + index_name
+
+def terms_coll_name(collection, index_name):
+    return TERMS_NAMESPACE + '.' + collection.name + '.' + index_name
+
+def docnos_coll_name(collection, index_name):
+    return DOCNOS_NAMESPACE + '.' + collection.name + '.' + index_name
+
+def extract_term_frequencies(doc, fields):
+    """
+    Return a dict of stem: field-weighted frequency for `doc`, where `fields`
+    is an index's dict of fieldname: weighting.
+    """
+    from mongo_search import stem_and_tokenize
+    term_freqs = {}
+    for fieldname, weighting in fields.iteritems():
+        for value in util.get_field(doc, fieldname) or []:
+            if not isinstance(value, basestring):
+                continue
+            for stem in stem_and_tokenize(value):
+                term_freqs[stem] = term_freqs.get(stem, 0) + weighting
+    return term_freqs
+
+def iter_indexed_docs(collection, index_collection, fields):
+    """
+    Yield (docno, source document) for every entry in `index_collection`, in
+    `_id` order, fetching the source documents from `collection` in batches.
+    """
+    docno = 0
+    batch = []
+    for entry in index_collection.find({}, ['_id']).sort('_id', pymongo.ASCENDING):
+        batch.append(entry['_id'])
+        if len(batch) >= BUILD_BATCH_SIZE:
+            for doc in _fetch_in_order(collection, batch, fields):
+                yield docno, doc
+                docno += 1
+            batch = []
+    for doc in _fetch_in_order(collection, batch, fields):
+        yield docno, doc
+        docno += 1
+
+def _fetch_in_order(collection, ids, fields):
+    if not ids:
+        return []
+    docs = dict((doc['_id'], doc) for doc in
+      collection.find({'_id': {'$in': ids}}, list(fields)))
+    return [docs[id] for id in ids if id in docs]
+
+def build_postings(collection, index_name, fields, index_collection, with_positions=False):
+    """
+    (Re)build the terms, postings and docnos collections for the index
+    `index_name` of `collection`, from the entries in its (already built)
+    index collection, recording the stems' positions in each posting if
+    `with_positions`.
+    """
+    builder = PostingsBuilder(collection, index_name, fields, with_positions)
+    for docno, doc in iter_indexed_docs(collection, index_collection, fields):
+        builder.add(docno, doc)
+    return builder.finish()
+
+class PostingsBuilder(object):
+    """
+    Builds the terms, postings and docnos collections for an index from its
+    documents, which are given to add() in docno order, as
+    iter_indexed_docs() yields them. That numbers the documents and counts
+    the document frequencies; finish() then makes a second pass to weight
+    the postings, which needs the idfs.
+
+    The new collections are built under temporary names and swapped in
+    together at the end, so until then searches keep using the old postings
+    with the old docnos, rather than a mixture. The second pass reads the
+    documents through the new docnos collection, so their postings get the
+    docnos it records even if the collection changes in between.
+    """
+    def __init__(self, collection, index_name, fields, with_positions=False):
+        self.collection = collection
+        self.fields = fields
+        self.with_positions = with_positions
+        db = collection.database
+        self._names = [postings_coll_name(collection, index_name),
+          terms_coll_name(collection, index_name), docnos_coll_name(collection, index_name)]
+        self._new_postings, self._new_terms, self._new_docnos = [
+          db[name + '.building'] for name in self._names]
+        for new_coll in self._new_postings, self._new_terms, self._new_docnos:
+            new_coll.drop()
+        self._doc_freqs = {}
+        self._doc_count = 0
+        self._docnos_batch = []
+
+    def add(self, docno, doc):
+        self._docnos_batch.append({'_id': doc['_id'], 'n': docno})
+        if len(self._docnos_batch) >= BUILD_BATCH_SIZE:
+            self._new_docnos.insert(self._docnos_batch)
+            self._docnos_batch = []
+        for stem in extract_term_frequencies(doc, self.fields):
+            self._doc_freqs[stem] = self._doc_freqs.get(stem, 0) + 1
+        self._doc_count += 1
+
+    def finish(self):
+        """
+        Weight and write the postings and terms, swap the new collections in
+        and return the number of documents indexed.
+        """
+        if self._docnos_batch:
+            self._new_docnos.insert(self._docnos_batch)
+        doc_freqs = self._doc_freqs
+        idfs = dict((stem, math.log(float(self._doc_count) / doc_freq))
+          for stem, doc_freq in doc_freqs.iteritems())
+
+        # second pass: normalised weights
+        fields = self.fields
+        with_positions = self.with_positions
+        max_weights = {}
+        batch = []
+        for docno, doc in self._iter_numbered_docs():
+            # a stem the document didn't have in the first pass (it has been
+            # edited since) isn't counted in the dfs, so it's left out
+            weights = dict((stem, term_freq * idfs[stem]) for stem, term_freq in
+              extract_term_frequencies(doc, fields).iteritems() if stem in idfs)
+            norm = math.sqrt(sum(weight * weight for weight in weights.itervalues()))
+            if with_positions:
+                term_positions = positions.extract_term_positions(doc, fields)
+            for stem, weight in weights.iteritems():
+                if norm:
+                    weight /= norm
+                if weight > max_weights.get(stem, 0.0):
+                    max_weights[stem] = weight
+                posting = {'t': stem, 'd': docno, 'w': weight}
+                if with_positions:
+                    posting['p'] = positions.encode_positions(term_positions.get(stem, []))
+                batch.append(posting)
+            if len(batch) >= BUILD_BATCH_SIZE:
+                self._new_postings.insert(batch)
+                batch = []
+        if batch:
+            self._new_postings.insert(batch)
+
+        batch = []
+        for stem, doc_freq in doc_freqs.iteritems():
+            batch.append({'_id': stem, 'df': doc_freq, 'idf': idfs[stem],
+              'max_w': max_weights.get(stem, 0.0)})
+            if len(batch) >= BUILD_BATCH_SIZE:
+                self._new_terms.insert(batch)
+                batch = []
+        if batch:
+            self._new_terms.insert(batch)
+
+        self._new_postings.ensure_index([('t', pymongo.ASCENDING), ('w', pymongo.DESCENDING)])
+        self._new_postings.ensure_index([('t', pymongo.ASCENDING), ('d', pymongo.ASCENDING)])
+        self._new_docnos.ensure_index([('n', pymongo.ASCENDING)])
+        db = self.collection.database
+        for new_coll, name in zip([self._new_postings, self._new_terms, self._new_docnos],
+          self._names):
+            db.drop_collection(name)
+            if new_coll.name in db.collection_names():
+                new_coll.rename(name)
+        return self._doc_count
+
+    def _iter_numbered_docs(self):
+        """
+        Yield (docno, source document) for the documents add() numbered, in
+        docno order, with the docnos it gave them - a document deleted since
+        then just gets no postings, rather than shifting the docnos of the
+        ones after it.
+        """
+        # docnos were given in _id order, so this is docno order too
+        records = self._new_docnos.find({}, ['n']).sort('_id', pymongo.ASCENDING)
+        for chunk in idsets.chunks(records, BUILD_BATCH_SIZE):
+            docnos = dict((rec['_id'], rec['n']) for rec in chunk)
+            for doc in _fetch_in_order(self.collection, [rec['_id'] for rec in chunk],
+              self.fields):
+                yield docnos[doc['_id']], doc
+
+
+class PostingsIndex(object):
+    """
+    Search-time access to the terms and postings collections of one index.
+    `with_positions` says whether its postings record positions.
+    """
+    def __init__(self, collection, index_name, index_collection, with_positions=False):
+        db = collection.database
+        self.with_positions = with_positions
+        self.index_collection = index_collection
+        self.postings = db[postings_coll_name(collection, index_name)]
+        self.terms = db[terms_coll_name(collection, index_name)]
+        self.docnos = db[docnos_coll_name(collection, index_name)]
+        self._doc_freqs = {} # of the terms whose stats have been fetched
+
+    def term_stats(self, terms):
+        """
+        Return a dict of stem: {'df': ..., 'idf': ..., 'max_w': ...} for those
+        of `terms` that occur in the index.
+        """
+        terms = set(terms)
+        stats = dict((rec['_id'], rec) for rec in
+          self.terms.find({'_id': {'$in': list(terms)}}))
+        for term in terms:
+            self._doc_freqs[term] = stats[term]['df'] if term in stats else 0
+        return stats
+
+    def query_weights(self, terms, stats, idfs=None):
+        """
+        Return the normalised query vector for `terms` as a dict of
+        stem: weight. `idfs` optionally overrides the idfs in `stats`.
+
+        The document weights were built with this index's own idfs, so with
+        `idfs` each term's weight is also scaled by its idf there over its
+        own idf, which rescales every posting of the term to the given idf.
+        The documents' norms can't be recomputed without their whole weight
+        vectors, so they stay this index's: scores are only approximately
+        what they would be in an index built with `idfs`.
+        """
+        weights = {}
+        for term in terms:
+            if idfs is not None and term in idfs:
+                idf = idfs[term]
+            else:
+                idf = stats[term]['idf']
+            weights[term] = weights.get(term, 0.0) + idf
+        norm = math.sqrt(sum(weight * weight for weight in weights.itervalues()))
+        if norm:
+            for term in weights:
+                weights[term] /= norm
+        if idfs is not None:
+            for term in weights:
+                if term in idfs and stats[term]['idf']:
+                    weights[term] *= idfs[term] / stats[term]['idf']
+        return weights
+
+    def evaluate(self, plan, k=None, allowed=None, scoped_docnos=None, idfs=None):
+        """
+        Return up to `k` (docno, score) pairs, best first, for the documents
+        matching the QueryPlan `plan`. `allowed` is an optional set of docnos
+        to restrict the search to, and `scoped_docnos` maps each of the plan's
+        field-scoped terms to the set of docnos matching it. `idfs` is an
+        optional dict of stem: idf to weight the query with instead of this
+        index's own idfs.
+
+        Pure conjunctions go through top_k; anything else is evaluated
+        term-at-a-time into a dict of score accumulators, with each
+        conjunction's later clauses only fetching postings for the candidates
+        that have survived so far.
+        """
+        if plan.is_empty:
+            return []
+        if plan.is_conjunctive:
+            return self.top_k(plan.terms, k, allowed, idfs)
+        stats = self.term_stats(plan.terms)
+        query_weights = self.query_weights(
+          [term for term in plan.terms if term in stats], stats, idfs)
+        accumulators = self._accumulate(plan.root, query_weights,
+          scoped_docnos or {}, allowed)
+        if k is None:
+            best = accumulators.iteritems()
+        else:
+            best = heapq.nlargest(k, accumulators.iteritems(), key=itemgetter(1))
+        return sorted(best, key=itemgetter(1), reverse=True)
+
+    def _accumulate(self, node, query_weights, scoped_docnos, within):
+        """
+        Return a dict of docno: partial score for the documents matching
+        `node`, considering only docnos in `within` (unless it's None).
+        """
+        if isinstance(node, query.Term):
+            return self._term_scores(node, query_weights, scoped_docnos, within)
+        if isinstance(node, (query.Phrase, query.Near)):
+            return self._proximity_scores(node, query_weights, within)
+        if isinstance(node, query.Or):
+            accumulators = {}
+            for child in node.children:
+                for docno, score in self._accumulate(child, query_weights,
+                  scoped_docnos, within).iteritems():
+                    accumulators[docno] = accumulators.get(docno, 0.0) + score
+            return accumulators
+        if isinstance(node, query.Not):
+            return {} # only meaningful inside an And
+        # And: the children are already ordered cheapest first
+        accumulators = None
+        for child in node.children:
+            if isinstance(child, query.Not):
+                continue
+            child_scores = self._accumulate(child, query_weights, scoped_docnos,
+              within if accumulators is None else set(accumulators))
+            if accumulators is None:
+                accumulators = child_scores
+            else:
+                accumulators = dict((docno, accumulators[docno] + score)
+                  for docno, score in child_scores.iteritems()
+                  if docno in accumulators)
+            if not accumulators:
+                return {}
+        if accumulators is None:
+            return {}
+        for child in node.children:
+            if isinstance(child, query.Not):
+                for docno in self._accumulate(child.child, query_weights,
+                  scoped_docnos, set(accumulators)):
+                    accumulators.pop(docno, None)
+        return accumulators
+
+    def _proximity_scores(self, node, query_weights, within):
+        """
+        Score the documents matching the Phrase or Near `node`: those
+        containing all its stems, and then (if there are positions) only
+        those where their positions line up.
+        """
+        stats = self.term_stats(node.stems)
+        terms = sorted(node.children, key=lambda term: stats.get(term.stem, {}).get('df', 0))
+        scores = self._accumulate(query.And(terms), query_weights, {}, within)
+        if not scores or not self.with_positions:
+            return scores
+        position_lists = dict((stem, self._positions_for(stem, scores.keys()))
+          for stem in set(node.stems))
+        for docno in scores.keys():
+            lists = [position_lists[stem].get(docno, []) for stem in node.stems]
+            if isinstance(node, query.Phrase):
+                matched = positions.phrase_matches(lists)
+            else:
+                matched = positions.near_matches(lists, node.distance)
+            if not matched:
+                del scores[docno]
+        return scores
+
+    def _positions_for(self, term, docnos):
+        """
+        Return a dict of docno: positions of `term`, for the documents
+        `docnos`.
+        """
+        found = {}
+        for chunk in idsets.chunks(docnos):
+            for posting in self.postings.find({'t': term, 'd': {'$in': chunk}}, ['d', 'p']):
+                found[posting['d']] = positions.decode_positions(posting.get('p', ''))
+        return found
+
+    def _term_scores(self, term, query_weights, scoped_docnos, within):
+        scores = {}
+        if term.field is not None:
+            # the field decides what matches, this index's postings how well
+            scores = dict((docno, 0.0) for docno in scoped_docnos.get(term, ())
+              if within is None or docno in within)
+            within = scores
+        weight = query_weights.get(term.stem, 0.0)
+        for posting in self._postings_for(term.stem, within):
+            scores[posting['d']] = posting['w'] * weight
+        return scores
+
+    def top_k(self, terms, k=None, allowed=None, idfs=None):
+        """
+        Return up to `k` (docno, score) pairs, best first, for the documents
+        containing all of `terms`. With `k` of None, all matches are returned.
+        `allowed` is an optional set of docnos to restrict the search to, and
+        `idfs` is as for evaluate().
+
+        The rarest term drives the search, its postings read in descending
+        weight order. A bounded min-heap holds the best k scores so far; a
+        candidate is dropped as soon as its partial score plus the maximum
+        possible contribution of the terms still to be looked up can't beat
+        the heap's minimum, and the search ends when that's true even for the
+        driving term's next posting.
+        """
+        stats = self.term_stats(terms)
+        if not terms or len(stats) < len(set(terms)):
+            return [] # some term isn't in the index at all
+        query_weights = self.query_weights(terms, stats, idfs)
+        max_contributions = dict((term, stats[term]['max_w'] * weight)
+          for term, weight in query_weights.iteritems())
+        by_rarity = sorted(query_weights, key=lambda term: stats[term]['df'])
+        driver, others = by_rarity[0], by_rarity[1:]
+        others_max = sum(max_contributions[term] for term in others)
+
+        heap = []
+        block = []
+        for posting in self._postings_by_weight(driver):
+            block.append(posting)
+            if len(block) < PRUNING_BLOCK_SIZE:
+                continue
+            if not self._score_block(block, heap, k, allowed, query_weights,
+              max_contributions, driver, others, others_max):
+                return self._sorted(heap)
+            block = []
+        if block:
+            self._score_block(block, heap, k, allowed, query_weights,
+              max_contributions, driver, others, others_max)
+        return self._sorted(heap)
+
+    def _score_block(self, block, heap, k, allowed, query_weights,
+      max_contributions, driver, others, others_max):
+        """
+        Score a block of the driving term's postings into `heap`. Returns
+        False if no posting from here on could make it into the top k.
+        """
+        threshold = self._threshold(heap, k)
+        driver_weight = query_weights[driver]
+        if threshold is not None and \
+          block[0]['w'] * driver_weight + others_max <= threshold:
+            return False
+        candidates = {}
+        for posting in block:
+            if allowed is not None and posting['d'] not in allowed:
+                continue
+            score = posting['w'] * driver_weight
+            if threshold is not None and score + others_max <= threshold:
+                break # postings are in descending weight order
+            candidates[posting['d']] = score
+        remaining_max = others_max
+        for term in others:
+            if not candidates:
+                break
+            remaining_max -= max_contributions[term]
+            term_weight = query_weights[term]
+            scored = {}
+            for posting in self._postings_for(term, candidates):
+                score = candidates[posting['d']] + posting['w'] * term_weight
+                if threshold is None or score + remaining_max > threshold:
+                    scored[posting['d']] = score
+            candidates = scored # documents without the term drop out here
+        for docno, score in candidates.iteritems():
+            if k is None or len(heap) < k:
+                heapq.heappush(heap, (score, docno))
+            elif score > heap[0][0]:
+                heapq.heapreplace(heap, (score, docno))
+        return True
+
+    def _postings_by_weight(self, term):
+        """
+        The postings of `term`, highest weight first.
+        """
+        return self.postings.find({'t': term}, ['d', 'w']).sort(
+          'w', pymongo.DESCENDING)
+
+    def _postings_for(self, term, docnos=None):
+        """
+        The postings of `term` for the documents `docnos` (or all of them).
+        When there are fewer docnos than the term has postings, they are
+        looked up a chunk of docnos at a time; otherwise the term's postings
+        are read through and tested against `docnos` here, rather than
+        sending them all to the server.
+        """
+        if docnos is None:
+            return self.postings.find({'t': term}, ['d', 'w'])
+        if term not in self._doc_freqs:
+            self.term_stats([term])
+        if len(docnos) >= self._doc_freqs[term]:
+            return (posting for posting in self.postings.find({'t': term}, ['d', 'w'])
+              if posting['d'] in docnos)
+        return itertools.chain.from_iterable(
+          self.postings.find({'t': term, 'd': {'$in': chunk}}, ['d', 'w'])
+          for chunk in idsets.chunks(docnos))
+
+    def _threshold(self, heap, k):
+        if k is None or len(heap) < k:
+            return None
+        return heap[0][0]
+
+    def _sorted(self, heap):
+        return [(docno, score) for score, docno in sorted(heap, reverse=True)]
+
+    def docnos_for_ids(self, ids):
+        """
+        Return the set of docnos of the documents with the given `_id`s.
+        """
+        docnos = set()
+        for chunk in idsets.chunks(ids):
+            docnos.update(rec['n'] for rec in self.docnos.find(
+              {'_id': {'$in': chunk}}, ['n']))
+        return docnos
+
+    def docnos_for_query(self, query_obj):
+        """
+        Return the set of docnos of the index entries matching `query_obj`.
+        """
+        return self.docnos_for_ids(rec['_id'] for rec in
+          self.index_collection.find(query_obj, ['_id']))
+
+    def ids_for_docnos(self, docnos):
+        """
+        Return a dict of docno: `_id` for the given docnos.
+        """
+        ids = {}
+        for chunk in idsets.chunks(docnos):
+            ids.update((rec['n'], rec['_id']) for rec in self.docnos.find(
+              {'n': {'$in': chunk}}, ['n']))
+        return ids
+
+
+class SharedPostingsIndex(PostingsIndex):
+    """
+    A PostingsIndex for running many queries together. Term statistics are
+    fetched for all the terms asked for at once and kept, and each term's
+    postings are read from the database the first time they are needed and
+    then served from memory - unless there are more than
+    SHARED_POSTINGS_LIMIT of them, in which case they are read from the
+    database each time, as by a PostingsIndex.
+    """
+    def __init__(self, collection, index_name, index_collection, with_positions=False):
+        super(SharedPostingsIndex, self).__init__(collection, index_name,
+          index_collection, with_positions)
+        self._stats = {}
+        self._fetched_terms = set()
+        self._postings_lists = {}
+
+    def term_stats(self, terms):
+        missing = set(terms) - self._fetched_terms
+        if missing:
+            self._stats.update(super(SharedPostingsIndex, self).term_stats(missing))
+            self._fetched_terms.update(missing)
+        return dict((term, self._stats[term]) for term in terms if term in self._stats)
+
+    def _postings_list(self, term):
+        """
+        Return the postings of `term` as a list, highest weight first, and
+        a dict of docno: weight.
+        """
+        if term not in self._postings_lists:
+            postings = list(super(SharedPostingsIndex, self)._postings_by_weight(term))
+            self._postings_lists[term] = (postings,
+              dict((posting['d'], posting['w']) for posting in postings))
+        return self._postings_lists[term]
+
+    def _is_shared(self, term):
+        stats = self.term_stats([term]).get(term)
+        return stats is not None and stats['df'] <= SHARED_POSTINGS_LIMIT
+
+    def _postings_by_weight(self, term):
+        if not self._is_shared(term):
+            return super(SharedPostingsIndex, self)._postings_by_weight(term)
+        return iter(self._postings_list(term)[0])
+
+    def _postings_for(self, term, docnos=None):
+        if not self._is_shared(term):
+            return super(SharedPostingsIndex, self)._postings_for(term, docnos)
+        postings, weights = self._postings_list(term)
+        if docnos is None:
+            return postings
+        return [{'d': docno, 'w': weights[docno]} for docno in docnos
+          if docno in weights]
@@ -0,0 +1,500 @@
+"""
+Parsing of search query strings into boolean query trees, and compilation of
+those into execution plans.
+
+The syntax is deliberately forgiving, since query strings usually come
+straight from a search box:
+
+    dog whippet             both terms (AND is implied)
+    dog AND whippet         the same
+    dog OR cat              either term
+    dog NOT whippet         dog, but not whippet. `-whippet` means the same,
+                            and `-(dog OR cat)` negates the group
+    (dog OR cat) fish       grouping
+    title:dog               the term, searched for in the `title` field only
+    whipp*                  any of the commonest words starting with "whipp"
+    "john dory"             the words next to each other, in order
+    dog NEAR/3 whippet      the words within 3 words of each other
+
+Operators must be upper case; lower case "and", "or" and "not" are ordinary
+words. Unbalanced parentheses and dangling operators are ignored rather than
+raising errors, as are purely negative alternatives (`dog OR -cat`). A
+double negative cancels out, and a query that is negative as a whole
+(`NOT dog`, `NOT (dog -cat)`) matches nothing.
+
+Phrases and NEAR/k clauses can only be checked exactly against an index with
+positions (see positions.py); elsewhere they match as if their words were
+ANDed. NEAR/k joins single words, or other NEAR/k clauses with the same k.
+
+Words are run through the same analyzer as the search index, so one word can
+produce several stems, which are ANDed together. A word ending in `*` is
+expanded into an OR of the stems of its completions, if an `expand` function
+is given (see dictionary.py); if nothing completes it, it matches nothing.
+Similarly, a `correct` function can replace stems that aren't in the index
+with an OR of the known stems they may be misspellings of (see fuzzy.py).
+"""
+import re
+
+FIELD_RE = re.compile(r"^(\w[\w.]*):(.+)$")
+LEX_RE = re.compile(r'[^\s()"]*"[^"]*"?|[()]|[^\s()"]+')
+NEAR_RE = re.compile(r"^NEAR/(\d+)$")
+
+class Term(object):
+    """
+    A single stem, optionally restricted to the field named `field`.
+    """
+    def __init__(self, stem, field=None):
+        self.stem = stem
+        self.field = field
+
+    def __eq__(self, other):
+        return isinstance(other, Term) and (self.stem, self.field) == (other.stem, other.field)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.stem, self.field))
+
+    def __repr__(self):
+        if self.field:
+            return 'Term(%r, field=%r)' % (self.stem, self.field)
+        return 'Term(%r)' % self.stem
+
+class And(object):
+    def __init__(self, children):
+        self.children = children
+
+    def __eq__(self, other):
+        return isinstance(other, And) and self.children == other.children
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'And(%r)' % self.children
+
+class Or(object):
+    def __init__(self, children):
+        self.children = children
+
+    def __eq__(self, other):
+        return isinstance(other, Or) and self.children == other.children
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Or(%r)' % self.children
+
+class Not(object):
+    def __init__(self, child):
+        self.child = child
+
+    def __eq__(self, other):
+        return isinstance(other, Not) and self.child == other.child
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Not(%r)' % self.child
+
+class Phrase(object):
+    """
+    Unscoped stems that must occur consecutively, in order.
+    """
+    def __init__(self, stems):
+        self.stems = stems
+
+    @property
+    def children(self):
+        return [Term(stem) for stem in self.stems]
+
+    def __eq__(self, other):
+        return isinstance(other, Phrase) and self.stems == other.stems
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Phrase(%r)' % self.stems
+
+class Near(object):
+    """
+    Unscoped stems that must all occur within `distance` positions of each
+    other, in any order.
+    """
+    def __init__(self, stems, distance):
+        self.stems = stems
+        self.distance = distance
+
+    @property
+    def children(self):
+        return [Term(stem) for stem in self.stems]
+
+    def __eq__(self, other):
+        return isinstance(other, Near) and \
+          (self.stems, self.distance) == (other.stems, other.distance)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Near(%r, %r)' % (self.stems, self.distance)
+
+def parse(query_string, analyze, expand=None, correct=None):
+    """
+    Parse `query_string` into a tree of Term, And, Or and Not nodes, using
+    `analyze` to turn each word into a list of stems, `expand` (if given)
+    to turn each `prefix*` into a list of stems, or None if it can't, and
+    `correct` (if given) to return the stems to search for instead of a
+    stem, or None to keep it. Returns None if nothing searchable is left.
+    """
+    parser = _Parser(LEX_RE.findall(query_string), analyze, expand, correct)
+    children = []
+    while parser.peek() is not None:
+        node = parser.parse_or()
+        if node is not None:
+            children.append(node)
+        if parser.peek() == ')':
+            parser.next() # unbalanced; ignore it
+    return _combine(And, children)
+
+class _Parser(object):
+    def __init__(self, tokens, analyze, expand=None, correct=None):
+        self.tokens = tokens
+        self.position = 0
+        self.analyze = analyze
+        self.expand = expand
+        self.correct = correct
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse_or(self):
+        children = [self.parse_and()]
+        while self.peek() == 'OR':
+            self.next()
+            children.append(self.parse_and())
+        if len(children) > 1:
+            # a purely negative alternative matches nearly everything, and
+            # postings can't enumerate it; ignore it
+            children = [child for child in children if not _is_negative(child)]
+        return _combine(Or, children)
+
+    def parse_and(self):
+        children = []
+        while self.peek() not in (None, ')', 'OR'):
+            if self.peek() == 'AND':
+                self.next()
+                continue
+            node = self.parse_unary()
+            while self.peek() is not None and NEAR_RE.match(self.peek()):
+                distance = int(NEAR_RE.match(self.next()).group(1))
+                if self.at_operand():
+                    node = _near(node, self.parse_unary(), distance)
+                # otherwise it's dangling; ignore it
+            children.append(node)
+        return _combine(And, children)
+
+    def at_operand(self):
+        token = self.peek()
+        return token not in (None, ')', 'OR', 'AND', 'NOT') and not NEAR_RE.match(token)
+
+    def parse_unary(self):
+        token = self.next()
+        if NEAR_RE.match(token):
+            return None # with nothing before it
+        if token == 'NOT':
+            if self.peek() in (None, ')', 'OR'):
+                return None
+            return _negate(self.parse_unary())
+        if token == '-' and self.peek() == '(':
+            return _negate(self.parse_unary()) # -(dog OR cat)
+        if token == '(':
+            node = self.parse_or()
+            if self.peek() == ')':
+                self.next()
+            return node
+        if token.startswith('-') and len(token) > 1:
+            return _negate(self.parse_word(token[1:]))
+        return self.parse_word(token)
+
+    def parse_word(self, word):
+        match = FIELD_RE.match(word)
+        if match:
+            field, text = match.groups()
+        else:
+            field, text = None, word
+        if text.startswith('"'):
+            stems = self.analyze(text.strip('"'))
+            if field is None and len(stems) > 1:
+                return Phrase(stems)
+            return _combine(And, [Term(stem, field) for stem in stems])
+        if text.endswith('*') and len(text) > 1 and self.expand is not None:
+            stems = self.expand(text[:-1].lower())
+            if stems is not None:
+                if not stems:
+                    return Term(text.lower(), field) # not a stem, so never matches
+                return _combine(Or, [Term(stem, field) for stem in stems])
+        return _combine(And, [self.parse_stem(stem, field) for stem in self.analyze(text)])
+
+    def parse_stem(self, stem, field):
+        if self.correct is not None:
+            stems = self.correct(stem)
+            if stems:
+                return _combine(Or, [Term(correction, field) for correction in stems])
+        return Term(stem, field)
+
+def _near(left, right, distance):
+    """
+    Combine `left` and `right` into a Near node, if they are made of plain
+    words; otherwise just AND them.
+    """
+    stems = []
+    for node in [left, right]:
+        if isinstance(node, Term) and node.field is None:
+            stems.append(node.stem)
+        elif isinstance(node, Near) and node.distance == distance:
+            stems.extend(node.stems)
+        else:
+            return _combine(And, [left, right])
+    return Near(stems, distance)
+
+def _is_negative(node):
+    return not [term for term, negated in iter_terms(node) if not negated]
+
+def _negate(node):
+    if node is None:
+        return None
+    if isinstance(node, Not):
+        return node.child # NOT NOT dog is just dog
+    return Not(node)
+
+def _combine(node_class, children):
+    """
+    Build a `node_class` (And or Or) node from `children`, dropping empty
+    children, flattening nested nodes of the same type and removing
+    duplicates. Returns the only child directly, or None if there are none.
+    """
+    flattened = []
+    for child in children:
+        if child is None:
+            continue
+        if isinstance(child, node_class):
+            candidates = child.children
+        else:
+            candidates = [child]
+        for candidate in candidates:
+            if candidate not in flattened:
+                flattened.append(candidate)
+    if not flattened:
+        return None
+    if len(flattened) == 1:
+        return flattened[0]
+    return node_class(flattened)
+
+def iter_terms(node, negated=False):
+    """
+    Yield (term, negated) for every Term in the tree under `node`.
+    """
+    if isinstance(node, Term):
+        yield node, negated
+    elif isinstance(node, Not):
+        for item in iter_terms(node.child, not negated):
+            yield item
+    elif node is not None:
+        for child in node.children:
+            for item in iter_terms(child, negated):
+                yield item
+
+def required_terms(node):
+    """
+    Return the set of unscoped Terms that every match of `node` must contain.
+    """
+    if isinstance(node, Term):
+        if node.field is None:
+            return set([node])
+        return set()
+    if isinstance(node, (And, Phrase, Near)):
+        result = set()
+        for child in node.children:
+            result |= required_terms(child)
+        return result
+    if isinstance(node, Or):
+        result = required_terms(node.children[0])
+        for child in node.children[1:]:
+            result &= required_terms(child)
+        return result
+    return set()
+
+def is_conjunctive(node):
+    """
+    True if `node` only ANDs together unscoped terms.
+    """
+    if isinstance(node, Term):
+        return node.field is None
+    if isinstance(node, And):
+        return all(isinstance(child, Term) and child.field is None
+          for child in node.children)
+    return False
+
+def has_proximity(node):
+    """
+    True if there's a Phrase or Near in the tree under `node`.
+    """
+    if isinstance(node, (Phrase, Near)):
+        return True
+    if isinstance(node, Not):
+        return has_proximity(node.child)
+    if isinstance(node, (And, Or)):
+        return any(has_proximity(child) for child in node.children)
+    return False
+
+
+class QueryPlan(object):
+    """
+    A compiled query, ready to run against one index.
+
+    `doc_freq` is a function returning the document frequency of a stem in
+    the index. It is used to order conjunctions so that the rarest term (or
+    cheapest clause) comes first and drives the intersection; NOT clauses
+    always come last, as they can only remove candidates.
+
+    Attributes:
+      `root` - the ordered query tree, or None if nothing can match
+      `terms` - the sorted stems of the positive terms: what results are
+        scored on
+      `required_terms` - the stems every result must contain, rarest first
+      `scoped_terms` - the Terms restricted to a field, which have to be
+        resolved against other indexes
+      `is_conjunctive` - True if the query just ANDs unscoped terms
+      `has_proximity` - True if the query has phrases or NEAR/k clauses
+    """
+    def __init__(self, root, doc_freq):
+        self._doc_freq = doc_freq
+        if root is not None and not list(term for term, negated in iter_terms(root)
+          if not negated):
+            root = None # purely negative queries match nothing
+        if isinstance(root, Not):
+            root = None # and neither does a negated group, eg. NOT (dog -cat)
+        if root is not None:
+            root = self._order(root)
+        self.root = root
+        self.is_empty = self.root is None
+        self.terms = sorted(term.stem for term, negated in iter_terms(self.root)
+          if not negated)
+        self.required_terms = [term.stem for term in required_terms(self.root)]
+        if len(self.required_terms) > 1:
+            self.required_terms.sort(key=doc_freq)
+        self.scoped_terms = set(term for term, negated in iter_terms(self.root)
+          if term.field is not None)
+        self.is_conjunctive = self.root is not None and is_conjunctive(self.root)
+        self.has_proximity = has_proximity(self.root)
+
+    def _order(self, node):
+        if isinstance(node, Not):
+            return Not(self._order(node.child))
+        if isinstance(node, (And, Or)):
+            children = [self._order(child) for child in node.children]
+            if isinstance(node, And) and len(children) > 1:
+                children.sort(key=self._cost)
+            return node.__class__(children)
+        return node
+
+    def _cost(self, node):
+        """
+        An estimate of the number of candidates `node` produces.
+        """
+        if isinstance(node, Term):
+            return self._doc_freq(node.stem)
+        if isinstance(node, (And, Phrase, Near)):
+            return min(self._cost(child) for child in node.children)
+        if isinstance(node, Or):
+            return sum(self._cost(child) for child in node.children)
+        return float('inf') # Not
+
+    def mongo_query(self, scoped_ids=None):
+        """
+        Return a query selecting the matching entries of the index
+        collection. `scoped_ids` maps each of `scoped_terms` to the `_id`s of
+        the documents matching it.
+        """
+        if self.root is None:
+            return {'_id': {'$in': []}}
+        return self._mongo_query(self.root, scoped_ids or {})
+
+    def _mongo_query(self, node, scoped_ids):
+        if isinstance(node, Term):
+            if node.field is None:
+                return {'value._extracted_terms': node.stem}
+            return {'_id': {'$in': list(scoped_ids.get(node, []))}}
+        if isinstance(node, (Phrase, Near)):
+            return {'value._extracted_terms': {'$all': node.stems}}
+        if isinstance(node, Not):
+            if isinstance(node.child, Term) and node.child.field is None:
+                return {'value._extracted_terms': {'$ne': node.child.stem}}
+            return {'$nor': [self._mongo_query(node.child, scoped_ids)]}
+        if isinstance(node, Or):
+            if all(isinstance(child, Term) and child.field is None
+              for child in node.children):
+                return {'value._extracted_terms': {'$in': [child.stem for child in node.children]}}
+            return {'$or': [self._mongo_query(child, scoped_ids) for child in node.children]}
+        # And: the plain terms go in one $all, in order, so the rarest one is
+        # used for the index lookup
+        all_terms, none_terms, clauses = [], [], []
+        for child in node.children:
+            if isinstance(child, Term) and child.field is None:
+                all_terms.append(child.stem)
+            elif isinstance(child, Not) and isinstance(child.child, Term) \
+              and child.child.field is None:
+                none_terms.append(child.child.stem)
+            else:
+                clauses.append(self._mongo_query(child, scoped_ids))
+        terms_query = {}
+        if all_terms:
+            terms_query['$all'] = all_terms
+        if none_terms:
+            terms_query['$nin'] = none_terms
+        if terms_query:
+            clauses.insert(0, {'value._extracted_terms': terms_query})
+        if len(clauses) == 1:
+            return clauses[0]
+        return {'$and': clauses}
+
+    def matches(self, terms, id, scoped_ids=None):
+        """
+        True if a document with `_id` `id`, whose index entry contains the
+        stems `terms`, matches this query.
+        """
+        if self.root is None:
+            return False
+        return self._matches(self.root, set(terms), id, scoped_ids or {})
+
+    def _matches(self, node, terms, id, scoped_ids):
+        if isinstance(node, Term):
+            if node.field is None:
+                return node.stem in terms
+            return id in scoped_ids.get(node, ())
+        if isinstance(node, Not):
+            return not self._matches(node.child, terms, id, scoped_ids)
+        if isinstance(node, (And, Phrase, Near)):
+            return all(self._matches(child, terms, id, scoped_ids) for child in node.children)
+        return any(self._matches(child, terms, id, scoped_ids) for child in node.children)
+
+    def __repr__(self):
+        return 'QueryPlan(%r)' % self.root
+
+def compile_query(query_string, analyze, doc_freq, expand=None, correct=None):
+    """
+    Parse `query_string` and return a QueryPlan for it.
+    """
+    return QueryPlan(parse(query_string, analyze, expand, correct), doc_freq)
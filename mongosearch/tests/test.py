@@ -4,8 +4,9 @@ actual tests for the mongo-full-text-search
 """
 
 from nose import with_setup
-from nose.tools import assert_true, assert_equals, assert_raises
+from nose.tools import assert_true, assert_equals, assert_raises, assert_almost_equals
 from mongosearch import mongo_search, util
+import math
 import time
 import sys
 
@@ -25,13 +26,14 @@ def setup_module():
     Instantiate a new mongo daemon and corresponding connection and 
     then insert the appropriate test fixture.
     """
+    global _connection
     from pymongo.errors import AutoReconnect, ConnectionFailure
     import time
     daemon = _setup_daemon()
     conn_tries = 0
     while True:
         try:
-            _connection = util.get_connection(**_settings)
+            _connection = util.set_default_connection(**_settings)
             break
         except (AutoReconnect, ConnectionFailure):
             conn_tries += 1 # sometimes the daemon doesn't set up straight away
@@ -72,8 +74,7 @@ def _setup_fixture(connection=None):
     util.load_fixture('jstests/_fixture-basic.json', _collection)
 
 def teardown_module():
-    if _connection:
-        _connection.disconnect()
+    util.close_connections()
     if _daemon:
         _daemon.destroy()
 
@@ -141,20 +142,48 @@ def test_oo_search():
         {u'content': u'groupers like John Dory', u'_id': 1.0, u'score': 0.72150482058559517, u'title': u'fish', u'category': u'A' }])
         
     assert_equals(list(collection.search(u'dog whippet', limit=1)), [
-        {u'content': u'whippets kick groupers', u'_id': 3.0, u'score': 0.27585913234480763, u'title': u'dogs and fish', u'category': u'B' }])
-    assert_equals(list(collection.search(u'whippets', skip=1, spec={u'category': u'B'})), [
-        {u'content': u'whippets kick mongrels', u'_id': 2.0, u'score': 0.1706438640480763, u'title': u'dogs', u'category': u'B' }])
+        {u'content': u'whippets kick mongrels', u'category': u'B', u'_id': 2, u'score': 0.72398060061762026, u'title': u'dogs'}])
+    results = list(collection.search(u'whippets', skip=1, spec={u'category': u'B'}))
+    assert_equals([rec[u'_id'] for rec in results], [3.0])
+    assert_almost_equals(results[0][u'score'], 0.0650206210444169)
     assert_equals(list(collection.search(u'whippet', spec={u'category': u'Z'})), [])
     assert_equals(list(collection.search(u'whippet', skip=2, spec={u'category': u'Z'})), [])
     assert_equals(list(collection.search(u'spurgle', limit=10)), [])
     
+    # both ways of applying a spec give the same results
+    cursor = collection.search(u'whippets', spec={u'category': u'B'}, limit=1)
+    expected = list(cursor)
+    assert_equals(cursor.explain()['restriction']['strategy'], mongo_search.FILTER_FIRST)
+    cursor = collection.search(u'whippets', spec={u'category': u'B'}, limit=1)
+    cursor._restriction_strategy = mongo_search.SCORE_FIRST
+    assert_equals(list(cursor), expected)
+    assert_equals(cursor.count(), 2)
+    
+    # unknown stems and empty queries never reach the server
+    for query in [u'spurgle', u'dog spurgle', u'', u'&&']:
+        cursor = collection.search(query, limit=10)
+        assert_equals(list(cursor), [])
+        assert_true(cursor._raw_result_coll is None)
+    
     cursor = collection.search(u'dog whippet')
     assert_equals(cursor.count(), 2)
     cursor.skip(1)
     cursor.limit(1)
     assert_equals(cursor[0], 
-        {u'content': u'whippets kick mongrels', u'category': u'B', u'_id': 2, u'score': 0.72398060061762026, u'title': u'dogs'})
+        {u'content': u'whippets kick groupers', u'_id': 3.0, u'score': 0.27585913234480763, u'title': u'dogs and fish', u'category': u'B' })
     assert_equals(len(list(cursor)), 1)
+    assert_raises(IndexError, lambda: cursor[1])
+    assert_raises(mongo_search.InvalidSearchOperation, lambda: cursor[0:1])
+    
+    cursor = collection.search(u'dog whippet')[1:2]
+    assert_equals([rec[u'_id'] for rec in cursor], [3.0])
+    cursor = collection.search(u'dog whippet')[1:1]
+    assert_equals(list(cursor), [])
+    assert_equals(list(collection.search(u'dog whippet', prefetch=True)),
+      list(collection.search(u'dog whippet')))
+    cursor = collection.search(u'dog whippet')
+    assert_equals(cursor[1], cursor[1])
+    assert_equals([cursor[0][u'_id'], cursor[1][u'_id']], [2.0, 3.0])
     
     cursor = collection.search(u'dog')
     cursor.limit(10)
@@ -164,9 +193,23 @@ def test_oo_search():
         {u'content': u'whippets kick groupers', u'_id': 3.0, u'score': 0.32510310522208458, u'title': u'dogs and fish', u'category': u'B' }])
  
     cursor = collection.search(u'kick', skip=1, limit=5)
-    assert_equals(list(cursor), 
-        [{u'content': u'whippets kick mongrels', u'_id': 2.0, u'score': 0.1706438640480763, u'title': u'dogs', u'category': u'B' }])
+    results = list(cursor)
+    assert_equals([rec[u'_id'] for rec in results], [3.0])
+    assert_almost_equals(results[0][u'score'], 0.0650206210444169)
     assert_equals(cursor.count(), 2)
+    
+    assert_equals(collection.search(u'fish', spec={u'category': u'A'}).count(), 1)
+    assert_equals(collection.search(u'whippet', spec={u'category': u'Z'}).count(), 0)
+    assert_equals(collection.search(u'dog', id_list=[3.0]).count(), 1)
+    assert_equals(collection.search(u'spurgle').count(), 0)
+    
+    # the fixture is smaller than the sample, so these are exact
+    approx = collection.search(u'dog whippet').count(approximate=True)
+    assert_equals((approx, approx.exact), (2, True))
+    approx = collection.search(u'whippet', spec={u'category': u'A'}).count(approximate=True)
+    assert_equals((approx, approx.error), (0, 0))
+    approx = collection.search(u'dog OR fish').count(approximate=True)
+    assert_equals(approx, collection.search(u'dog OR fish').count())
    
 
 
@@ -207,8 +250,533 @@ def test_per_field_search():
     assert_equals(list(collection.search({u'title': u'dogs whippet'})), [])
     
     assert_raises(mongo_search.SearchIndexNotConfiguredException, collection.search, {u'not_index_name': 'dog'})
+
+def test_boolean_search():
+    collection = mongo_search.SearchableCollection(
+      _database['oo_boolean_works']
+    )
+    collection.remove()
+    stdout, stderr = util.load_fixture('jstests/_fixture-per_field.json', collection)
+    collection.configure_text_index_fields({'title': 5, 'content': 1})
+    collection.configure_text_index_fields({'title': 1}, 'title')
+    collection.configure_text_index_fields({'content': 1}, 'content_idx')
+    stdout, stderr = collection.ensure_text_index()
+    
+    def ids(query, **kwargs):
+        return sorted(rec[u'_id'] for rec in collection.search(query, **kwargs))
+    
+    assert_equals(ids(u'dog NOT whippet'), [1])
+    assert_equals(ids(u'dog -whippets'), [1])
+    assert_equals(ids(u'mongrel OR grouper'), [1, 2, 3])
+    assert_equals(ids(u'(mongrel OR grouper) fish'), [1, 2, 3])
+    assert_equals(ids(u'(mongrel OR dory) kick'), [2])
+    assert_equals(ids(u'title:dog'), [2, 3])
+    assert_equals(ids(u'title:fish -title:dog'), [1])
+    assert_equals(ids(u'title:dog', spec={u'category': u'B'}), [2, 3])
+    assert_equals(ids(u'NOT dog'), [])
+    assert_equals(collection.search(u'mongrel OR grouper').count(), 3)
+    assert_equals(collection.search(u'dog NOT whippet').count(), 1)
+    # a purely negative alternative is ignored by every engine
+    assert_equals(ids(u'mongrel OR -grouper'), ids(u'mongrel'))
+    assert_equals(collection.search(u'mongrel OR -grouper').count(),
+      collection.search(u'mongrel').count())
+    assert_raises(mongo_search.InvalidSearchOperation, list, collection.search(u'category:dog'))
+    # field-scoped ids are only looked up among the other words' matches
+    from mongosearch import idsets
+    chunk_size = idsets.ID_CHUNK_SIZE
+    idsets.ID_CHUNK_SIZE = 1
+    try:
+        assert_equals(ids(u'title:dog kick'), [2, 3])
+        assert_equals(ids(u'title:dog -title:fish kick'), [2])
+        assert_raises(mongo_search.InvalidSearchOperation, list,
+          collection.search(u'title:dog'))
+    finally:
+        idsets.ID_CHUNK_SIZE = chunk_size
+
+def test_query_parsing():
+    from mongosearch import query
+    parse = lambda query_string: query.parse(query_string, mongo_search.stem_and_tokenize)
+    Term, And, Or, Not = query.Term, query.And, query.Or, query.Not
+    
+    yield assert_equals, parse(u'dogs whippets'), And([Term(u'dog'), Term(u'whippet')])
+    yield assert_equals, parse(u'dogs AND whippets'), And([Term(u'dog'), Term(u'whippet')])
+    yield assert_equals, parse(u'dogs and whippets'), And([Term(u'dog'), Term(u'and'), Term(u'whippet')])
+    yield assert_equals, parse(u'dog OR cat'), Or([Term(u'dog'), Term(u'cat')])
+    yield assert_equals, parse(u'(dog OR cat) -fish'), And([Or([Term(u'dog'), Term(u'cat')]), Not(Term(u'fish'))])
+    yield assert_equals, parse(u'title:dogs fish'), And([Term(u'dog', u'title'), Term(u'fish')])
+    yield assert_equals, parse(u'((dog AND'), Term(u'dog')
+    yield assert_equals, parse(u') OR'), None
+    yield assert_equals, parse(u'-(dog OR cat) fish'), And([Not(Or([Term(u'dog'), Term(u'cat')])), Term(u'fish')])
+    yield assert_equals, parse(u'- fish'), Term(u'fish')
+    yield assert_equals, parse(u'dog OR -cat'), Term(u'dog')
+    yield assert_equals, parse(u'dog OR (-cat -fish) OR (fish -cat)'), Or([Term(u'dog'), And([Term(u'fish'), Not(Term(u'cat'))])])
+    yield assert_equals, parse(u'dog NEAR/3'), Term(u'dog')
+    yield assert_equals, parse(u'(dog NEAR/3'), Term(u'dog')
+    yield assert_equals, parse(u'NEAR/3 dog'), Term(u'dog')
+    yield assert_equals, parse(u'dog NEAR/3 OR cat'), Or([Term(u'dog'), Term(u'cat')])
+    yield assert_equals, parse(u'dog NEAR/3 NOT cat'), And([Term(u'dog'), Not(Term(u'cat'))])
+    yield assert_equals, parse(u'dog NEAR/3 whippets'), query.Near([u'dog', u'whippet'], 3)
+    expand = {u'do': [u'dog', u'dori'], u'zz': []}.get
+    yield assert_equals, query.parse(u'do* fish', mongo_search.stem_and_tokenize, expand), \
+      And([Or([Term(u'dog'), Term(u'dori')]), Term(u'fish')])
+    yield assert_equals, query.parse(u'zz*', mongo_search.stem_and_tokenize, expand), Term(u'zz*')
+    yield assert_equals, query.parse(u'fish*', mongo_search.stem_and_tokenize, expand), Term(u'fish')
+    
+    doc_freqs = {u'dog': 10, u'whippet': 2, u'fish': 5}
+    plan = query.compile_query(u'dog fish whippet', mongo_search.stem_and_tokenize, doc_freqs.get)
+    yield assert_equals, plan.required_terms, [u'whippet', u'fish', u'dog']
+    yield assert_equals, plan.mongo_query(), {'value._extracted_terms': {'$all': [u'whippet', u'fish', u'dog']}}
+    yield assert_true, plan.is_conjunctive
+    plan = query.compile_query(u'NOT dog', mongo_search.stem_and_tokenize, doc_freqs.get)
+    yield assert_true, plan.is_empty
+    yield assert_equals, parse(u'NOT NOT dog'), Term(u'dog')
+    yield assert_equals, parse(u'fish -(NOT dog)'), And([Term(u'fish'), Term(u'dog')])
+    plan = query.compile_query(u'NOT (dog -fish)', mongo_search.stem_and_tokenize, doc_freqs.get)
+    yield assert_true, plan.is_empty
+
+def test_bloom_filter():
+    from mongosearch.bloom import BloomFilter
+    term_filter = BloomFilter(1000)
+    for i in xrange(1000):
+        term_filter.add(u'stem%d' % i)
+    assert_true(all(u'stem%d' % i in term_filter for i in xrange(1000)))
+    false_positives = sum(1 for i in xrange(1000) if u'other%d' % i in term_filter)
+    assert_true(false_positives < 30)
+    restored = BloomFilter.from_document(term_filter.to_document())
+    assert_true(all(u'stem%d' % i in restored for i in xrange(1000)))
+
+def test_single_flight():
+    import threading
+    from mongosearch.cache import SingleFlight
+    flights = SingleFlight()
+    release = threading.Event()
+    def slow():
+        release.wait(10)
+        return object()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flights.do('key', slow)))
+      for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for i in range(100):
+        if flights.stats()['coalesced'] == 3:
+            break
+        time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert_equals(len(set(id(result) for result, shared in results)), 1)
+    assert_equals(sorted(shared for result, shared in results), [False, True, True, True])
+    assert_equals(flights.stats(), {'executed': 1, 'coalesced': 3, 'in_flight': 0})
+
+def test_compact_ids():
+    from pymongo.objectid import ObjectId
+    from mongosearch.idsets import CompactIds, chunks
+    object_ids = [ObjectId() for i in xrange(5)]
+    for ids in [range(10), [0.5, 1.5], object_ids, [1, u'two', object_ids[0]]]:
+        assert_equals(list(CompactIds(ids)), ids)
+        assert_equals(len(CompactIds(ids)), len(ids))
+    assert_equals(list(chunks(CompactIds(range(5)), 2)), [[0, 1], [2, 3], [4]])
+
+def test_docno_bitmap():
+    from mongosearch.bitmap import DocnoBitmap
+    sparse = set(xrange(0, 200000, 37))
+    dense = set(xrange(65536, 75536))
+    bitmap = DocnoBitmap(sparse | dense)
+    assert_equals(list(bitmap), sorted(sparse | dense))
+    assert_equals(len(bitmap), len(sparse | dense))
+    assert_true(37 in bitmap)
+    assert_true(38 not in bitmap)
+    assert_equals(list(bitmap & DocnoBitmap(dense)), sorted(dense))
+    assert_equals(bitmap.intersection([36, 37, 70000]), [37, 70000])
+
+def _ids_and_scores(results):
+    return [(rec[u'_id'], round(rec[u'score'], 10)) for rec in results]
+
+def test_postings_search():
+    collection = mongo_search.SearchableCollection(
+      _database['oo_postings_works']
+    )
+    collection.remove()
+    stdout, stderr = util.load_fixture('jstests/_fixture-basic.json', collection)
+    collection.configure_text_index_fields({u'title': 5, u'content': 1})
+    collection.configure_text_index_fields({u'title': 5, u'content': 1}, u'postings_idx', postings=True)
+    
+    stdout, stderr = collection.ensure_text_index()
+    
+    # postings give the same scores as the map_reduce search
+    for query in [u'fish', u'dog whippet', u'kick', u'spurgle']:
+        assert_equals(
+          _ids_and_scores(collection.search({u'postings_idx': query})),
+          _ids_and_scores(collection.search(query)))
+    assert_equals(
+      _ids_and_scores(collection.search({u'postings_idx': u'dog whippet'}, limit=1)),
+      _ids_and_scores(collection.search(u'dog whippet', limit=1)))
+    assert_equals(
+      _ids_and_scores(collection.search({u'postings_idx': u'whippet'}, skip=1, limit=1)),
+      _ids_and_scores(collection.search(u'whippet', skip=1, limit=1)))
+    assert_equals(
+      _ids_and_scores(collection.search({u'postings_idx': u'fish'}, spec={u'category': u'B'})),
+      _ids_and_scores(collection.search(u'fish', spec={u'category': u'B'})))
+    assert_equals(
+      [rec[u'_id'] for rec in collection.search({u'postings_idx': u'(mongrel OR grouper) -fish'})],
+      [2])
+    # batched searches give the same results as separate ones
+    queries = [u'fish', u'dog whippet', u'spurgle', u'kick -mongrel']
+    for index_name in [u'postings_idx', None]:
+        results = collection.search_many(queries, limit=2, index_name=index_name)
+        assert_equals([_ids_and_scores(result) for result in results],
+          [_ids_and_scores(collection.search({index_name or u'default_': query}, limit=2))
+            for query in queries])
+    # the spec's docnos are cached and reused
+    cursor = collection.search({u'postings_idx': u'fish'}, spec={u'category': u'B'})
+    results = _ids_and_scores(cursor)
+    assert_equals(cursor.explain()['filter_cache'], 'hit')
+    assert_equals(results,
+      _ids_and_scores(collection.search(u'fish', spec={u'category': u'B'})))
    
 
+def test_multi_index_search():
+    collection = mongo_search.SearchableCollection(
+      _database['oo_multi_index_works']
+    )
+    collection.remove()
+    stdout, stderr = util.load_fixture('jstests/_fixture-basic.json', collection)
+    collection.configure_text_index_fields({u'title': 1}, u'title_p', postings=True)
+    collection.configure_text_index_fields({u'content': 1}, u'content_p', postings=True)
+    collection.configure_text_index_fields({u'title': 1}, u'title')
+    stdout, stderr = collection.ensure_text_index()
+    
+    expected = {}
+    for index_name, query, boost in [(u'title_p', u'fish', 2), (u'content_p', u'groupers', 1)]:
+        for rec in collection.search({index_name: query}):
+            expected[rec[u'_id']] = expected.get(rec[u'_id'], 0) + boost * rec[u'score']
+    expected = sorted(expected.items(), key=lambda item: -item[1])
+    cursor = collection.search({u'title_p': u'fish', u'content_p': u'groupers'},
+      boosts={u'title_p': 2})
+    assert_equals(_ids_and_scores(cursor),
+      [(id, round(score, 10)) for id, score in expected])
+    assert_equals(cursor.count(), len(expected))
+    cursor = collection.search({u'title_p': u'fish', u'content_p': u'groupers'},
+      boosts={u'title_p': 2}, limit=1)
+    assert_equals([rec[u'_id'] for rec in cursor], [expected[0][0]])
+    assert_equals(cursor.count(), len(expected))
+    assert_equals(cursor.id_list(), None)
+    cursor = collection.search({u'title_p': u'fish', u'content_p': u'groupers'},
+      boosts={u'title_p': 2}).skip(1).limit(1)
+    assert_equals([rec[u'_id'] for rec in cursor], [expected[1][0]])
+    # every index needs postings
+    assert_raises(mongo_search.InvalidSearchOperation, collection.search,
+      {u'title_p': u'fish', u'title': u'fish'})
+
+def test_multi_collection_search():
+    from mongosearch.federated import MultiCollectionSearch
+    collections = []
+    for name in [u'federated_a', u'federated_b']:
+        collection = mongo_search.SearchableCollection(_database[name])
+        collection.remove()
+        stdout, stderr = util.load_fixture('jstests/_fixture-basic.json', collection)
+        collection.configure_text_index_fields({u'title': 5, u'content': 1}, postings=True)
+        stdout, stderr = collection.ensure_text_index()
+        collections.append(collection)
+    
+    # identical collections have the same term statistics as either alone
+    federated = MultiCollectionSearch(collections)
+    expected = _ids_and_scores(collections[0].search(u'dog whippet'))
+    results = federated.search(u'dog whippet', limit=10)
+    assert_equals(_ids_and_scores(results), [pair for pair in expected for i in range(2)])
+    assert_equals(set(rec[u'_collection'] for rec in results),
+      set([u'federated_a', u'federated_b']))
+    assert_equals(len(federated.search(u'dog whippet', limit=1, skip=1)), 1)
+    
+    # with different term statistics, each collection's postings are
+    # rescaled from its own idf to the shared one
+    common, rare = [mongo_search.SearchableCollection(_database[name])
+      for name in [u'federated_common', u'federated_rare']]
+    for collection, contents in [
+      (common, [u'groupers like dory', u'groupers kick', u'groupers', u'whippets']),
+      (rare, [u'groupers like dory', u'whippets kick', u'mongrels', u'whippets'])]:
+        collection.remove()
+        for i, content in enumerate(contents):
+            collection.insert({u'_id': i, u'content': content})
+        collection.configure_text_index_fields({u'content': 1}, postings=True)
+        stdout, stderr = collection.ensure_text_index()
+    federated = MultiCollectionSearch([common, rare])
+    shared_idf = math.log(8.0 / 4)
+    local_idfs = {u'federated_common': math.log(4.0 / 3), u'federated_rare': math.log(4.0)}
+    results = federated.search(u'groupers', limit=10)
+    assert_equals(len(results), 4)
+    for rec in results:
+        collection = {u'federated_common': common, u'federated_rare': rare}[rec[u'_collection']]
+        local_score = dict(_ids_and_scores(collection.search(u'groupers')))[rec[u'_id']]
+        assert_almost_equals(rec[u'score'],
+          local_score * shared_idf / local_idfs[rec[u'_collection']], 8)
+
+def test_async_search():
+    from mongosearch.async_search import AsyncSearchableCollection
+    collection = mongo_search.SearchableCollection(
+      _database['oo_async_works']
+    )
+    collection.remove()
+    stdout, stderr = util.load_fixture('jstests/_fixture-basic.json', collection)
+    collection.configure_text_index_fields({u'title': 5, u'content': 1})
+    stdout, stderr = collection.ensure_text_index()
+    collection = AsyncSearchableCollection(collection)
+    expected = _ids_and_scores(collection.searchable_collection.search(u'dog whippet'))
+    pending = [collection.search(u'dog whippet').to_list() for i in range(5)]
+    for result in pending:
+        assert_equals(_ids_and_scores(result.get(10)), expected)
+    seen = []
+    collection.search(u'dog whippet').each(lambda doc, error: seen.append(doc)).get(10)
+    assert_equals(_ids_and_scores(seen[:-1]), expected)
+    assert_equals(seen[-1], None)
+    assert_equals(collection.search(u'dog whippet').count().get(10), len(expected))
+
+def test_prefetch():
+    import threading
+    collection = mongo_search.SearchableCollection(
+      _database['oo_prefetch_works']
+    )
+    collection.remove()
+    stdout, stderr = util.load_fixture('jstests/_fixture-basic.json', collection)
+    collection.configure_text_index_fields({u'title': 5, u'content': 1})
+    stdout, stderr = collection.ensure_text_index()
+    expected = list(collection.search(u'dog whippet'))
+    page_size = mongo_search.RESULT_PAGE_SIZE
+    mongo_search.RESULT_PAGE_SIZE = 1
+    try:
+        # the next page is fetched in the background, once
+        cursor = collection.search(u'dog whippet', prefetch=True)
+        gate = threading.Event()
+        fetched = []
+        fetch_page = cursor._fetch_page
+        def gated_fetch_page(page_number):
+            if page_number == 1:
+                gate.wait(10)
+            fetched.append(page_number)
+            return fetch_page(page_number)
+        cursor._fetch_page = gated_fetch_page
+        assert_equals(cursor[0], expected[0])
+        assert_true(1 in cursor._prefetches)
+        threading.Timer(0.1, gate.set).start()
+        assert_equals(cursor[1], expected[1]) # waits for the prefetch
+        assert_true(1 in cursor._page_cache)
+        assert_equals(fetched, [0, 1])
+        assert_equals(cursor._prefetches, {})
+        
+        # every slot has been released
+        slots = [mongo_search._prefetch_slots.acquire(False)
+          for i in range(mongo_search.PREFETCH_LIMIT)]
+        assert_true(all(slots))
+        # and with none free, nothing is prefetched
+        cursor = collection.search(u'dog whippet', prefetch=True)
+        assert_equals(cursor[0], expected[0])
+        assert_equals(cursor._prefetches, {})
+        assert_true(1 not in cursor._page_cache)
+        for i in range(mongo_search.PREFETCH_LIMIT):
+            mongo_search._prefetch_slots.release()
+    finally:
+        mongo_search.RESULT_PAGE_SIZE = page_size
+
+def test_search_session():
+    collection = mongo_search.SearchableCollection(
+      _database['oo_session_works']
+    )
+    collection.remove()
+    stdout, stderr = util.load_fixture('jstests/_fixture-basic.json', collection)
+    collection.configure_text_index_fields({u'title': 5, u'content': 1},
+      dictionary=True)
+    stdout, stderr = collection.ensure_text_index()
+    session = collection.search_session()
+    # an unfinished last word is completed
+    for typed, query in [(u'whip', u'whip*'), (u'whippets', u'whippets*'),
+      (u'whippets k', u'whippets k*'), (u'whippets kick', u'whippets kick*'),
+      (u'whippets kick ', u'whippets kick'), (u'whippets kick grouper', u'whippets kick grouper*'),
+      (u'dogs OR fish', u'dogs OR fish')]:
+        assert_equals(_ids_and_scores(session.search(typed)),
+          _ids_and_scores(collection.search(query, limit=10)))
+    assert_equals(session.stats, {'refined': 1, 'reused': 2, 'rescanned': 1})
+    
+    # finished words with too many candidates are only looked up once
+    from mongosearch import typeahead
+    limit = typeahead.SESSION_CANDIDATE_LIMIT
+    typeahead.SESSION_CANDIDATE_LIMIT = 1
+    try:
+        session = collection.search_session()
+        for typed in [u'whippets k', u'whippets ki', u'whippets kic']:
+            assert_equals(_ids_and_scores(session.search(typed)),
+              _ids_and_scores(collection.search(typed + u'*', limit=10)))
+        assert_equals(session.stats, {'refined': 0, 'reused': 2, 'rescanned': 1})
+    finally:
+        typeahead.SESSION_CANDIDATE_LIMIT = limit
+
+def test_complete():
+    collection = mongo_search.SearchableCollection(
+      _database['oo_complete_works']
+    )
+    collection.remove()
+    stdout, stderr = util.load_fixture('jstests/_fixture-basic.json', collection)
+    collection.configure_text_index_fields({u'title': 5, u'content': 1},
+      dictionary=True)
+    collection.configure_text_index_fields({u'title': 1}, u'title')
+    stdout, stderr = collection.ensure_text_index()
+    assert_equals([(rec[u'term'], rec[u'stem'], rec[u'df']) for rec in collection.complete(u'do')],
+      [(u'dogs', u'dog', 2), (u'dory', u'dori', 1)])
+    assert_equals([rec[u'term'] for rec in collection.complete(u'Whip')], [u'whippets'])
+    # answered from the cached completions of u'do'
+    assert_equals([rec[u'term'] for rec in collection.complete(u'dor')], [u'dory'])
+    assert_equals(collection.complete(u'spurgle'), [])
+    assert_equals(_ids_and_scores(collection.search(u'whipp*')),
+      _ids_and_scores(collection.search(u'whippets')))
+    assert_equals(collection.search(u'gro* mong*').count(), 0)
+    assert_equals(collection.search(u'gro* OR mong*').count(), 3)
+    assert_equals(list(collection.search(u'spurg*')), [])
+    # the title index wasn't configured with a dictionary
+    assert_raises(mongo_search.SearchIndexNotInitializedException,
+      collection.complete, u'do', index_name=u'title')
+
+def test_fuzzy_search():
+    from mongosearch.fuzzy import DeletionIndex
+    deletion_index = DeletionIndex()
+    deletion_index.update({u'whippet': 2, u'whip': 1, u'grouper': 2})
+    assert_equals(deletion_index.lookup(u'whipet'), [(u'whippet', 1), (u'whip', 2)])
+    assert_equals(deletion_index.lookup(u'whipet', 1), [(u'whippet', 1)])
+    deletion_index.update({u'whippet': 2, u'mongrel': 1})
+    assert_equals(deletion_index.lookup(u'whipet'), [(u'whippet', 1)])
+    assert_equals(deletion_index.lookup(u'mongrle'), [(u'mongrel', 1)])
+    
+    collection = mongo_search.SearchableCollection(
+      _database['oo_fuzzy_works']
+    )
+    collection.remove()
+    stdout, stderr = util.load_fixture('jstests/_fixture-basic.json', collection)
+    collection.configure_text_index_fields({u'title': 5, u'content': 1},
+      dictionary=True)
+    stdout, stderr = collection.ensure_text_index()
+    assert_equals(list(collection.search(u'whipets')), [])
+    assert_equals(_ids_and_scores(collection.search(u'whipets', fuzzy=True)),
+      _ids_and_scores(collection.search(u'whippets')))
+    assert_equals(_ids_and_scores(collection.search(u'grouprs -mongrle', fuzzy=1)),
+      _ids_and_scores(collection.search(u'groupers -mongrels')))
+    assert_equals(list(collection.search(u'spurgle', fuzzy=True)), [])
+
+def test_substring_search():
+    collection = mongo_search.SearchableCollection(
+      _database['oo_substring_works']
+    )
+    collection.remove()
+    stdout, stderr = util.load_fixture('jstests/_fixture-basic.json', collection)
+    collection.configure_text_index_fields({u'title': 5, u'content': 1}, trigrams=True)
+    collection.configure_text_index_fields({u'title': 1}, u'title')
+    stdout, stderr = collection.ensure_text_index()
+    
+    ids = lambda substring, **kwargs: sorted(doc[u'_id'] for doc in
+      collection.substring_search(substring, **kwargs))
+    assert_equals(ids(u'ongre'), [2])
+    assert_equals(ids(u'ROUPER'), [1, 3])
+    assert_equals(ids(u'hn Do'), [1])
+    assert_equals(ids(u'roupe', spec={u'category': u'B'}), [3])
+    assert_equals(ids(u'xyzzy'), [])
+    assert_raises(mongo_search.InvalidSearchOperation, collection.substring_search, u'ab')
+    assert_raises(mongo_search.SearchIndexNotInitializedException,
+      collection.substring_search, u'dog', index_name=u'title')
+
+def test_positions():
+    from mongosearch import positions
+    for position_list in [[], [0], [3, 5, 200, 100000]]:
+        assert_equals(positions.decode_positions(positions.encode_positions(position_list)),
+          position_list)
+    assert_true(positions.phrase_matches([[0, 5], [6], [7]]))
+    assert_true(not positions.phrase_matches([[0, 5], [6], [8]]))
+    assert_true(positions.near_matches([[0, 50], [10, 53]], 3))
+    assert_true(not positions.near_matches([[0], [10]], 3))
+    
+    collection = mongo_search.SearchableCollection(
+      _database['oo_positions_works']
+    )
+    collection.remove()
+    stdout, stderr = util.load_fixture('jstests/_fixture-basic.json', collection)
+    collection.configure_text_index_fields({u'title': 5, u'content': 1})
+    collection.configure_text_index_fields({u'title': 5, u'content': 1}, u'positional',
+      positions=True)
+    stdout, stderr = collection.ensure_text_index()
+    
+    ids = lambda query_string: sorted(doc[u'_id'] for doc in
+      collection.search({u'positional': query_string}))
+    assert_equals(ids(u'"john dory"'), [1])
+    assert_equals(ids(u'"dory john"'), [])
+    assert_equals(ids(u'"whippets kick"'), [2, 3])
+    assert_equals(ids(u'"kick whippets"'), [])
+    assert_equals(ids(u'groupers NEAR/2 whippets'), [3])
+    assert_equals(ids(u'groupers NEAR/1 whippets'), [])
+    assert_equals(ids(u'groupers NEAR/3 dogs'), []) # different fields
+    assert_equals(ids(u'groupers -"john dory"'), [3])
+    assert_equals(collection.search({u'positional': u'"kick whippets"'}).count(), 0)
+    # facets and the count they cache go by positions too
+    for query_string, category_counts, total in [(u'"kick whippets"', {}, 0),
+      (u'"whippets kick" -mongrels', {u'B': 1}, 1)]:
+        cursor = collection.search({u'positional': query_string})
+        assert_equals(cursor.facets([u'category']), {u'category': category_counts})
+        assert_equals(cursor.count(), total)
+        assert_equals(len(list(cursor)), total)
+        assert_equals(collection.search({u'positional': query_string}).count(
+          approximate=True), total)
+    # without positions, the words just have to be there
+    assert_equals(sorted(doc[u'_id'] for doc in collection.search(u'"dory john"')), [1])
+
+def test_filter_field_pushdown():
+    collection = mongo_search.SearchableCollection(
+      _database['oo_pushdown_works']
+    )
+    collection.remove()
+    stdout, stderr = util.load_fixture('jstests/_fixture-basic.json', collection)
+    collection.configure_text_index_fields({u'title': 5, u'content': 1})
+    collection.configure_text_index_fields({u'title': 5, u'content': 1}, u'filtered',
+      filter_fields=[u'category'], stored_fields=[u'title'])
+    stdout, stderr = collection.ensure_text_index()
+    
+    for spec in [{u'category': u'B'}, {u'category': {u'$in': [u'A', u'B']}},
+      {u'$or': [{u'category': u'A'}, {u'_id': 3.0}]}]:
+        cursor = collection.search({u'filtered': u'whippet'}, spec=spec)
+        assert_equals(_ids_and_scores(cursor),
+          _ids_and_scores(collection.search(u'whippet', spec=spec)))
+        assert_true(cursor.explain()['restriction']['pushdown'])
+        assert_true(cursor._resolved_id_list is None)
+    assert_equals(collection.search({u'filtered': u'whippet'}, spec={u'category': u'B'}).count(), 2)
+    # specs on other fields still go via the collection
+    cursor = collection.search({u'filtered': u'fish'}, spec={u'title': u'fish'})
+    assert_equals([rec[u'_id'] for rec in cursor], [1.0])
+    assert_true(not cursor.explain()['restriction']['pushdown'])
+    # a filtered count isn't the term's document frequency, either way round
+    for i in range(2):
+        assert_equals(collection.search({u'filtered': u'fish'},
+          spec={u'category': u'A'}).count(), 1)
+        assert_equals(collection.search({u'filtered': u'fish'}).count(), 2)
+    
+    # facets from the stored filter fields or from the documents
+    for search_query in [{u'filtered': u'dog'}, u'dog']:
+        cursor = collection.search(search_query)
+        assert_equals(cursor.facets([u'category', u'title']),
+          {u'category': {u'B': 2}, u'title': {u'dogs': 1, u'dogs and fish': 1}})
+        assert_equals(cursor.count(), 2)
+    assert_equals(collection.search({u'filtered': u'fish'}).facets([u'category']),
+      {u'category': {u'A': 1, u'B': 1}})
+    
+    # sorting by stored fields
+    cursor = collection.search({u'filtered': u'whippet'}).sort(u'title', -1)
+    assert_equals([rec[u'_id'] for rec in cursor], [3.0, 2.0])
+    cursor = collection.search({u'filtered': u'whippet'}, limit=1).sort({u'score': -1})
+    assert_equals([rec[u'_id'] for rec in cursor], [3.0])
+    assert_raises(mongo_search.InvalidSearchOperation,
+      collection.search({u'filtered': u'whippet'}).sort, u'content')
+    
+    # stored fields answer searches without hydration
+    expected = [dict(_id=rec[u'_id'], score=rec[u'score'], title=rec[u'title'])
+      for rec in collection.search(u'whippet', skip=1)]
+    assert_equals(list(collection.search({u'filtered': u'whippet'}, skip=1, hydrate=False)),
+      expected)
+    
+
 # def test_stemming():
 #     analyze = whoosh_searching.search_engine().index.schema.analyzer('content')
 #     assert list(analyze(u'finally'))[0].text == u'final' # so porter1 right now
@@ -221,38 +789,41 @@ def test_per_field_search():
 #     assert len(results) == 1
 #     assert results[0]['id'] == u'24455'
 #     
-# def greater_than(a, b):
-#     """
-#     test helper assertion
-#     """
-#     assert a>b
-# 
-# def test_get_field():
-#     """
-#     does our dict traverser descend just how we like it?
-#     """
-#     #fail loudly for nonsense schemata
-#     # yield assert_raises, KeyError, get_field, {}, 'nonexistent_field'
-#     yield assert_equals, get_field({}, 'nonexistent_field'), None
-#     #but find members if they exist
-#     yield assert_equals, get_field({'a': 5}, 'a'), [5]
-#     yield assert_equals, get_field({'a': [5, 6, 7]}, 'a'), [5, 6, 7]
-#     yield assert_equals, get_field({'a': {'b': [5, 6, 7]}}, 'a.b'), [5, 6, 7]
-#     yield assert_equals, get_field({'a': [
-#       {'b': 5},
-#       {'b': 1},
-#       ]}, 'a.b'), [5, 1]
-#     yield assert_equals, get_field({'a': [
-#       {'b': [5, 6, 7]},
-#       {'b': [1, 2, 3]},
-#       ]}, 'a.b'), [5, 6, 7, 1, 2, 3]
-#     yield assert_equals, get_field(
-#       {'artist': [
-#         {'name': ['brett', 'bretto', 'brettmeister']},
-#         {'name': ['tim', 'timmy']},
-#       ]}, 'artist.name'), ['brett', 'bretto', 'brettmeister', 'tim', 'timmy']
-#     yield assert_equals, get_field(
-#       {'artist': [
-#         {'name': ['brett', 'bretto', 'brettmeister']},
-#         {'quality': 'nameless'},
-#       ]}, 'artist.name'), ['brett', 'bretto', 'brettmeister']
+def test_connection_registry():
+    # the same settings always give the same connection
+    assert_true(util.get_connection(**_settings) is _connection)
+    assert_true(util.get_connection() is _connection)
+    assert_true(util.get_default_database().connection is _connection)
+    stats = [conn_stats for conn_stats in util.connection_stats()
+      if conn_stats['settings']['port'] == _settings['port']]
+    assert_equals(len(stats), 1)
+    assert_true(stats[0]['requests'] >= 3)
+
+def test_get_field():
+    """
+    does our dict traverser descend just how we like it?
+    """
+    get_field = util.get_field
+    yield assert_equals, get_field({}, 'nonexistent_field'), None
+    #but find members if they exist
+    yield assert_equals, get_field({'a': 5}, 'a'), [5]
+    yield assert_equals, get_field({'a': [5, 6, 7]}, 'a'), [5, 6, 7]
+    yield assert_equals, get_field({'a': {'b': [5, 6, 7]}}, 'a.b'), [5, 6, 7]
+    yield assert_equals, get_field({'a': [
+      {'b': 5},
+      {'b': 1},
+      ]}, 'a.b'), [5, 1]
+    yield assert_equals, get_field({'a': [
+      {'b': [5, 6, 7]},
+      {'b': [1, 2, 3]},
+      ]}, 'a.b'), [5, 6, 7, 1, 2, 3]
+    yield assert_equals, get_field(
+      {'artist': [
+        {'name': ['brett', 'bretto', 'brettmeister']},
+        {'name': ['tim', 'timmy']},
+      ]}, 'artist.name'), ['brett', 'bretto', 'brettmeister', 'tim', 'timmy']
+    yield assert_equals, get_field(
+      {'artist': [
+        {'name': ['brett', 'bretto', 'brettmeister']},
+        {'quality': 'nameless'},
+      ]}, 'artist.name'), ['brett', 'bretto', 'brettmeister']
@@ -0,0 +1,113 @@
+"""
+Search-as-you-type.
+
+A search box that searches as it's typed in sends a stream of queries that
+mostly extend the one before: "whip", "whipp", "whippet", "whippet k",
+"whippet ki", ... SearchSession remembers the words that have been finished
+(everything before the last space) and the index entries containing all of
+them, so each new query only has to look at those candidates - and when more
+words are finished, it narrows them down rather than starting again. The
+unfinished last word is searched for as a prefix (see dictionary.py).
+"""
+import idsets
+import mongo_search
+
+SESSION_CANDIDATE_LIMIT = 10000 # more candidates than this aren't worth keeping
+
+class SearchSession(object):
+    """
+    Successive searches of the index `index_name` of `searchable_collection`
+    as a query is typed. Should not be instantiated directly, but returned by
+    calling SearchableCollection.search_session().
+
+    `stats` counts how often the candidates were `refined` from the previous
+    ones, `reused` unchanged, or `rescanned` from the whole index.
+    """
+    def __init__(self, searchable_collection, index_name=None, limit=10):
+        self.searchable_collection = searchable_collection
+        self.index_name = index_name or mongo_search.DEFAULT_INDEX_NAME
+        self.limit = limit
+        self._finished_stems = None
+        self._candidates = None
+        self._overflowed = False # the finished stems had too many candidates
+        self.stats = {'refined': 0, 'reused': 0, 'rescanned': 0}
+
+    def search(self, query_string):
+        """
+        Return a SearchCursor for `query_string`, the current contents of the
+        search box, restricted to the candidates for its finished words, with
+        any unfinished last word completed from the index's term dictionary.
+
+        Queries using any of the search syntax beyond plain words are
+        searched from scratch.
+        """
+        words = query_string.split()
+        if [word for word in words if _is_syntax(word)]:
+            self._finished_stems = self._candidates = None
+            self._overflowed = False
+            return self._search(query_string)
+        if query_string[-1:].isspace():
+            finished_words = words
+        else:
+            finished_words = words[:-1]
+            query_string = completing_query(query_string)
+        finished_stems = set(mongo_search.stem_and_tokenize(' '.join(finished_words)))
+        overflowed = False
+        if not finished_stems:
+            candidates = None
+        elif finished_stems == self._finished_stems and \
+          (self._candidates is not None or self._overflowed):
+            candidates, overflowed = self._candidates, self._overflowed
+            self.stats['reused'] += 1
+        elif self._candidates is not None and self._finished_stems <= finished_stems:
+            candidates = self._matching_ids(finished_stems - self._finished_stems,
+              self._candidates)
+            self.stats['refined'] += 1
+        else:
+            candidates = self._matching_ids(finished_stems)
+            overflowed = candidates is None
+            self.stats['rescanned'] += 1
+        self._finished_stems = finished_stems
+        self._candidates = candidates
+        self._overflowed = overflowed
+        if candidates is None:
+            return self._search(query_string)
+        return self._search(query_string, list(candidates))
+
+    def _search(self, query_string, id_list=None):
+        return self.searchable_collection.search({self.index_name: query_string},
+          id_list=id_list, limit=self.limit)
+
+    def _matching_ids(self, stems, within=None):
+        """
+        Return the set of `_id`s of the index entries containing all of
+        `stems`, out of those in `within` (if given), or None if there are
+        more than SESSION_CANDIDATE_LIMIT of them.
+        """
+        collection = self.searchable_collection.search_collection
+        idx_coll = collection.database[mongo_search.index_coll_name(collection,
+          self.index_name)]
+        query_obj = {'value._extracted_terms': {'$all': sorted(stems)}}
+        if within is None:
+            ids = set(rec['_id'] for rec in idx_coll.find(query_obj, ['_id']).limit(
+              SESSION_CANDIDATE_LIMIT + 1))
+            if len(ids) > SESSION_CANDIDATE_LIMIT:
+                return None
+            return ids
+        ids = set()
+        for chunk in idsets.chunks(within):
+            ids.update(rec['_id'] for rec in idx_coll.find(
+              mongo_search._restrict_query(query_obj, chunk), ['_id']))
+        return ids
+
+def completing_query(query_string):
+    """
+    Return `query_string` with its last word searched for as a prefix.
+    """
+    if not query_string.strip() or query_string.endswith('*'):
+        return query_string
+    return query_string + '*'
+
+def _is_syntax(word):
+    return word in ('AND', 'OR', 'NOT') or word.startswith(('-', 'NEAR/')) or \
+      [char for char in '():"' if char in word]
@@ -5,8 +5,14 @@ functions.
 This mirrors the javascript _utils.js in that it provide serverside
 script updating and other miscellaneous infrastructure.
 """
+import threading
+import time
+
 _js_root = ''
-_connection = None
+CONNECTION_SETTINGS = ['host', 'port', 'network_timeout', 'max_pool_size', 'slave_okay']
+_connections = {} # normalised settings: (Connection, stats)
+_default_connection_key = None
+_connections_lock = threading.Lock()
 
 class MongoFullTextError(Exception):
     pass
@@ -27,27 +33,111 @@ def get_settings(**mongo_params):
 
 def get_connection(**settings):
     """
-    get a mongo db connection. with no args, return the current global one, or
-    create a new one
+    Return a mongo db connection for `settings` - `host`, `port`,
+    `network_timeout` (the socket timeout in seconds), `max_pool_size` and
+    `slave_okay`, defaulting as in get_settings().
+    
+    Connections are kept in a registry keyed by their settings: pymongo
+    Connections are thread-safe and pool their sockets, so everyone asking
+    for the same settings shares one, and asking for different settings never
+    affects anyone else's connection. With no args, return the default
+    connection - the first one asked for, unless set_default_connection()
+    has been called - creating one with the default settings if need be.
     """
-    global _connection
+    global _default_connection_key
     from pymongo import Connection
-    if not settings:
-        if _connection is not None:
-            return _connection
+    with _connections_lock:
+        if settings:
+            key = _connection_key(settings)
+        elif _default_connection_key is not None:
+            key = _default_connection_key
         else:
-            settings = get_settings()
-    connection_settings = dict(
-      [(key, settings[key]) for key in [
-        'host', 'port', 'network_timeout'
-      ] if key in settings]
-    )
-    _connection = Connection(**connection_settings)
-    return _connection
+            key = _connection_key(get_settings())
+        if key not in _connections:
+            connection = Connection(**dict(key))
+            _connections[key] = (connection, {'created': time.time(), 'requests': 0})
+        connection, stats = _connections[key]
+        stats['requests'] += 1
+        if _default_connection_key is None:
+            _default_connection_key = key
+        return connection
+
+def _connection_key(settings):
+    settings = get_settings(**settings)
+    return tuple(sorted((key, settings[key]) for key in CONNECTION_SETTINGS
+      if key in settings))
+
+def set_default_connection(**settings):
+    """
+    Make the connection for `settings` the one get_connection() returns
+    when called with no args, and return it.
+    """
+    global _default_connection_key
+    connection = get_connection(**settings)
+    with _connections_lock:
+        _default_connection_key = _connection_key(settings)
+    return connection
+
+def connection_stats():
+    """
+    Return a list of dicts describing each registered connection: its
+    `settings`, when it was `created`, the number of `requests` for it, and,
+    where the driver exposes them, the `max_pool_size` of its socket pool and
+    the number of `idle_sockets` in it.
+    """
+    with _connections_lock:
+        connections = _connections.items()
+    result = []
+    for key, (connection, stats) in connections:
+        description = dict(stats, settings=dict(key))
+        pool = getattr(connection, '_Connection__pool', None)
+        for name, attribute in [('max_pool_size', 'max_size'), ('idle_sockets', 'sockets')]:
+            value = getattr(pool, attribute, None)
+            if value is not None:
+                if not isinstance(value, (int, long)):
+                    value = len(value)
+                description[name] = value
+        result.append(description)
+    return result
+
+def close_connections():
+    """
+    Disconnect and forget all the registered connections.
+    """
+    global _default_connection_key
+    with _connections_lock:
+        for connection, stats in _connections.itervalues():
+            connection.disconnect()
+        _connections.clear()
+        _default_connection_key = None
 
 def get_default_database(dbname='test'):
     return get_connection()[dbname]
 
+def get_field(doc, field_name):
+    """
+    Return a list of all the values at the (possibly dotted) `field_name` in
+    `doc`, descending through lists along the way, or None if there are none.
+    eg. get_field({'a': [{'b': 5}, {'b': [1, 2]}]}, 'a.b') == [5, 1, 2]
+    """
+    values = [doc]
+    for key in field_name.split('.'):
+        next_values = []
+        for value in values:
+            if not isinstance(value, list):
+                value = [value]
+            for item in value:
+                if isinstance(item, dict) and key in item:
+                    next_values.append(item[key])
+        values = next_values
+    result = []
+    for value in values:
+        if isinstance(value, list):
+            result.extend(value)
+        else:
+            result.append(value)
+    return result or None
+
 def get_js_root():
     global _js_root
     if not _js_root: